@@ -1,29 +1,35 @@
 # Import essential libraries
 
-import io
 import os
 import sys
+import time
 from contextlib import asynccontextmanager
 # Standard libraries
 import typing
 from datetime import timedelta, timezone
 
 import dateutil
+import psycopg
 import validators
 from dateutil.parser import *
 from discord import app_commands
 from discord.ext import commands
 
 # Web API libraries
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Header
 import uvicorn
 from pydantic import BaseModel
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse, Response
 
 # Import custom libraries
 from helpers.quoting import *
-
-# from mastoposter import post_new_quote # Semi-bork
+from helpers import database, queries
+from helpers.voting import VoteScheduler
+from helpers.stampfinder import StampfinderJobs, load_pending
+from helpers.users import UserResolver, AuthorProfiles
+from helpers.ui import TopQuotesView
+from helpers import importer, metrics
+from helpers.poster import MastodonPoster
 
 # setup logging
 logger = logging.getLogger('discord')
@@ -36,8 +42,30 @@ cfg = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # One pool for the bot and the API, opened before either starts taking requests
+    await database.open_pool()
+    await database.migrate()
+    await user_prefs.start()
+    karma_queue.start()
+    loop_lag.start()
     asyncio.create_task(sanford.start(cfg["sanford"]["discord_token"]))
+    if cfg['mastodon'].get('run_in_bot'):
+        poster.start()
     yield
+    await shutdown()
+    await sanford.close()
+    await database.close_pool()
+
+async def shutdown():
+    """Stop the background work, saving what it has in hand. Run before the process goes
+    away, whether the API is shutting down or &reboot is about to replace it."""
+    await poster.stop()
+    await loop_lag.stop()
+    await votes.stop()
+    await stampjobs.stop()
+    # Write out any karma that's still waiting in the queue
+    await karma_queue.stop()
+    await user_prefs.stop()
 
 
 # load config
@@ -58,6 +86,46 @@ webapp = FastAPI(
     },
     lifespan=lifespan
 )
+
+# The API shares the database pool (and the event loop) with the bot, so only let so
+# many requests at the database at once. The rest wait their turn here, and the
+# bot's own queries never end up queued behind a burst of API traffic.
+api_limit = asyncio.Semaphore(int((cfg['sanford'].get('api') or {}).get('max_concurrency', 5)))
+# An ndjson export holds its connection for as long as the client takes to download it,
+# long after the middleware above has let go, so exports get a (smaller) limit of their own
+export_limit = asyncio.Semaphore(int((cfg['sanford'].get('api') or {}).get('max_exports', 1)))
+api_stats = {
+    "in_flight": 0,
+    "waiting": 0,
+    "exporting": 0,
+    "served": 0,
+    "wait_total_ms": 0.0,
+    "wait_max_ms": 0.0,
+}
+
+@webapp.middleware("http")
+async def limit_api_concurrency(request, call_next):
+    if not request.url.path.startswith("/quote"):
+        return await call_next(request)
+
+    start = time.perf_counter()
+    api_stats['waiting'] += 1
+    try:
+        await api_limit.acquire()
+    finally:
+        api_stats['waiting'] -= 1
+    waited = (time.perf_counter() - start) * 1000
+    api_stats['wait_total_ms'] += waited
+    api_stats['wait_max_ms'] = max(api_stats['wait_max_ms'], waited)
+
+    api_stats['in_flight'] += 1
+    try:
+        return await call_next(request)
+    finally:
+        api_stats['in_flight'] -= 1
+        api_stats['served'] += 1
+        api_limit.release()
+
 async def run_webapp():
     webapp_config=uvicorn.Config("bot:webapp", host="0.0.0.0", port=8690)
     webapp_server=uvicorn.Server(webapp_config)
@@ -76,9 +144,46 @@ sanford = commands.Bot(
     command_prefix="&",
     intents=intents,
     allowed_contexts=app_commands.AppCommandContext(guild=True,dm_channel=True,private_channel=True),
-    allowed_installs=app_commands.AppInstallationType(guild=True, user=True)
+    allowed_installs=app_commands.AppInstallationType(guild=True, user=True),
+    tree_cls=metrics.TimedCommandTree
     )
 
+# Quotes open for voting, closed by a single background task
+votes = VoteScheduler(sanford, qvote_timeout)
+
+# User lookups that try the gateway and our own cache before hitting the API
+users = UserResolver(sanford, **(cfg['sanford'].get('users') or {}))
+
+# Quote authors' names/avatars/membership, mostly filled in from gateway events
+profiles = AuthorProfiles(users, **(cfg['sanford'].get('profiles') or {}))
+
+# Background stampfinder runs, sharing one budget for reading channel history
+stampjobs = StampfinderJobs(sanford, **(cfg['sanford'].get('stampfinder') or {}))
+
+# Posts to Mastodon go through a queue in the database, sent here or by mastoposter.py
+poster = MastodonPoster(
+    cfg['mastodon']['api_base_url'],
+    cfg['mastodon']['access_token'],
+    lambda: user_prefs.excluded,
+    **(cfg['mastodon'].get('poster') or {})
+)
+
+# How late the event loop is running, for /metrics
+loop_lag = metrics.LoopLagMonitor(**(cfg['sanford'].get('metrics') or {}))
+
+# Everything from the /status endpoints, as gauges on /metrics
+metrics.stats.add('database', database.pool_stats)
+metrics.stats.add('api', lambda: api_stats)
+metrics.stats.add('votes', votes.stats)
+metrics.stats.add('karma', karma_queue.stats)
+metrics.stats.add('users', users.stats)
+metrics.stats.add('profiles', profiles.stats)
+metrics.stats.add('search', quote_search.stats)
+metrics.stats.add('cache', quote_cache.stats)
+metrics.stats.add('random', quote_ids.stats)
+metrics.stats.add('prefs', user_prefs.stats)
+metrics.stats.add('loop', loop_lag.stats)
+
 # define API models
 
 class Quote(BaseModel):
@@ -93,6 +198,18 @@ class Quote(BaseModel):
 class Error(BaseModel):
     error: str
 
+class SearchResults(BaseModel):
+    quotes: list[Quote]
+    # "fulltext" (whole words) or "substring" (partial matches) - send it back with the next page
+    mode: str
+    # Pass this back as `offset` for the next page; null once there's nothing left
+    next: int | None = None
+
+class QuotePage(BaseModel):
+    quotes: list[Quote]
+    # Pass this back as `after` for the next page; null once there's nothing left
+    next: int | None = None
+
 
 # various helpers
 def strfdelta(tdelta, fmt):
@@ -106,6 +223,9 @@ def strfdelta(tdelta, fmt):
 async def reboot(ctx):
     await ctx.send("Reloading the bot...")
     logger.warning("Rebooting the bot!")
+    # execv skips the lifespan teardown, so do it here
+    await shutdown()
+    await database.close_pool()
     os.execv(sys.executable,['python3.12'] + sys.argv)
 
 @sanford.command()
@@ -132,25 +252,19 @@ async def stampfinder(ctx, *, channel: typing.Union[discord.TextChannel, discord
 
     # Now go to sleep
 
-    # Alright, let's start by initialising a connection to the database
-
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port = cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-    )
-
     logger.info(f"Stampfinder: Attempting to resolve missing timestamps and message IDs for quotes in #{channel.name}")
-    delta = datetime.now()
-
-    cur = con.cursor()
 
-    cur.execute(f"SELECT id,content,authorid FROM bot.quotes WHERE guild='{str(ctx.guild.id)}' AND authorID is not NULL AND (timestamp IS NULL OR addedby is NULL) ORDER BY id ASC")
+    # Been here before? Carry on from the last checkpoint instead of starting over
+    job = await stampjobs.get(channel.id)
+    if stampjobs.running(channel.id):
+        await ctx.send(f"I'm already searching <#{channel.id}>! Use `&stampstatus` to see how it's going.")
+        return
+    elif job is not None and job['status'] != 'done':
+        await stampjobs.start(channel, ctx.channel.id)
+        await ctx.send(f"Picking up where I left off in <#{channel.id}> (**{job['messages']}** messages searched, **{job['hits']}** found so far). I'll post here when I'm done.")
+        return
 
-    # Sadly, SELECT statements don't have a rowcount or len in the cur, so we /have/ to fetchall
-    untimestamped = cur.fetchall()
+    untimestamped = await load_pending(ctx.guild.id)
 
     logger.info(f"Returned {str(len(untimestamped))} quotes in need of a timestamp or msgID")
     if len(untimestamped) == 0:
@@ -197,75 +311,8 @@ async def stampfinder(ctx, *, channel: typing.Union[discord.TextChannel, discord
 
             logger.info("Stampfinder: Here we go")
 
-
-            msgcounter = 0 # Count total messages
-            hitcounter = 0 # Count matching messages
-
-            progressmsg = await ctx.send(f"**Progress:** **{msgcounter}** messages searched, **{hitcounter}/{len(untimestamped)}** quote timestamps found.")
-
-            async with ctx.typing():
-
-                async for message in channel.history(limit=None,oldest_first=True): # limit=None when this is complete
-                    if msgcounter == 0:
-                        logger.info(f"processing message {msgcounter} (currently exploring {message.created_at.strftime('%B %d, %Y')})")
-                    msgcounter += 1
-                    logger.debug(f"processing message {msgcounter} (currently exploring {message.created_at.strftime('%B %d, %Y')})")
-                    if msgcounter % 1000 == 0:
-                        logger.info(f"processing message {msgcounter} (currently exploring {message.created_at.strftime('%B %d, %Y')})")
-                        await progressmsg.edit(content = f"**Progress:** **{msgcounter}** messages searched (currently exploring {message.created_at.strftime('%B %d, %Y')}), **{hitcounter}/{len(untimestamped)}** quote timestamps found.")
-                    for row in untimestamped:
-                        # First, check that between when we started and now,
-                        # we did not get a timestamp/message ID added
-
-                        # This of course
-                        cur.execute(f"SELECT 1 from bot.quotes WHERE id='{row[0]}' AND (timestamp IS NULL OR source IS NULL OR msgID IS NULL OR addedby IS NULL)")
-                        check_dupe = cur.fetchall()
-
-                        if not(bool(check_dupe)):
-                            logger.debug("We already found a quote associated with this message")
-                            continue
-
-                        if (row[1] == message.content and int(row[2]) == message.author.id) or (row[1] in message.content and int(row[2]) == message.author.id) or (row[1] in message.clean_content and int(row[2]) in message.raw_mentions):
-                            if message.author.id == sanford.user.id:
-                                continue # Don't add confirmation messages from Sanford as the message ID itself
-                            elif message.content.startswith('b!addquote'):
-                                continue # Pre-Bucket/Sanford string circa 2016
-                                # This basically means we tried to add it from IRC or another prior network
-                                # Ergo, this is not a timestamp we want
-
-                            logger.info(f"Stampfinder: Found quote ID {row[0]} in msg ID {message.id} timestamp {message.created_at.strftime('%Y-%m-%d %H:%M:%S.%f %z')}")
-                            logger.debug(f'quote content: {row[1]}\nquote author: {row[2]}')
-                            logger.debug(f'message content: {message.content}\nmessage author: {message.author.id}')
-
-                            addedby = ""
-                            if message.content.startswith('Bucket, addquote') or message.content.startswith('//addquote'):
-                                addedby = message.author.id
-
-                            # OK, this is the part where we actually update the database
-                            try:
-                                cur.execute("UPDATE bot.quotes SET msgID= %s, timestamp= %s, updatedAt= %s, addedby = %s, source = %s WHERE ID= %s", (
-                                    message.id,
-                                    int(datetime.timestamp(message.created_at)),
-                                    datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
-                                    addedby if bool(addedby) else None,
-                                    message.jump_url,
-                                    int(row[0]),
-                                    ))
-                            except psycopg2.DatabaseError as error:
-                                await ctx.send(f'Error: SQL Update Failed due to:\n```{str(error)}```')
-                                logger.error("QUOTE SQL ERROR:\n" + str(error))
-                                break
-
-                            hitcounter += 1
-
-                            continue
-
-                    # progressmsg.delete()
-            con.commit()
-            delta = datetime.now() - delta
-            logger.info(f"Done! Found sources for {str(hitcounter)} out of {str(len(untimestamped))} quotes in {str(msgcounter)} messages in #{channel.name}")
-            await ctx.send(f"Done! Found sources for **{str(hitcounter)}** out of {str(len(untimestamped))} quotes in **{str(msgcounter)} messages** in <#{channel.id}>.\nTime taken: **{strfdelta(delta, '{hours} hours, {minutes} minutes, {seconds} seconds')}**.")
-    cur.close()
+            await stampjobs.start(channel, ctx.channel.id)
+            await ctx.send(f"I'll keep going in the background and post here when I'm done. Use `&stampstatus` to check on progress, or `&stamppause` to stop for now.")
 
 @stampfinder.error
 async def stampfinder_err(ctx, error):
@@ -277,6 +324,65 @@ async def stampfinder_err(ctx, error):
         await ctx.send(error)
         logger.error(error)
 
+@sanford.command()
+@commands.is_owner()
+async def stampstatus(ctx):
+    jobs = await stampjobs.status()
+    if not jobs:
+        await ctx.send("No stampfinder jobs yet.")
+        return
+    lines = []
+    for job in jobs:
+        line = f"<#{job['channelid']}>: **{job['status']}**, **{job['messages']}** messages searched, **{job['hits']}/{job['total']}** found"
+        if job['last_timestamp']:
+            line += f", up to <t:{job['last_timestamp']}:D>"
+        if job['messages_per_second']:
+            line += f" ({job['messages_per_second']:.1f} msgs/sec)"
+        if job['error']:
+            line += f"\n-# {job['error']}"
+        lines.append(line)
+    await ctx.send("\n".join(lines))
+
+@sanford.command()
+@commands.is_owner()
+async def importquotes(ctx, format: str = None):
+    # Attach a .csv, .json or .ndjson file of quotes (fields as in the API's Quote model,
+    # plus msgid and added_by) and they all go into this server at once
+    if ctx.guild is None:
+        await ctx.send(":no_entry_sign: Quotes are imported into a server, so this only works in one.")
+        return
+    if not ctx.message.attachments:
+        await ctx.send(f"Attach a file of quotes to import ({', '.join(importer.formats)}).")
+        return
+    attachment = ctx.message.attachments[0]
+    async with ctx.typing():
+        try:
+            result = await importer.run_import(await attachment.read(), format or importer.guess_format(attachment.filename), ctx.guild.id, ctx.author.id)
+        except (ValueError, psycopg.DatabaseError) as error:
+            await ctx.send(f"Import failed: {error}")
+            return
+
+    message = f"Imported **{result['imported']:,}** of **{result['rows']:,}** quotes in {result['seconds']}s ({result['rows_per_second']:,} rows/sec). **{result['duplicates']:,}** were already saved, **{result['invalid']:,}** were invalid."
+    if result['errors']:
+        message += "\n" + "\n".join(f"-# Row {e['row']}: {e['error']}" for e in result['errors'][:5])
+    await ctx.send(message[:2000])
+
+@sanford.command()
+@commands.is_owner()
+async def recountstats(ctx):
+    async with ctx.typing():
+        wrong = await reconcile_quote_stats()
+    if wrong:
+        await ctx.send(f"Recounted quote stats. **{len(wrong)}** servers had drifted and have been fixed.")
+    else:
+        await ctx.send("Recounted quote stats. Everything was already correct.")
+
+@sanford.command()
+@commands.is_owner()
+async def stamppause(ctx, *, channel: typing.Union[discord.TextChannel, discord.Thread]):
+    await stampjobs.pause(channel.id)
+    await ctx.send(f"Paused stampfinder in <#{channel.id}>. Run `&stampfinder` on it again to carry on.")
+
 @sanford.tree.command()
 @app_commands.guilds(TGC)
 @app_commands.rename(exclude_in_mastoposter='dont_send_quotes')
@@ -284,28 +390,19 @@ async def stampfinder_err(ctx, error):
             masto_alias="Set your name for when you are mentioned in a quote by @tgcooc.")
 async def mastodon(interaction: discord.Interaction, exclude_in_mastoposter: bool = None, masto_alias: str = None):
     """Configure settings relating to you in the @tgcooc Mastodon account."""
-    global cfg
-    if not(exclude_in_mastoposter) and not(masto_alias):
-        await interaction.response.send_message(f"Here's what I have for you right now in relation to the quote bot at https://social.thegeneral.chat/@tgcooc :\n\nYou have chosen to **{'prevent' if interaction.user.id in cfg['mastodon']['exclude_users'] else 'allow' }** posting of your quotes on Mastodon.\nYou are currently referred to as **{cfg['mappings']['users'][interaction.user.id] if bool(cfg['mappings']['users'][interaction.user.id]) else 'nobody (masto_alias not set!)'}** if you are the author of, or mentioned in, a quote.",ephemeral=True)
+    if exclude_in_mastoposter is None and masto_alias is None:
+        alias = user_prefs.aliases.get(interaction.user.id)
+        await interaction.response.send_message(f"Here's what I have for you right now in relation to the quote bot at https://social.thegeneral.chat/@tgcooc :\n\nYou have chosen to **{'prevent' if interaction.user.id in user_prefs.excluded else 'allow' }** posting of your quotes on Mastodon.\nYou are currently referred to as **{alias if bool(alias) else 'nobody (masto_alias not set!)'}** if you are the author of, or mentioned in, a quote.",ephemeral=True)
+        return
     try:
+        await user_prefs.set(interaction.user.id, exclude=exclude_in_mastoposter, alias=masto_alias)
         if exclude_in_mastoposter is not None:
-            if exclude_in_mastoposter == True:
-                cfg['mastodon']['exclude_users'].append(interaction.user.id)
-                logger.info(f"/mastodon: {interaction.user.name} added themselves to the excluded_users list")
-            else:
-                cfg['mastodon']['exclude_users'].remove(interaction.user.id)
-                logger.info(f"/mastodon: {interaction.user.name} removed themselves from the excluded_users list")
-        if masto_alias is not None:
-            cfg['mappings']['users'][interaction.user.id] = masto_alias
-
-        with open('config.yaml', 'w') as file:
-            yaml.dump(cfg, file)
-        with open('config.yaml', 'r') as file:
-            cfg = yaml.safe_load(file)
-            await interaction.response.send_message("Your settings were updated.",ephemeral=True)
-    except io.UnsupportedOperation as error:
-        logger.error("Issue reading the config file!", error)
-        await interaction.response.send_message("There was an issue reading the file.",ephemeral=True)
+            logger.info(f"/mastodon: {interaction.user.name} {'added themselves to' if exclude_in_mastoposter else 'removed themselves from'} the excluded users")
+        await interaction.response.send_message("Your settings were updated.",ephemeral=True)
+    except psycopg.DatabaseError as error:
+        logger.error("/mastodon: couldn't save settings")
+        logger.exception(error)
+        await interaction.response.send_message("There was an issue saving your settings.",ephemeral=True)
 
 quote_group = app_commands.Group(name='quote',description='Save or recall memorable messages')
 
@@ -322,11 +419,11 @@ async def quote_get(interaction: discord.Interaction, user: discord.User=None, a
                     ephemeral=True
                     )
                 return
-            qid,content,aID,aName,timestamp,karma,source = get_quote(None, user.id)
+            qid,content,aID,aName,timestamp,karma,source = await get_quote(None, user.id)
         elif isinstance(interaction.channel, discord.abc.PrivateChannel) and bool(user):
-            qid,content,aID,aName,timestamp,karma,source = get_quote(None, user.id)
+            qid,content,aID,aName,timestamp,karma,source = await get_quote(None, user.id)
         elif bool(user):
-            qid,content,aID,aName,timestamp,karma,source = get_quote(interaction.guild_id, user.id)
+            qid,content,aID,aName,timestamp,karma,source = await get_quote(interaction.guild_id, user.id)
         elif isinstance(interaction.channel, discord.abc.PrivateChannel):
             # Discord can't support this for user apps!
             # Reason being, it cannot access the list of recipients in a channel, in a user app context
@@ -342,7 +439,7 @@ async def quote_get(interaction: discord.Interaction, user: discord.User=None, a
             return
         elif all_servers:
             if interaction.user.id == 49288117307310080:
-                qid,content,aID,aName,timestamp,karma,source = get_quote(None, None)
+                qid,content,aID,aName,timestamp,karma,source = await get_quote(None, None)
             else:
                 await interaction.response.send_message(
                 ":no_entry_sign: Just FYI, `all_servers` will only work if you're exposing yourself.",
@@ -350,7 +447,7 @@ async def quote_get(interaction: discord.Interaction, user: discord.User=None, a
                 )
                 return
         else:
-            qid,content,aID,aName,timestamp,karma,source = get_quote(interaction.guild_id, None)
+            qid,content,aID,aName,timestamp,karma,source = await get_quote(interaction.guild_id, None)
     except LookupError as error:
         await interaction.response.send_message(str(error), ephemeral=True)
         return
@@ -364,29 +461,21 @@ async def quote_get(interaction: discord.Interaction, user: discord.User=None, a
             await interaction.response.send_message(errmsg, ephemeral=True)
 
     # Is the user still in the server?
-    authorObject = None
-    authorAvatar = None
-    try:
-        authorObject = await interaction.guild.fetch_member(aID)
-    except:
-        pass
+    authorProfile, authorIsMember = await profiles.lookup(interaction.guild, aID)
+    authorAvatar = authorProfile.avatar_url if authorProfile else None
 
-    if bool(authorObject):
-        authorAvatar = authorObject.display_avatar
-    else:
-        author = await sanford.fetch_user(aID)
-        if author:
-            aName = author.name
-            authorAvatar = author.display_avatar
+    if not authorIsMember:
+        if authorProfile:
+            aName = authorProfile.name
         else:
             aName = rename_user(aID, "'unknown', yeah, let's go with that")
 
     quoteview = discord.Embed(
-        description=format_quote(content, timestamp, authorID=aID if authorObject is not None else None, authorName=aName, source=source, format='markdown')
+        description=format_quote(content, timestamp, authorID=aID if authorIsMember else None, authorName=aName, source=source, format='markdown')
     )
 
     # Set avatar
-    if bool(authorAvatar): quoteview.set_thumbnail(url=authorAvatar.url)
+    if bool(authorAvatar): quoteview.set_thumbnail(url=authorAvatar)
     else: quoteview.set_thumbnail(url="https://cdn.thegeneral.chat/sanford/special-avatars/sanford-quote-noicon.png")
 
     if cfg['sanford']['quoting']['voting'] == True and interaction.is_guild_integration(): quoteview.set_footer(text=f"Score: {'+' if karma > 0 else ''}{karma}. Voting is open for {qvote_timeout} minutes.")
@@ -395,62 +484,99 @@ async def quote_get(interaction: discord.Interaction, user: discord.User=None, a
 
     if cfg['sanford']['quoting']['voting'] == True and interaction.is_guild_integration():
         qmsg = await interaction.original_response()
+        await votes.open(qmsg, qid, karma, quoteview)
+
+@quote_group.command(name="search")
+@app_commands.describe(text='Words (or part of a word) to look for', author='Only search quotes by this user', page='Which page of results to show', public='Show the results to everyone?',
+                       match='How the first page matched (shown at the bottom of the results), so later pages line up with it')
+async def quote_search_command(interaction: discord.Interaction, text: str, author: discord.User = None, page: int = 1, public: bool = False, match: typing.Literal["fulltext", "substring"] = None):
+    """Find a quote by what was said"""
+    if isinstance(interaction.channel, discord.abc.PrivateChannel) and not bool(author):
+        await interaction.response.send_message(":no_entry_sign: You'll need to specify a user when searching quotes in a private channel.", ephemeral=True)
+        return
 
-        newkarma = await karma_helper(interaction, qid, karma)
-        karmadiff = newkarma[1] - karma
+    per_page = 5
+    page = max(1, page)
+    try:
+        # One extra, to see if there's another page after this one
+        mode, results = await quote_search.search(text, interaction.guild_id, author.id if author else None, limit=per_page + 1, offset=(page - 1) * per_page, mode=match)
+    except LookupError as error:
+        await interaction.response.send_message(str(error), ephemeral=True)
+        return
 
-        try:
-            quoteview.set_footer(text=f"Score: {'+' if newkarma[1] > 0 else ''}{newkarma[1]} ({'went up by +{karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff > 0 else 'went down by {karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff < 0 else 'did not change'} this time).")
-            update_karma(qid,newkarma[1])
-            await qmsg.edit(embed=quoteview)
-            await qmsg.clear_reactions()
-        except Exception as error:
-            quoteview.set_footer(text=f"Score: {'+' if karma > 0 else ''}{karma} (no change due to error: {error}")
-            await qmsg.edit(embed=quoteview)
+    if not results:
+        await interaction.response.send_message(f":no_entry_sign: No quotes matching \"{text}\"{' on that page' if page > 1 else ''}.", ephemeral=True)
+        return
+
+    resultview = discord.Embed(title=f"Quotes matching \"{text}\"")
+    for qid,content,aID,aName,timestamp,karma,source in results[:per_page]:
+        if len(content) > 300: content = content[:300] + "…"
+        resultview.add_field(
+            name=f"#{qid} · Score: {'+' if karma > 0 else ''}{karma}",
+            value=format_quote(content, timestamp, authorID=aID, authorName=aName, source=source, format='markdown'),
+            inline=False
+        )
+    resultview.set_footer(text=f"Page {page}{f' · /quote search page:{page + 1} match:{mode} for more' if len(results) > per_page else ''}")
+    await interaction.response.send_message(embed=resultview, allowed_mentions=discord.AllowedMentions.none(), ephemeral=not public)
 
 @quote_group.command(name="top")
 @app_commands.describe(author='User whose quotes you want to see')
 async def quote_topquotes(interaction: discord.Interaction, author: discord.Member=None):
     """See the top quotes of the server, or of a user"""
-    await interaction.response.send_message(":no_entry_sign: Coming whenever Splatsune gets the spoons.",ephemeral=True)
+    if not interaction.guild_id:
+        await interaction.response.send_message(":no_entry_sign: Top quotes are per server, so this only works in one.", ephemeral=True)
+        return
+
+    async def fetch(after, limit):
+        return await top_quotes(interaction.guild_id, author.id if author else None, after, limit)
+
+    def render(rows, first_rank):
+        topview = discord.Embed(title=f"Top quotes{f' by {author.display_name}' if author else ''} in {interaction.guild.name}")
+        for rank, (qid,content,aID,aName,timestamp,karma,source) in enumerate(rows, start=first_rank):
+            if len(content) > 300: content = content[:300] + "…"
+            topview.add_field(
+                name=f"#{rank} · Score: {'+' if karma > 0 else ''}{karma}",
+                value=format_quote(content, timestamp, authorID=aID, authorName=aName, source=source, format='markdown'),
+                inline=False
+            )
+        return topview
+
+    view = TopQuotesView(interaction.user, fetch, render)
+    try:
+        topview = await view.load()
+    except psycopg.DatabaseError as error:
+        await interaction.response.send_message(f'Error: SQL Failed due to:\n```{str(error)}```',ephemeral=True)
+        logger.error("QUOTE SQL ERROR:\n" + str(error))
+        return
+
+    if not view.rows:
+        await interaction.response.send_message(f":no_entry_sign: {'That user has' if author else 'This server has'} no quotes yet!", ephemeral=True)
+        return
+
+    await interaction.response.send_message(embed=topview, view=view, allowed_mentions=discord.AllowedMentions.none())
+    view.message = await interaction.original_response()
 
 @quote_group.command(name="sanity")
-@app_commands.describe(public='Publish the results to everyone?')
-async def quote_sanitycheck(interaction: discord.Interaction, public: bool = False):
+@app_commands.describe(public='Publish the results to everyone?', this_server='Only count quotes from this server?')
+async def quote_sanitycheck(interaction: discord.Interaction, public: bool = False, this_server: bool = False):
     """Check how many quotes are missing details"""
 
     def percentage(part, whole):
-        Percentage = float(part)/float(whole)
+        Percentage = float(part)/float(whole) if whole else 0.0
         return f"{Percentage:.2%}"
 
     try:
-        sql_query = '''select 
-            count(*) as total,
-            sum(case when timestamp is null then 1 else 0 end) as nullstamps,
-            sum(case when source is null then 1 else 0 end) as nullsource,
-            sum(case when msgid is null then 1 else 0 end) as nullids
-            from bot.quotes'''
-
-        con = psycopg2.connect(
-                database = cfg['postgresql']['database'],
-                host = cfg['postgresql']['host'],
-                port = cfg['postgresql']['port'],
-                user = cfg['postgresql']['user'],
-                password = cfg['postgresql']['password'],
-        )
-        cur = con.cursor()
-
-        cur.execute(sql_query)
-        qtotal,qnullstamps,qnullsource,qnullids = cur.fetchone()
+        # Counted as quotes come and go (see helpers/sql/008_quote_stats.sql), so this is a quick read
+        qtotal,qnullstamps,qnullsource,qnullids = await quote_stats(interaction.guild_id if this_server else None)
 
-        message = f'''Out of **{qtotal:,}** total quotes stored by Sanford...
+        message = f'''Out of **{qtotal:,}** total quotes stored by Sanford{' in this server' if this_server else ''}...
         
         **{qnullstamps:,}** (*{percentage(qnullstamps,qtotal)}*) have no timestamp and will display as from 'Octember 32'.
         **{qnullsource:,}** (*{percentage(qnullsource,qtotal)}*) have no source (implemented <t:1726835400:R>) and cannot be linked to.
         **{qnullids:,}** (*{percentage(qnullids,qtotal)}*) have no message ID, used internally. These quotes may have come from elsewhere, or may have been manually imported.'''
 
         await interaction.response.send_message(message,ephemeral=not public)
-    except psycopg2.DatabaseError as error:
+    except psycopg.DatabaseError as error:
         await interaction.response.send_message(f'Error: SQL Failed due to:\n```{str(error.with_traceback)}```',ephemeral=True)
         logger.error("QUOTE SQL ERROR:\n" + str(error.with_traceback))
 
@@ -476,7 +602,7 @@ async def quote_addbyhand(interaction: discord.Interaction, author: discord.Memb
             source if validators.url(source) else None
         )
 
-        qid,karma = insert_quote(sql_values)
+        qid,karma = await insert_quote(sql_values)
 
         logger.info("Quote saved successfully")
         logger.debug(format_quote(content, authorName=author.name, timestamp=int(datetime.timestamp(timestamp))))
@@ -494,26 +620,19 @@ async def quote_addbyhand(interaction: discord.Interaction, author: discord.Memb
             ephemeral=author.id == interaction.user.id
             )
 
-        if interaction.guild_id == 124680630075260928 and author.id not in cfg['mastodon']['exclude_users']:
-            post_new_quote(content, author.id, int(datetime.timestamp(timestamp)))
+        if interaction.guild_id == poster.guild and author.id not in user_prefs.excluded:
+            # The quote's saved and the reply's gone out, so a failure here is only logged
+            # (the handlers below would try to reply a second time)
+            try:
+                await poster.enqueue(qid)
+            except psycopg.DatabaseError as error:
+                logger.error(f"Mastodon: couldn't queue quote {qid}: {error}")
 
         if cfg['sanford']['quoting']['voting'] == True and interaction.is_guild_integration():
             qmsg = await interaction.original_response()
+            await votes.open(qmsg, qid, karma, quote)
 
-            newkarma = await karma_helper(interaction, qid, karma)
-            karmadiff = newkarma[1] - karma
-
-            try:
-                quote.set_footer(text=f"Score: {'+' if newkarma[1] > 0 else ''}{newkarma[1]} ({'went up by +{karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff > 0 else 'went down by {karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff < 0 else 'did not change'} this time).")
-                update_karma(qid,newkarma[1])
-                await qmsg.edit(embed=quote)
-                await qmsg.clear_reactions()
-            except Exception as error:
-                quote.set_footer(text=f"Score: {'+' if karma > 0 else ''}{karma} (no change due to error: {error}")
-                await qmsg.edit(embed=quote)
-
-        con.close()
-    except psycopg2.DatabaseError as error:
+    except psycopg.DatabaseError as error:
         await interaction.response.send_message(f'Error: SQL Failed due to:\n```{str(error.with_traceback)}```',ephemeral=True)
         logger.error("QUOTE SQL ERROR:\n" + str(error.with_traceback))
     except dateutil.parser._parser.ParserError as error:
@@ -527,117 +646,41 @@ async def quote_leaderboards(interaction: discord.Interaction):
         description=f"These are the rankings as of right now"
         )
 
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port = cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-    )
-    cur = con.cursor()
-
     # Might take a bit, so
     await interaction.response.send_message(content=":thinking:")
 
-    # Most Quotes
-    try:
-        cur.execute(f"SELECT count(*) as quotes, authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY quotes desc LIMIT 10")
-
-        lb_mostquoted = cur.fetchall()
-        lb_mq_list = []
-        for count,author in lb_mostquoted:
-            try:
-                user = await sanford.fetch_user(author)
-            except Exception as err:
-                user = "???"
-            lb_mq_list.append(f"{str(user)}: **{count}**")
-
-        lb_mq_string = "\n".join(lb_mq_list)
-
-        leaderboard.add_field(
-            name="Top 10 Most Quoted",
-            value=lb_mq_string,
-            inline=False
-        )
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
-
-    # Most Average Karma
-    try:
-        cur.execute(f"SELECT avg(karma), authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY avg desc LIMIT 5")
-
-        lb_bestkarma = cur.fetchall()
-        lb_bk_list = []
-        for count,author in lb_bestkarma:
-            try:
-                user = await sanford.fetch_user(author)
-            except Exception as err:
-                user = "???"
-            lb_bk_list.append(f"{str(user)}: **{count:.2f}**")
-
-        lb_bk_string = "\n".join(lb_bk_list)
-
-        leaderboard.add_field(
-            name="Top 5 Highest Average Karma",
-            value=lb_bk_string,
-            inline=True
-        )
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
-
-    # Most Karma (Total)
+    # All four boards come precomputed from the leaderboard cache
     try:
-        cur.execute(f"SELECT (sum(karma) - count(*)) as score, authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY score desc LIMIT 5")
-
-        lb_mostkarma = cur.fetchall()
-        lb_mk_list = []
-        for count,author in lb_mostkarma:
-            try:
-                user = await sanford.fetch_user(author)
-            except Exception as err:
-                user = "???"
-            lb_mk_list.append(f"{str(user)}: **{count}**")
-
-        lb_mk_string = "\n".join(lb_mk_list)
-
-        leaderboard.add_field(
-            name="Top 5 Most Karma",
-            value=lb_mk_string,
-            inline=True
-        )
+        board = await leaderboards.get(interaction.guild.id)
     except Exception as err:
         logger.error(err)
         await interaction.edit_original_response(content=err)
         return
 
-    # Most Saved
-    try:
-        cur.execute(f"SELECT count(*), addedby FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY addedby ORDER BY count desc LIMIT 5")
+    sections = (
+        ("quotes", "Top 10 Most Quoted", 10, False, "{}"),
+        ("avg_karma", "Top 5 Highest Average Karma", 5, True, "{:.2f}"),
+        ("total_karma", "Top 5 Most Karma", 5, True, "{}"),
+        ("saves", "Top 5 Most Saves", 5, True, "{}"),
+    )
 
-        lb_mostsaved = cur.fetchall()
-        lb_ms_list = []
-        for count,author in lb_mostsaved:
-            try:
-                user = await sanford.fetch_user(author)
-            except Exception as err:
-                user = "???"
-            lb_ms_list.append(f"{str(user)}: **{count}**")
+    # Look everyone up in one go, rather than one API call per row
+    lb_users = await users.resolve_many(
+        [author for category, _, limit, _, _ in sections for _, author, _ in board.top(category, limit)],
+        guild=interaction.guild
+    )
 
-        lb_ms_string = "\n".join(lb_ms_list)
+    for category, title, limit, inline, valuefmt in sections:
+        lb_list = []
+        for count,author,rank in board.top(category, limit):
+            user = lb_users.get(author) or "???"
+            lb_list.append(f"{str(user)}: **{valuefmt.format(count)}**")
 
         leaderboard.add_field(
-            name="Top 5 Most Saves",
-            value=lb_ms_string,
-            inline=True
+            name=title,
+            value="\n".join(lb_list),
+            inline=inline
         )
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
 
     await interaction.edit_original_response(content=None,embed=leaderboard)
 
@@ -645,110 +688,34 @@ sanford.tree.add_command(quote_group)
 
 @sanford.tree.context_menu(name='Leaderboard Stats')
 async def stats(interaction: discord.Interaction, member: discord.Member):
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port= cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-    )
-    cur = con.cursor()
-
-    def findIndex(l, index, value):
-        for pos, t in enumerate(l):
-            if t[index] == value:
-                return pos
-        raise ValueError("list.index(x): x not in list")
-
-    # Might take a bit, so
-    # await interaction.response.send_message(content=":thinking:",ephemeral=true)
-
-    # Most Quotes
     try:
-        cur.execute(f"SELECT count(*) as quotes, authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY quotes desc")
-
-        lb_mostquoted = cur.fetchall()
-
+        ranks = await leaderboards.ranks(interaction.guild.id, member.id)
     except Exception as err:
         logger.error(err)
-        await interaction.edit_original_response(content=err)
+        await interaction.response.send_message(content=err,ephemeral=True)
         return
 
-    # Most Average Karma
-    try:
-        cur.execute(f"SELECT avg(karma), authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY avg desc")
+    quoterank = ranks['quotes']
+    karmarank = ranks['avg_karma']
+    karmascore = ranks['total_karma']
+    savedrank = ranks['saves']
 
-        lb_bestkarma = cur.fetchall()
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
-
-
-    # Most Karma (Total)
-    try:
-        cur.execute(f"SELECT (sum(karma) - count(*)) as score, authorid FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY authorid ORDER BY score desc")
-
-        lb_mostkarma = cur.fetchall()
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
-
-    # Most Saved
-    try:
-        cur.execute(f"SELECT count(*), addedby FROM bot.quotes WHERE guild={str(interaction.guild.id)} GROUP BY addedby ORDER BY count desc")
+    rankmsg = f"{member.mention} is **rank {quoterank[1]}** with **{quoterank[0]}** quotes." if quoterank else ""
+    rankmsg += f"\n{member.mention} has an *average* karma score of **{karmarank[0]:.3f}**, making them **rank {karmarank[1]}** in karma." if karmarank else ""
+    rankmsg += f"\n{member.mention} has a *total* karma score of **{karmascore[0]}**, making them **rank {karmascore[1]}** in karma." if karmascore else ""
+    rankmsg += f"\n{member.mention} has saved **{savedrank[0]} quotes**, making them **rank {savedrank[1]}** in saved quotes." if savedrank else ""
 
-        lb_mostsaved = cur.fetchall()
-    except Exception as err:
-        logger.error(err)
-        await interaction.edit_original_response(content=err)
-        return
-
-    try:
-        quoterank = lb_mostquoted[findIndex(lb_mostquoted, 1, member.id)] if findIndex(lb_mostquoted, 1, member.id) else None
-    except: quoterank = None
-    try:
-        karmarank = lb_bestkarma[findIndex(lb_bestkarma, 1, member.id)] if findIndex(lb_bestkarma, 1, member.id) else None
-    except: karmarank = None
-    try:
-        karmascore = lb_mostkarma[findIndex(lb_mostkarma, 1, member.id)] if findIndex(lb_mostkarma, 1, member.id) else None
-    except: karmascore = None
-    try:
-        savedrank = lb_mostsaved[findIndex(lb_mostsaved, 1, member.id)] if findIndex(lb_mostsaved, 1, member.id) else None
-    except: savedrank = None
-
-    rankmsg = f"{member.mention} is **rank {findIndex(lb_mostquoted, 1, member.id) + 1}** with **{quoterank[0]}** quotes." if quoterank else ""
-    rankmsg += f"\n{member.mention} has an *average* karma score of **{karmarank[0]:.3f}**, making them **rank {findIndex(lb_bestkarma, 1, member.id) + 1}** in karma." if karmarank else ""
-    rankmsg += f"\n{member.mention} has a *total* karma score of **{karmascore[0]}**, making them **rank {findIndex(lb_mostkarma, 1, member.id) + 1}** in karma." if karmascore else ""
-    rankmsg += f"\n{member.mention} has saved **{savedrank[0]} quotes**, making them **rank {findIndex(lb_mostsaved, 1, member.id) + 1}** in saved quotes." if savedrank else ""
-
-    await interaction.response.send_message(content=rankmsg,ephemeral=True)
+    await interaction.response.send_message(content=rankmsg if rankmsg else f"{member.mention} isn't on any leaderboards yet.",ephemeral=True)
 
 @sanford.tree.context_menu(name='Save as quote!')
 async def quote_save(interaction: discord.Interaction, message: discord.Message):
 
     try:
-        con = psycopg2.connect(
-            database = cfg['postgresql']['database'],
-            host = cfg['postgresql']['host'],
-            port = cfg['postgresql']['port'],
-            user = cfg['postgresql']['user'],
-            password = cfg['postgresql']['password'],
-        )
-        cur = con.cursor()
-
         # Strip any mention from the beginning of the message
         strippedcontent = None
         if message.content.startswith('<@'):
             strippedcontent = re.sub(r'^\s*<@!?[0-9]+>\s*', '', message.content)
 
-        # Check for duplicates first
-        cur.execute("SELECT 1 from bot.quotes WHERE msgID='" + str(message.id) + "'")
-        if cur.fetchone() is not None:
-            raise LookupError('This quote is already in the database.')
-        con.close()
-
         sql_values = (
             strippedcontent if bool(strippedcontent) else message.content,
             message.author.id,
@@ -760,7 +727,8 @@ async def quote_save(interaction: discord.Interaction, message: discord.Message)
             message.jump_url
             )
 
-        qid,karma = insert_quote(sql_values)
+        # Raises LookupError if this message was already saved
+        qid,karma = await insert_quote(sql_values)
         if karma == None: karma = 1
 
         quote = format_quote(message.content, authorID=message.author.id, timestamp=int(message.created_at.timestamp()), format='discord_embed')
@@ -780,26 +748,15 @@ async def quote_save(interaction: discord.Interaction, message: discord.Message)
             ephemeral=message.author.id == interaction.user.id and bool(interaction.guild_id)
             )
 
-        #if interaction.guild_id == 124680630075260928 and message.author.id not in cfg['mastodon']['exclude_users']:
-        #    post_new_quote(message.content, (sql_values[1] if message.webhook_id else message.author.id), int(message.created_at.timestamp()))
+        #if interaction.guild_id == poster.guild and message.author.id not in user_prefs.excluded:
+        #    await poster.enqueue(qid)
 
         if cfg['sanford']['quoting']['voting'] == True and interaction.is_guild_integration():
             qmsg = await interaction.original_response()
-
-            newkarma = await karma_helper(interaction, qid, karma)
-            karmadiff = newkarma[1] - karma
-
-            try:
-                quote.set_footer(text=f"Score: {'+' if newkarma[1] > 0 else ''}{newkarma[1]} ({'went up by +{karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff > 0 else 'went down by {karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff < 0 else 'did not change'} this time).")
-                update_karma(qid,newkarma[1])
-                await qmsg.edit(embed=quote)
-                await qmsg.clear_reactions()
-            except Exception as error:
-                quote.set_footer(text=f"Score: {'+' if karma > 0 else ''}{karma} (no change due to error: {error}")
-                await qmsg.edit(embed=quote)
+            await votes.open(qmsg, qid, karma, quote)
 
 
-    except psycopg2.DatabaseError as error:
+    except psycopg.DatabaseError as error:
         await interaction.response.send_message(f'Error: SQL Failed due to:\n```{str(error)}```',ephemeral=True)
         logger.error("QUOTE SQL ERROR:")
         logger.error(error, exc_info=1)
@@ -813,11 +770,88 @@ async def quote_save(interaction: discord.Interaction, message: discord.Message)
 async def web_root():
     return {"message": "Hello! Welcome to the Sanford API! Nothing's *really* here yet!"}
 
+@webapp.get("/metrics")
+async def web_metrics():
+    """Command, query and Discord API timings, event loop lag, and every /status number, for Prometheus to scrape."""
+    return Response(metrics.render(), media_type=metrics.content_type)
+
+@webapp.get("/status/database")
+async def web_database_status():
+    """Connection pool statistics: connections checked out, requests waiting, and how long acquiring one takes."""
+    return database.pool_stats()
+
+@webapp.get("/status/api")
+async def web_api_status():
+    """Quote API requests running and queued, and how long they waited for a slot."""
+    return {
+        "in_flight": api_stats['in_flight'],
+        "waiting": api_stats['waiting'],
+        "exporting": api_stats['exporting'],
+        "served": api_stats['served'],
+        "wait_avg_ms": api_stats['wait_total_ms'] / api_stats['served'] if api_stats['served'] else 0.0,
+        "wait_max_ms": api_stats['wait_max_ms'],
+    }
+
+@webapp.get("/status/queries")
+async def web_queries_status():
+    """Calls, errors and timings for every named database query."""
+    return queries.stats()
+
+@webapp.get("/status/votes")
+async def web_votes_status():
+    """How many quotes are open for voting right now."""
+    return votes.stats()
+
+@webapp.get("/status/karma")
+async def web_karma_status():
+    """Karma changes waiting to be written, and how long the batched writes take."""
+    return karma_queue.stats()
+
+@webapp.get("/status/stampfinder")
+async def web_stampfinder_status():
+    """Progress of every stampfinder job, running or not."""
+    return await stampjobs.status()
+
+@webapp.get("/status/users")
+async def web_users_status():
+    """Where user lookups were answered from: the gateway, our cache, or the Discord API."""
+    return users.stats()
+
+@webapp.get("/status/profiles")
+async def web_profiles_status():
+    """Quote author lookups answered from the profile cache (hits) versus the Discord API (misses)."""
+    return profiles.stats()
+
+@webapp.get("/status/search")
+async def web_search_status():
+    """How many searches fell back to substring matching, or ran out of time."""
+    return quote_search.stats()
+
+@webapp.get("/status/cache")
+async def web_cache_status():
+    """Guilds and quotes held in memory for random picks, roughly how much memory they take, and the hit rate."""
+    return quote_cache.stats()
+
+@webapp.get("/status/mastodon")
+async def web_mastodon_status():
+    """Posts waiting in the Mastodon outbox, and how sending them has gone."""
+    return await poster.status()
+
+@webapp.get("/status/prefs")
+async def web_prefs_status():
+    """How many users have Mastodon settings, and how often they've been reloaded or changed."""
+    return user_prefs.stats()
+
+@webapp.get("/status/random")
+async def web_random_status():
+    """How many quote ID scopes are cached for random picks, and how often they were already warm."""
+    return quote_ids.stats()
+
 @webapp.get("/quote/server/{server_id}", response_model=list[Quote], responses={404: {"model": Error}})
 async def web_server_quote(server_id: int, user_id: int = None, id: int = None):
     """Return a random quote from a server, optionally filtered by a user ID."""
     try:
-        quote = get_quote(server_id, user_id)
+        quote = await get_quote(server_id, user_id)
         return [Quote(
             id=quote[0],
             content=quote[1],
@@ -838,20 +872,19 @@ async def web_user_quotes(user_id: int, server_id: int = None, id: int = None, l
     """Return a random quote from a user, optionally filtered by a server ID. You can return more than one quote by
     passing a `limit`."""
 
-    if bool(id):
-        limit = None
     try:
-        quote = get_quote(server_id, user_id, sort_order="id asc" if bool(id) else "random()", limit=limit)
         if bool(id):
-            return [sorted([Quote(
-                id=q[0],
-                content=q[1],
-                author_id=q[2],
-                author_name=q[3],
-                timestamp=q[4],
-                karma_score=q[5],
-                source=q[6]
-            ) for q in quote], key=lambda x: x.id)[id]]
+            quote = await get_nth_quote(server_id, user_id, id)
+            return [Quote(
+                id=quote[0],
+                content=quote[1],
+                author_id=quote[2],
+                author_name=quote[3],
+                timestamp=quote[4],
+                karma_score=quote[5],
+                source=quote[6]
+            )]
+        quote = await get_quote(server_id, user_id, limit=limit)
         if limit == 1:
             return [Quote(
                 id=quote[0],
@@ -878,10 +911,150 @@ async def web_user_quotes(user_id: int, server_id: int = None, id: int = None, l
         else:
             return JSONResponse(status_code=404, content={"error": str(err)})
 
+async def quote_listing(server_id: int = None, user_id: int = None, after: int = 0, limit: int = 100, format: str = "json"):
+    if format == "ndjson":
+        if export_limit.locked():
+            return JSONResponse(status_code=429, content={"error": "Too many exports running, try again later."})
+        # Nothing is awaited between the check and here, so this takes the slot straight away
+        # and no other request can have slipped in and taken it first
+        await export_limit.acquire()
+
+        # The whole lot, one quote per line, streamed straight out of a database cursor
+        async def lines():
+            api_stats['exporting'] += 1
+            try:
+                yield ""
+                async for q in stream_quotes(server_id, user_id, after):
+                    yield Quote(
+                        id=q[0],
+                        content=q[1],
+                        author_id=q[2],
+                        author_name=q[3],
+                        timestamp=q[4],
+                        karma_score=q[5],
+                        source=q[6]
+                    ).model_dump_json() + "\n"
+            finally:
+                api_stats['exporting'] -= 1
+                export_limit.release()
+
+        stream = lines()
+        # Step it into the try, so the slot is given back however the response ends,
+        # even if the client is gone before streaming starts
+        await anext(stream)
+        return StreamingResponse(stream, media_type="application/x-ndjson")
+
+    limit = max(1, min(limit, 500))
+    quotes = [Quote(
+        id=q[0],
+        content=q[1],
+        author_id=q[2],
+        author_name=q[3],
+        timestamp=q[4],
+        karma_score=q[5],
+        source=q[6]
+    ) for q in await list_quotes(server_id, user_id, after, limit)]
+    return QuotePage(quotes=quotes, next=quotes[-1].id if len(quotes) == limit else None)
+
+@webapp.post("/quote/server/{server_id}/import", responses={400: {"model": Error}, 403: {"model": Error}, 500: {"model": Error}})
+async def web_import_quotes(server_id: int, request: Request, format: typing.Literal["csv", "json", "ndjson"] = "json", authorization: str = Header(None)):
+    """Bulk import quotes into a server. The request body is a CSV, JSON or NDJSON file of quotes using the
+    same fields as `Quote` (minus `id`, plus optional `msgid` and `added_by`). Quotes already saved with the same
+    message ID, or the same author and content, are skipped. Needs `Authorization: Bearer <api_token>`."""
+    token = cfg['sanford'].get('api_token')
+    if not token or authorization != f"Bearer {token}":
+        return JSONResponse(status_code=403, content={"error": "A valid API token is needed to import quotes."})
+    try:
+        return await importer.run_import(await request.body(), format, server_id)
+    except ValueError as err:
+        return JSONResponse(status_code=400, content={"error": str(err)})
+    except psycopg.DatabaseError as err:
+        logger.error(f"Import into {server_id} failed: {err}")
+        return JSONResponse(status_code=500, content={"error": f"Import failed: {err}"})
+
+@webapp.get("/quote/search", response_model=SearchResults, responses={404: {"model": Error}})
+async def web_quote_search(q: str, server_id: int = None, user_id: int = None, limit: int = 20, offset: int = 0, mode: typing.Literal["fulltext", "substring"] = None):
+    """Search quotes by content, optionally filtered by server and/or user. Results are ranked best match first,
+    `limit` (max 100) at a time; pass `next` back as `offset`, along with `mode`, for the following page."""
+    limit = max(1, min(limit, 100))
+    try:
+        mode, results = await quote_search.search(q, server_id, user_id, limit=limit + 1, offset=offset, mode=mode)
+    except LookupError as err:
+        return JSONResponse(status_code=404, content={"error": str(err)})
+    return SearchResults(
+        quotes=[Quote(
+            id=r[0],
+            content=r[1],
+            author_id=r[2],
+            author_name=r[3],
+            timestamp=r[4],
+            karma_score=r[5],
+            source=r[6]
+        ) for r in results[:limit]],
+        mode=mode,
+        next=offset + limit if len(results) > limit else None
+    )
+
+@webapp.get("/quote/server/{server_id}/list", response_model=QuotePage, responses={429: {"model": Error}})
+async def web_server_quote_list(server_id: int, user_id: int = None, after: int = 0, limit: int = 100, format: typing.Literal["json", "ndjson"] = "json"):
+    """List a server's quotes in the order they were saved, optionally filtered by a user ID. Pages hold up to
+    `limit` (max 500) quotes; pass the `next` value back as `after` to get the following page. With
+    `format=ndjson` every quote after `after` is streamed back instead, one JSON object per line; only so many
+    exports run at once, and a 429 means try again later."""
+    return await quote_listing(server_id, user_id, after, limit, format)
+
+@webapp.get("/quote/user/{user_id}/list", response_model=QuotePage, responses={429: {"model": Error}})
+async def web_user_quote_list(user_id: int, server_id: int = None, after: int = 0, limit: int = 100, format: typing.Literal["json", "ndjson"] = "json"):
+    """List a user's quotes in the order they were saved, optionally filtered by a server ID. Paged and streamed
+    the same way as `/quote/server/{server_id}/list`."""
+    return await quote_listing(server_id, user_id, after, limit, format)
+
+
+@sanford.event
+async def on_message(message: discord.Message):
+    profiles.seen(message.author)
+    await sanford.process_commands(message)
+
+@sanford.event
+async def on_interaction(interaction: discord.Interaction):
+    profiles.seen(interaction.user)
+
+@sanford.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    metrics.command_finished(interaction)
+
+# These four only fire with the members intent, which we don't ask for (see intents above);
+# without it, profile entries are kept fresh by expiring instead (AuthorProfiles' ttl)
+@sanford.event
+async def on_member_join(member: discord.Member):
+    profiles.seen(member)
+
+@sanford.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    profiles.seen(after)
+
+@sanford.event
+async def on_member_remove(member: discord.Member):
+    profiles.left(member.guild.id, member.id)
+
+@sanford.event
+async def on_user_update(before: discord.User, after: discord.User):
+    profiles.user_updated(after)
+
+@sanford.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    await votes.reaction(payload, 1)
+
+@sanford.event
+async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    await votes.reaction(payload, -1)
 
 @sanford.event
 async def on_ready():
     logger.info(f"Logged in. I am {sanford.user} (ID: {sanford.user.id})")
+    # Pick up any votes that were still open when we last went down
+    await votes.start()
+    await stampjobs.resume_all()
     logger.info("Syncing commands to Discord.")
     await sanford.tree.sync()
     await sanford.tree.sync(guild=TGC)
@@ -0,0 +1,11 @@
+# Shared by the benchmark scripts at the top of the repo (loadtest.py, randombench.py, leaderbench.py)
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def report(label, latencies, what="calls"):
+    """One line of p50/p99/max for a list of latencies in milliseconds."""
+    print(f"{label:<34} p50 {percentile(latencies, 50):8.3f}ms  p99 {percentile(latencies, 99):8.3f}ms  "
+          f"max {max(latencies):8.3f}ms  ({len(latencies)} {what})")
@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import yaml
+import logging
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+with open('config.yaml', 'r') as file:
+    cfg = yaml.safe_load(file)
+
+# setup logging
+logger = logging.getLogger('helpers')
+
+# The one pool everything shares. Opened in the FastAPI lifespan (or lazily by
+# whoever asks for a connection first, e.g. the standalone mastoposter)
+pool: AsyncConnectionPool | None = None
+
+# How long callers wait to get a connection out of the pool
+acquire_stats = {
+    "count": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+    "last_ms": 0.0,
+}
+
+def pool_config():
+    poolcfg = cfg['postgresql'].get('pool') or {}
+    return {
+        "min_size": int(poolcfg.get('min_size', 2)),
+        "max_size": int(poolcfg.get('max_size', 10)),
+        "timeout": float(poolcfg.get('timeout', 30)),
+    }
+
+def connection_kwargs():
+    return {
+        "dbname": cfg['postgresql']['database'],
+        "host": cfg['postgresql'].get('host'),
+        "port": cfg['postgresql'].get('port'),
+        "user": cfg['postgresql']['user'],
+        "password": cfg['postgresql']['password'],
+    }
+
+async def open_pool():
+    global pool
+    if pool is not None:
+        return pool
+
+    poolcfg = pool_config()
+    pool = AsyncConnectionPool(
+        kwargs=connection_kwargs(),
+        min_size=poolcfg['min_size'],
+        max_size=poolcfg['max_size'],
+        timeout=poolcfg['timeout'],
+        name="sanford",
+        open=False,
+    )
+    await pool.open(wait=True)
+    logger.info(f"Database: pool opened ({poolcfg['min_size']}-{poolcfg['max_size']} connections)")
+    return pool
+
+async def close_pool():
+    global pool
+    if pool is None:
+        return
+    await pool.close()
+    pool = None
+    logger.info("Database: pool closed")
+
+@asynccontextmanager
+async def connection():
+    """Borrow a connection from the shared pool.
+
+    The transaction is committed when the block exits cleanly and rolled back if it raises."""
+    if pool is None:
+        await open_pool()
+
+    start = time.perf_counter()
+    async with pool.connection() as con:
+        waited = (time.perf_counter() - start) * 1000
+        acquire_stats['count'] += 1
+        acquire_stats['total_ms'] += waited
+        acquire_stats['last_ms'] = waited
+        acquire_stats['max_ms'] = max(acquire_stats['max_ms'], waited)
+        yield con
+
+# Schema changes live in helpers/sql as plain .sql files, applied in name order on
+# every startup, so each one has to be safe to run again (IF NOT EXISTS and friends)
+SQL_DIR = os.path.join(os.path.dirname(__file__), 'sql')
+
+async def migrate():
+    if not os.path.isdir(SQL_DIR):
+        return
+    for name in sorted(os.listdir(SQL_DIR)):
+        if not name.endswith('.sql'):
+            continue
+        with open(os.path.join(SQL_DIR, name), 'r') as file:
+            script = file.read()
+        async with connection() as con:
+            # The bot and mastoposter.py can start at the same time; the lock makes one wait
+            # for the other's script to commit, instead of both creating the same things at once
+            await con.execute("SELECT pg_advisory_xact_lock(hashtext('sanford.migrate'))")
+            await con.execute(script)
+        logger.debug(f"Database: applied {name}")
+
+async def listen(channel: str, callback, reconnected=None, retry: float = 60):
+    """Call callback(payload) for every NOTIFY on `channel`, until cancelled.
+
+    Listens on a connection of its own rather than one from the pool, since it's held
+    for good. reconnected() is awaited every time we (re)connect, for catching up on
+    anything sent while nobody was listening."""
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(**connection_kwargs(), autocommit=True) as con:
+                await con.execute(f"LISTEN {channel}")
+                if reconnected is not None:
+                    await reconnected()
+                async for notify in con.notifies():
+                    callback(notify.payload)
+        except psycopg.OperationalError as error:
+            logger.warning(f"Database: lost the listener on {channel} ({error}), reconnecting in {retry}s")
+            await asyncio.sleep(retry)
+
+def pool_stats():
+    if pool is None:
+        return {"open": False}
+
+    stats = pool.get_stats()
+    return {
+        "open": True,
+        "min_size": stats.get('pool_min', 0),
+        "max_size": stats.get('pool_max', 0),
+        "size": stats.get('pool_size', 0),
+        "available": stats.get('pool_available', 0),
+        "checked_out": stats.get('pool_size', 0) - stats.get('pool_available', 0),
+        "waiting": stats.get('requests_waiting', 0),
+        "acquire_count": acquire_stats['count'],
+        "acquire_avg_ms": acquire_stats['total_ms'] / acquire_stats['count'] if acquire_stats['count'] else 0.0,
+        "acquire_max_ms": acquire_stats['max_ms'],
+        "acquire_last_ms": acquire_stats['last_ms'],
+        "connection_errors": stats.get('connections_errors', 0),
+    }
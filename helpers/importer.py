@@ -0,0 +1,142 @@
+import io
+import csv
+import json
+import time
+import logging
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+from helpers import database
+from helpers.quoting import quote_ids, quote_cache, leaderboards
+
+logger = logging.getLogger('helpers')
+
+formats = ("csv", "json", "ndjson")
+
+class ImportedQuote(BaseModel):
+    """One row of an import file. Uses the same field names as the API's Quote model
+    (without the id, which the database hands out), plus where the quote came from."""
+    content: str
+    author_id: int
+    author_name: str | None = None
+    timestamp: int | None = None
+    karma_score: int = 1
+    source: str | None = None
+    msgid: int | None = None
+    added_by: int | None = None
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def blank_is_none(cls, value):
+        # CSV has no way to leave a column out, only to leave it empty
+        if isinstance(value, str) and value.strip() == "":
+            return None
+        return value
+
+    @field_validator('content')
+    @classmethod
+    def has_content(cls, value):
+        if value is None or not value.strip():
+            raise ValueError("quote has no content")
+        return value
+
+    @field_validator('karma_score', mode='before')
+    @classmethod
+    def default_karma(cls, value):
+        return 1 if value is None else value
+
+class UnreadableFile(Exception):
+    """The file parsed, but isn't shaped like a list of quotes."""
+
+def guess_format(filename: str):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return {"jsonl": "ndjson"}.get(extension, extension)
+
+def read_rows(data: str, format: str):
+    """Yields (line number, dict) for every record in the file."""
+    match format:
+        case "csv":
+            # Numbered by line, counting the header
+            for number, row in enumerate(csv.DictReader(io.StringIO(data)), start=2):
+                yield number, row
+        case "json":
+            records = json.loads(data)
+            if isinstance(records, dict):
+                records = records.get('quotes')
+            if not isinstance(records, list):
+                raise UnreadableFile("expected a list of quotes, or an object with a 'quotes' list")
+            for number, record in enumerate(records, start=1):
+                yield number, record
+        case "ndjson":
+            for number, line in enumerate(data.splitlines(), start=1):
+                if line.strip():
+                    yield number, json.loads(line)
+        case _:
+            raise ValueError(f"Don't know how to import '{format}' files (try one of {', '.join(formats)})")
+
+def parse(data: str | bytes, format: str):
+    """Validate every record; returns (quotes, [(record number, error)])."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+
+    quotes, errors = [], []
+    try:
+        for number, record in read_rows(data, format):
+            try:
+                quotes.append(ImportedQuote.model_validate(record))
+            except ValidationError as error:
+                errors.append((number, "; ".join(f"{'.'.join(str(l) for l in e['loc'])}: {e['msg']}" for e in error.errors())))
+    except (json.JSONDecodeError, csv.Error, UnreadableFile) as error:
+        errors.append((len(quotes) + len(errors) + 1, f"couldn't read the file: {error}"))
+    return quotes, errors
+
+async def import_quotes(quotes: list[ImportedQuote], gid: int, added_by: int = None):
+    """Load validated quotes into a guild in one go: COPY into a staging table, then one
+    INSERT ... SELECT that skips anything already saved (same message ID, or the same
+    author and content) and any repeats within the file itself. Returns how many went in."""
+    async with database.connection() as con:
+        await con.execute('''CREATE TEMP TABLE quote_import (
+                content text, authorid bigint, authorname text, addedby bigint,
+                msgid bigint, timestamp bigint, source text, karma integer
+            ) ON COMMIT DROP''')
+        async with con.cursor() as cur:
+            async with cur.copy("COPY quote_import (content, authorid, authorname, addedby, msgid, timestamp, source, karma) FROM STDIN") as copy:
+                for q in quotes:
+                    await copy.write_row((q.content, q.author_id, q.author_name, q.added_by or added_by, q.msgid, q.timestamp, q.source, q.karma_score))
+        # Temp tables never get auto-analyzed, and without row counts the planner picks a poor duplicate check
+        await con.execute("ANALYZE quote_import")
+
+        cur = await con.execute('''INSERT INTO bot.quotes (content, authorid, authorname, addedby, guild, msgid, timestamp, source, karma)
+            SELECT content, authorid, authorname, addedby, %(guild)s, msgid, timestamp, source, karma FROM (
+                SELECT DISTINCT ON (authorid, content) * FROM quote_import
+                ORDER BY authorid, content, timestamp NULLS LAST
+            ) i
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bot.quotes q WHERE q.guild = %(guild)s AND q.authorid = i.authorid AND q.content = i.content
+            )
+            ON CONFLICT (msgid) WHERE msgid IS NOT NULL DO NOTHING''', {"guild": gid})
+        imported = cur.rowcount
+
+    if imported:
+        quote_ids.forget(gid)
+        quote_cache.forget(gid)
+        leaderboards.invalidate(gid)
+    return imported
+
+async def run_import(data: str | bytes, format: str, gid: int, added_by: int = None):
+    """Parse, validate and load an import file, and say how it went."""
+    start = time.perf_counter()
+    quotes, errors = parse(data, format)
+    imported = await import_quotes(quotes, gid, added_by) if quotes else 0
+    elapsed = time.perf_counter() - start
+
+    logger.info(f"Import: {imported}/{len(quotes)} quotes into guild {gid} in {elapsed:.2f}s ({len(errors)} invalid)")
+    return {
+        "rows": len(quotes) + len(errors),
+        "invalid": len(errors),
+        "imported": imported,
+        "duplicates": len(quotes) - imported,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round((len(quotes) + len(errors)) / elapsed, 1) if elapsed else 0.0,
+        "errors": [{"row": number, "error": error} for number, error in errors[:20]],
+    }
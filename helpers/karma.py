@@ -0,0 +1,112 @@
+import time
+import asyncio
+import logging
+
+from helpers import queries
+
+logger = logging.getLogger('helpers')
+
+flush_query = queries.query("karma_flush", "UPDATE bot.quotes AS q SET karma = q.karma + v.delta FROM unnest(%(ids)s::bigint[], %(deltas)s::integer[]) AS v(id, delta) WHERE q.id = v.id RETURNING q.id, q.karma, q.guild")
+
+class KarmaQueue:
+    """Write-behind queue for karma changes.
+
+    Votes hand over a delta per quote rather than a new total, deltas for the same quote
+    are added together while they wait, and everything waiting is written in one UPDATE
+    every `interval` seconds (or sooner once `max_pending` quotes are queued). Since the
+    database adds the delta itself, two vote windows on the same quote can't clobber
+    each other's result."""
+
+    def __init__(self, interval: float = 5.0, max_pending: int = 100):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: dict[int, int] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+        # Called with the (id, karma, guild) rows each flush updated
+        self.listeners = []
+
+        self.flushes = 0
+        self.flushed_quotes = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def add(self, qid: int, delta: int):
+        if delta == 0:
+            return
+        self.pending[qid] = self.pending.get(qid, 0) + delta
+        if len(self.pending) >= self.max_pending:
+            self.wakeup.set()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return []
+
+            batch, self.pending = self.pending, {}
+
+            start = time.perf_counter()
+            try:
+                # Two arrays rather than a VALUES list, so it's the same statement whatever the batch size
+                updated = await flush_query.fetchall({"ids": list(batch.keys()), "deltas": list(batch.values())})
+            except BaseException:
+                # Put the deltas back so the next flush can have another go
+                # (this includes being cancelled mid-flush at shutdown)
+                self.failures += 1
+                for qid, delta in batch.items():
+                    self.pending[qid] = self.pending.get(qid, 0) + delta
+                raise
+
+            elapsed = (time.perf_counter() - start) * 1000
+            self.flushes += 1
+            self.flushed_quotes += len(batch)
+            self.last_flush_ms = elapsed
+            self.total_flush_ms += elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            logger.debug(f"Karma: flushed {len(batch)} quotes in {elapsed:.2f}ms")
+            for listener in self.listeners:
+                listener(updated)
+            return updated
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as error:
+                logger.error("Karma: flush failed, will retry")
+                logger.exception(error)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the timer and write out whatever is still waiting."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.pending),
+            "pending_delta": sum(abs(d) for d in self.pending.values()),
+            "flushes": self.flushes,
+            "flushed_quotes": self.flushed_quotes,
+            "failures": self.failures,
+            "flush_last_ms": self.last_flush_ms,
+            "flush_avg_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0,
+            "flush_max_ms": self.max_flush_ms,
+        }
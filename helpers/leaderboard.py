@@ -0,0 +1,152 @@
+import time
+import logging
+
+from helpers import database, queries
+
+logger = logging.getLogger('helpers')
+
+categories = ("quotes", "avg_karma", "total_karma", "saves")
+
+# Every user's value and rank in each category, from the (small) per-user totals table
+ranking_query = queries.query("leaderboard", '''SELECT userid, quotes, avg_karma, total_karma, saves,
+        rank() OVER (ORDER BY quotes DESC) AS quotes_rank,
+        rank() OVER (ORDER BY avg_karma DESC NULLS LAST) AS avg_rank,
+        rank() OVER (ORDER BY total_karma DESC NULLS LAST) AS total_rank,
+        rank() OVER (ORDER BY saves DESC) AS saves_rank
+    FROM (
+        SELECT userid, quotes, saves,
+            CASE WHEN quotes > 0 THEN karma::float8 / quotes END AS avg_karma,
+            CASE WHEN quotes > 0 THEN karma - quotes END AS total_karma
+        FROM bot.leaderboard WHERE guild = %s AND (quotes > 0 OR saves > 0)
+    ) totals''')
+
+# The same thing for a single user, without sorting everyone: their rank in each
+# category is one more than the number of users strictly ahead of them
+user_ranking_query = queries.query("leaderboard_user", '''WITH totals AS (
+        SELECT userid, quotes, saves,
+            CASE WHEN quotes > 0 THEN karma::float8 / quotes END AS avg_karma,
+            CASE WHEN quotes > 0 THEN karma - quotes END AS total_karma
+        FROM bot.leaderboard WHERE guild = %(guild)s AND (quotes > 0 OR saves > 0)
+    ), me AS (
+        SELECT * FROM totals WHERE userid = %(user)s
+    )
+    SELECT me.userid, me.quotes, me.avg_karma, me.total_karma, me.saves,
+        1 + count(*) FILTER (WHERE totals.quotes > me.quotes),
+        1 + count(*) FILTER (WHERE totals.avg_karma > me.avg_karma),
+        1 + count(*) FILTER (WHERE totals.total_karma > me.total_karma),
+        1 + count(*) FILTER (WHERE totals.saves > me.saves)
+    FROM me CROSS JOIN totals
+    GROUP BY me.userid, me.quotes, me.avg_karma, me.total_karma, me.saves''')
+
+tracked_query = queries.query("leaderboard_tracked", "SELECT 1 FROM bot.leaderboard_guilds WHERE guild = %s")
+# One rebuild of a guild at a time, across every process
+refresh_lock = queries.query("leaderboard_refresh_lock", "SELECT pg_advisory_xact_lock(hashtext('leaderboard_refresh'), %(gid)s::integer)")
+
+def user_ranks(row):
+    """{category: (value, rank)} for one row of ranking_query, None where they don't place."""
+    userid, quotes, avg_karma, total_karma, saves, quotes_rank, avg_rank, total_rank, saves_rank = row
+    return {
+        "quotes": (quotes, quotes_rank) if quotes > 0 else None,
+        "avg_karma": (avg_karma, avg_rank) if quotes > 0 else None,
+        "total_karma": (total_karma, total_rank) if quotes > 0 else None,
+        "saves": (saves, saves_rank) if saves > 0 else None,
+    }
+
+class Board:
+    """One guild's leaderboards: for each category, (value, userid, rank) from best to worst."""
+
+    def __init__(self, rows):
+        self.loaded_at = time.monotonic()
+        self.rankings: dict[str, list[tuple]] = {name: [] for name in categories}
+        # userid -> {category: (value, rank)}, for looking one member up without searching the lists
+        self.users: dict[int, dict] = {}
+
+        for row in rows:
+            userid, quotes, avg_karma, total_karma, saves, quotes_rank, avg_rank, total_rank, saves_rank = row
+            self.users[userid] = user_ranks(row)
+            if quotes > 0:
+                self.rankings['quotes'].append((quotes, userid, quotes_rank))
+                self.rankings['avg_karma'].append((avg_karma, userid, avg_rank))
+                self.rankings['total_karma'].append((total_karma, userid, total_rank))
+            if saves > 0:
+                self.rankings['saves'].append((saves, userid, saves_rank))
+
+        for ranking in self.rankings.values():
+            ranking.sort(key=lambda r: r[2])
+
+    def top(self, category: str, limit: int):
+        return self.rankings[category][:limit]
+
+    def ranks(self, userid: int):
+        return self.users.get(userid) or dict.fromkeys(categories)
+
+class Leaderboards:
+    """Leaderboards read from bot.leaderboard, which triggers keep current as quotes are
+    added, saved and voted on. Building a guild's board the first time takes one
+    aggregate pass over its quotes; after that it's a read of one row per user,
+    and the result is kept in memory until something in the guild changes."""
+
+    def __init__(self, ttl: int = 300):
+        self.ttl = ttl
+        self.boards: dict[int, Board] = {}
+
+    async def refresh(self, gid: int, if_untracked: bool = False):
+        """Rebuild a guild's totals from scratch, and start tracking it.
+
+        With if_untracked, only if nothing else has started tracking it by the time we get the lock."""
+        async with database.connection() as con:
+            await refresh_lock.execute(con, {"gid": gid % 2**31})
+            if if_untracked and await tracked_query.fetchone((gid,), con=con) is not None:
+                return
+            # Hold off new quotes and votes until we commit: one written during the rebuild would
+            # miss the scan, and the triggers too, since they can't see the guild is tracked yet
+            await con.execute("LOCK TABLE bot.quotes IN SHARE ROW EXCLUSIVE MODE")
+            await con.execute("DELETE FROM bot.leaderboard WHERE guild = %s", (gid,))
+            # GROUPING SETS gets us per-author and per-saver totals from a single scan
+            await con.execute('''WITH agg AS (
+                    SELECT authorid, addedby, GROUPING(authorid) AS by_saver, count(*) AS n, coalesce(sum(karma), 0) AS karma
+                    FROM bot.quotes WHERE guild = %(guild)s
+                    GROUP BY GROUPING SETS ((authorid), (addedby))
+                )
+                INSERT INTO bot.leaderboard (guild, userid, quotes, karma, saves)
+                SELECT %(guild)s, userid, sum(quotes), sum(karma), sum(saves) FROM (
+                    SELECT authorid AS userid, n AS quotes, karma, 0 AS saves FROM agg WHERE by_saver = 0 AND authorid IS NOT NULL
+                    UNION ALL
+                    SELECT addedby, 0, 0, n FROM agg WHERE by_saver = 1 AND addedby IS NOT NULL
+                ) totals GROUP BY userid''', {"guild": gid})
+            await con.execute("INSERT INTO bot.leaderboard_guilds (guild) VALUES (%s) ON CONFLICT (guild) DO UPDATE SET refreshed_at = now()", (gid,))
+        logger.info(f"Leaderboard: rebuilt totals for guild {gid}")
+        self.invalidate(gid)
+
+    async def track(self, gid: int):
+        """Make sure the triggers are keeping totals for this guild, building them if not."""
+        if await tracked_query.fetchone((gid,)) is None:
+            # Two members asking at once both end up here; the second waits and skips it
+            await self.refresh(gid, if_untracked=True)
+
+    async def load(self, gid: int):
+        await self.track(gid)
+
+        return Board(await ranking_query.fetchall((gid,)))
+
+    async def get(self, gid: int):
+        board = self.boards.get(gid)
+        if board is None or time.monotonic() - board.loaded_at > self.ttl:
+            board = await self.load(gid)
+            self.boards[gid] = board
+        return board
+
+    async def ranks(self, gid: int, userid: int):
+        """One member's value and rank in every category: {category: (value, rank) or None}.
+
+        Straight from memory if the guild's board is loaded, otherwise a single query."""
+        board = self.boards.get(gid)
+        if board is not None and time.monotonic() - board.loaded_at <= self.ttl:
+            return board.ranks(userid)
+
+        await self.track(gid)
+        row = await user_ranking_query.fetchone({"guild": gid, "user": userid})
+        return user_ranks(row) if row is not None else dict.fromkeys(categories)
+
+    def invalidate(self, gid: int):
+        self.boards.pop(gid, None)
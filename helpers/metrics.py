@@ -0,0 +1,136 @@
+import re
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+
+import discord
+from discord import app_commands
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger('helpers')
+
+# Served at /metrics, in Prometheus' text format
+content_type = CONTENT_TYPE_LATEST
+
+command_seconds = Histogram('sanford_command_seconds', "Time from a slash command or context menu arriving to it finishing", ['command'],
+                            buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+command_errors = Counter('sanford_command_errors_total', "Slash commands and context menus that raised", ['command'])
+
+query_seconds = Histogram('sanford_db_query_seconds', "Time taken by each named database query (see helpers/queries.py)", ['query'],
+                          buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+query_errors = Counter('sanford_db_query_errors_total', "Named database queries that raised", ['query'])
+
+rest_seconds = Histogram('sanford_discord_rest_seconds', "Time taken by Discord REST calls", ['call'],
+                         buckets=(.025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+rest_errors = Counter('sanford_discord_rest_errors_total', "Discord REST calls that failed, by what went wrong", ['call', 'error'])
+
+loop_lag_seconds = Histogram('sanford_event_loop_lag_seconds', "How much later than asked the event loop woke a sleeping task",
+                             buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+@contextmanager
+def rest_call(name: str):
+    """Time a Discord REST call, and count it if it fails (including 404s, which callers often expect)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except discord.HTTPException as error:
+        rest_errors.labels(name, str(error.status)).inc()
+        raise
+    except Exception as error:
+        rest_errors.labels(name, type(error).__name__).inc()
+        raise
+    finally:
+        rest_seconds.labels(name).observe(time.perf_counter() - start)
+
+def command_name(interaction: discord.Interaction):
+    return interaction.command.qualified_name if interaction.command is not None else "unknown"
+
+def command_finished(interaction: discord.Interaction, failed: bool = False):
+    start = interaction.extras.get('started')
+    if start is not None:
+        command_seconds.labels(command_name(interaction)).observe(time.perf_counter() - start)
+    if failed:
+        command_errors.labels(command_name(interaction)).inc()
+
+class TimedCommandTree(app_commands.CommandTree):
+    """A CommandTree that times every app command, slash commands and context menus alike
+    (the tree runs interaction_check before either). Finished commands are recorded by
+    the bot's on_app_command_completion event; failed ones here."""
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        command_finished(interaction, failed=True)
+        await super().on_error(interaction, error)
+
+class StatsCollector:
+    """Exports the dicts behind the /status endpoints as gauges, read fresh on every scrape.
+
+    `sanford_<source>_<key>` for every number (and bool) the source's stats() returns;
+    anything else is left out."""
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, name: str, stats):
+        self.sources[name] = stats
+
+    def collect(self):
+        for name, stats in self.sources.items():
+            try:
+                values = stats()
+            except Exception as error:
+                logger.warning(f"Metrics: couldn't read {name} stats: {error}")
+                continue
+            for key, value in values.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                metric = re.sub(r'[^a-zA-Z0-9_]', '_', f"sanford_{name}_{key}")
+                yield GaugeMetricFamily(metric, f"{key} from /status/{name}", value=float(value))
+
+stats = StatsCollector()
+REGISTRY.register(stats)
+
+class LoopLagMonitor:
+    """Sleeps for `interval` seconds over and over, and records how late it woke up.
+    Anything holding up the event loop (a blocking call, a long CPU-bound stretch) shows up here."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+        self.last = 0.0
+        self.max = 0.0
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, time.perf_counter() - start - self.interval)
+            self.max = max(self.max, self.last)
+            loop_lag_seconds.observe(self.last)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        return {
+            "last_seconds": self.last,
+            "max_seconds": self.max,
+        }
+
+def render():
+    return generate_latest(REGISTRY)
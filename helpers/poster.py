@@ -0,0 +1,319 @@
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import aiohttp
+
+from helpers import database, queries
+from helpers.quoting import format_quote, strip_discord_format, rename_user
+
+logger = logging.getLogger('helpers')
+
+### ROTATION
+# Every quote in the guild comes up once, in a shuffled order, before any comes up again.
+# The bag lives in bot.mastodon_rotation (see 010_mastodon_rotation.sql) so restarts carry on where we were
+
+rotation_lock = queries.query("mastodon_rotation_lock", "SELECT ids, position, excluded FROM bot.mastodon_rotation WHERE guild = %(gid)s FOR UPDATE")
+rotation_ids = queries.query("mastodon_rotation_ids", "SELECT id FROM bot.quotes WHERE guild = %(gid)s AND authorid <> ALL(%(exclude)s::bigint[])")
+rotation_readmitted = queries.query("mastodon_rotation_readmitted", "SELECT id FROM bot.quotes WHERE guild = %(gid)s AND authorid = ANY(%(authors)s::bigint[])")
+rotation_check = queries.query("mastodon_rotation_check", "SELECT id FROM bot.quotes WHERE id = %(qid)s AND authorid <> ALL(%(exclude)s::bigint[])")
+rotation_save = queries.query("mastodon_rotation_save", '''INSERT INTO bot.mastodon_rotation (guild, ids, position, excluded) VALUES (%(gid)s, %(ids)s, %(position)s, %(exclude)s)
+    ON CONFLICT (guild) DO UPDATE SET ids = EXCLUDED.ids, position = EXCLUDED.position, excluded = EXCLUDED.excluded,
+        shuffled_at = CASE WHEN %(reshuffled)s THEN now() ELSE bot.mastodon_rotation.shuffled_at END''')
+
+async def shuffled(query, params, con):
+    ids = [row[0] for row in await query.fetchall(params, con=con)]
+    random.shuffle(ids)
+    return ids
+
+async def next_in_rotation(con, gid: int, exclude):
+    """The ID of the next quote in the guild's rotation, or None if there's nothing to post.
+
+    Users added to `exclude` are skipped straight away, and users taken off it have
+    their quotes shuffled into what's left of the current bag. Run it in a transaction:
+    the bag is locked until it's committed."""
+    exclude = sorted(set(int(u) for u in exclude))
+    row = await rotation_lock.fetchone({"gid": gid}, con=con)
+    ids, position, excluded = row if row is not None else ([], 0, exclude)
+
+    if sorted(excluded) != exclude:
+        ids = ids[position:]
+        position = 0
+        readmitted = set(excluded) - set(exclude)
+        if readmitted:
+            # Quotes saved into the bag before their author opted out are still in it (they're
+            # only skipped when they come up), so don't add those a second time
+            present = set(ids)
+            for qid in await shuffled(rotation_readmitted, {"gid": gid, "authors": list(readmitted)}, con):
+                if qid not in present:
+                    ids.insert(random.randint(0, len(ids)), qid)
+
+    found = None
+    reshuffled = False
+    while found is None:
+        if position >= len(ids):
+            if reshuffled:
+                break # Nothing in this guild we're allowed to post
+            ids, position, reshuffled = await shuffled(rotation_ids, {"gid": gid, "exclude": exclude}, con), 0, True
+            continue
+        qid = ids[position]
+        position += 1
+        # Skips quotes that have been deleted, or whose author has asked not to be posted since
+        if await rotation_check.fetchone({"qid": qid, "exclude": exclude}, con=con) is not None:
+            found = qid
+
+    await rotation_save.run({"gid": gid, "ids": ids, "position": position, "exclude": exclude, "reshuffled": reshuffled}, con=con)
+    return found
+
+### OUTBOX
+
+enqueue_query = queries.query("mastodon_enqueue", "INSERT INTO bot.mastodon_outbox (kind, guild, quote_id) VALUES (%(kind)s, %(gid)s, %(qid)s) RETURNING id")
+schedule_lock = queries.query("mastodon_schedule_lock", "SELECT pg_advisory_xact_lock(hashtext('mastodon_schedule'), %(gid)s::integer)")
+last_scheduled_query = queries.query("mastodon_last_scheduled", "SELECT extract(epoch FROM now() - max(created_at))::float8 FROM bot.mastodon_outbox WHERE guild = %(gid)s AND kind = 'scheduled'")
+claim_query = queries.query("mastodon_claim", '''UPDATE bot.mastodon_outbox SET attempts = attempts + 1, next_attempt_at = now() + make_interval(secs => %(lease)s)
+    WHERE id = (
+        SELECT id FROM bot.mastodon_outbox WHERE posted_at IS NULL AND failed_at IS NULL AND next_attempt_at <= now()
+        ORDER BY next_attempt_at, id LIMIT 1 FOR UPDATE SKIP LOCKED
+    ) RETURNING id, kind, quote_id, attempts''')
+next_due_query = queries.query("mastodon_next_due", "SELECT extract(epoch FROM min(next_attempt_at) - now())::float8 FROM bot.mastodon_outbox WHERE posted_at IS NULL AND failed_at IS NULL")
+posted_query = queries.query("mastodon_posted", "UPDATE bot.mastodon_outbox SET posted_at = now(), status_id = %(status_id)s, last_error = NULL WHERE id = %(id)s")
+retry_query = queries.query("mastodon_retry", "UPDATE bot.mastodon_outbox SET next_attempt_at = now() + make_interval(secs => %(delay)s), attempts = attempts - %(refund)s, last_error = %(error)s WHERE id = %(id)s")
+failed_query = queries.query("mastodon_failed", "UPDATE bot.mastodon_outbox SET failed_at = now(), last_error = %(error)s WHERE id = %(id)s")
+outbox_counts = queries.query("mastodon_outbox_counts", '''SELECT
+        count(*) FILTER (WHERE posted_at IS NULL AND failed_at IS NULL),
+        count(*) FILTER (WHERE posted_at IS NULL AND failed_at IS NULL AND attempts > 0),
+        count(*) FILTER (WHERE failed_at IS NOT NULL)
+    FROM bot.mastodon_outbox''')
+quote_query = queries.query("mastodon_quote", "SELECT content, authorid, timestamp FROM bot.quotes WHERE id = %(qid)s")
+
+def seconds_until_reset(response: aiohttp.ClientResponse):
+    """How long Mastodon wants us to wait, from Retry-After or X-RateLimit-Reset, if it said."""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset is not None:
+        try:
+            return max(0.0, (datetime.fromisoformat(reset) - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            pass
+    return None
+
+class MastodonPoster:
+    """Posts quotes to Mastodon from a durable outbox (bot.mastodon_outbox, see 011_mastodon_outbox.sql).
+
+    New quotes are queued with enqueue(), and every `interval` seconds the next quote in the
+    guild's rotation is queued too. Queued posts survive restarts. A failed post is retried
+    with exponential backoff up to `max_attempts` times; when Mastodon says we're rate
+    limited, nothing is sent until its limit resets. Rejected posts (bad token, too long...)
+    aren't retried.
+
+    Runs inside the bot or on its own (mastoposter.py), or both at once: only one of them
+    queues each scheduled post, and a post is only handed to one sender at a time. Anything
+    added to the outbox wakes every running poster up through LISTEN/NOTIFY."""
+
+    def __init__(self, api_base_url: str, access_token: str, excluded, guild: int = 124680630075260928, interval: float = 10800,
+                 max_attempts: int = 8, backoff: float = 30, max_backoff: float = 3600, timeout: float = 30, poll: float = 60):
+        self.api_base_url = api_base_url.rstrip('/')
+        self.access_token = access_token
+        # Called for the current list of user IDs who don't want their quotes posted
+        self.excluded = excluded
+        self.guild = guild
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # Longest we sleep without checking the outbox, in case a notification went missing
+        self.poll = poll
+
+        self.session: aiohttp.ClientSession | None = None
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.paused_until = 0.0
+        self.rate_remaining: int | None = None
+
+        self.scheduled = 0
+        self.posted = 0
+        self.retries = 0
+        self.failures = 0
+        self.skipped = 0
+        self.rate_limited = 0
+        self.total_post_ms = 0.0
+        self.max_post_ms = 0.0
+
+    async def enqueue(self, qid: int, kind: str = 'new_quote', gid: int = None):
+        """Queue a quote to be posted. Only writes the outbox row; the post goes out in the background."""
+        row = await enqueue_query.fetchone({"kind": kind, "gid": gid or self.guild, "qid": qid})
+        self.wakeup.set()
+        logger.debug(f"Mastodon: queued quote {qid} ({kind}) as post {row[0]}")
+        return row[0]
+
+    async def schedule(self):
+        """Queue the next quote from the rotation if one is due. Returns seconds until the next one is."""
+        async with database.connection() as con:
+            # One decision per interval, however many posters are running
+            await schedule_lock.execute(con, {"gid": self.guild % 2**31})
+            age = (await last_scheduled_query.fetchone({"gid": self.guild}, con=con))[0]
+            if age is not None and age < self.interval:
+                return self.interval - age
+
+            qid = await next_in_rotation(con, self.guild, self.excluded())
+            if qid is None:
+                logger.info("Mastodon: nothing to post!")
+                return self.interval
+            await enqueue_query.fetchone({"kind": "scheduled", "gid": self.guild, "qid": qid}, con=con)
+        self.scheduled += 1
+        return self.interval
+
+    def backoff_delay(self, attempts: int):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        # Jittered, so a burst of failures doesn't all come back at once
+        return random.uniform(delay / 2, delay)
+
+    def check_rate_limit(self, response: aiohttp.ClientResponse):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if remaining is None or not remaining.isdigit():
+            return
+        self.rate_remaining = int(remaining)
+        if self.rate_remaining == 0:
+            wait = seconds_until_reset(response)
+            if wait:
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+                logger.info(f"Mastodon: used up our rate limit, waiting {wait:.0f}s")
+
+    async def send(self, oid: int, qid: int, attempts: int):
+        quote = await quote_query.fetchone({"qid": qid})
+        if quote is None or quote[1] in self.excluded():
+            self.skipped += 1
+            await failed_query.run({"id": oid, "error": "quote was deleted" if quote is None else "author has opted out"})
+            return
+
+        content, aID, timestamp = quote
+        status = format_quote(strip_discord_format(content), authorName=rename_user(aID, f'(@splatsune@thegeneral.chat has no map for user {aID}!)'), timestamp=timestamp)
+
+        start = time.perf_counter()
+        wait = None
+        try:
+            async with self.session.post(f"{self.api_base_url}/api/v1/statuses", data={"status": status},
+                                         headers={"Idempotency-Key": f"sanford-outbox-{oid}"}) as response:
+                self.check_rate_limit(response)
+                if response.status < 300:
+                    body = await response.json()
+                    elapsed = (time.perf_counter() - start) * 1000
+                    self.posted += 1
+                    self.total_post_ms += elapsed
+                    self.max_post_ms = max(self.max_post_ms, elapsed)
+                    await posted_query.run({"id": oid, "status_id": str(body.get('id'))})
+                    logger.info(f"Mastodon: posted quote {qid} as {body.get('url') or body.get('id')} in {elapsed:.0f}ms")
+                    return
+                error = f"HTTP {response.status}: {(await response.text())[:200]}"
+                retryable = response.status in (408, 429) or response.status >= 500
+                if response.status == 429:
+                    wait = seconds_until_reset(response) or self.backoff_delay(attempts)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f"{type(e).__name__}: {e}"
+            retryable = True
+
+        if wait is not None:
+            # Not the post's fault, so it doesn't count against its attempts
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            await retry_query.run({"id": oid, "delay": wait, "refund": 1, "error": error})
+            logger.warning(f"Mastodon: rate limited, trying again in {wait:.0f}s")
+        elif retryable and attempts < self.max_attempts:
+            self.retries += 1
+            delay = self.backoff_delay(attempts)
+            await retry_query.run({"id": oid, "delay": delay, "refund": 0, "error": error})
+            logger.warning(f"Mastodon: couldn't post quote {qid} ({error}), attempt {attempts}/{self.max_attempts}, trying again in {delay:.0f}s")
+        else:
+            self.failures += 1
+            await failed_query.run({"id": oid, "error": error})
+            logger.error(f"Mastodon: giving up on quote {qid} after {attempts} attempts: {error}")
+
+    async def drain(self):
+        """Send everything that's due, unless we're waiting out a rate limit."""
+        while time.monotonic() >= self.paused_until:
+            # The claim holds the post for a while (longer than a post could take), so it's
+            # neither sent twice nor lost if we die halfway through
+            row = await claim_query.fetchone({"lease": float(self.timeout * 2)})
+            if row is None:
+                return
+            oid, kind, qid, attempts = row
+            await self.send(oid, qid, attempts)
+
+    async def tick(self):
+        """Do whatever is due; returns how long until something else will be."""
+        waits = [self.poll]
+        if self.interval:
+            waits.append(await self.schedule())
+        await self.drain()
+        due = (await next_due_query.fetchone())[0]
+        if due is not None:
+            waits.append(due)
+        wait = min(waits)
+        if self.paused_until > time.monotonic():
+            wait = max(wait, self.paused_until - time.monotonic())
+        return max(wait, 0.1)
+
+    async def run(self):
+        self.session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self.access_token}"},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        # Anything added to the outbox, in this process or another, wakes us up
+        listener = asyncio.create_task(database.listen('mastodon_outbox', lambda payload: self.wakeup.set(), retry=self.poll))
+        try:
+            while True:
+                try:
+                    wait = await self.tick()
+                except Exception as error:
+                    logger.error("Mastodon: poster failed, will retry")
+                    logger.exception(error)
+                    wait = self.backoff
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        finally:
+            listener.cancel()
+            await self.session.close()
+            self.session = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def status(self):
+        pending, retrying, failed = await outbox_counts.fetchone()
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "pending": pending,
+            "retrying": retrying,
+            "failed": failed,
+            "scheduled": self.scheduled,
+            "posted": self.posted,
+            "retries": self.retries,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "rate_limited": self.rate_limited,
+            "rate_remaining": self.rate_remaining,
+            "paused_for": max(0.0, self.paused_until - time.monotonic()),
+            "post_avg_ms": self.total_post_ms / self.posted if self.posted else 0.0,
+            "post_max_ms": self.max_post_ms,
+        }
@@ -0,0 +1,104 @@
+import json
+import asyncio
+import logging
+
+from helpers import database, queries
+
+logger = logging.getLogger('helpers')
+
+load_query = queries.query("user_prefs_load", "SELECT userid, mastodon_exclude, mastodon_alias FROM bot.user_prefs WHERE mastodon_exclude OR mastodon_alias IS NOT NULL")
+seed_query = queries.query("user_prefs_seed", '''INSERT INTO bot.user_prefs (userid, mastodon_exclude, mastodon_alias)
+    SELECT * FROM unnest(%(uids)s::bigint[], %(excludes)s::boolean[], %(aliases)s::text[])
+    ON CONFLICT (userid) DO NOTHING''')
+# A NULL exclude or alias leaves it as it was; an empty alias clears it
+set_query = queries.query("user_prefs_set", '''INSERT INTO bot.user_prefs AS p (userid, mastodon_exclude, mastodon_alias)
+    VALUES (%(uid)s, coalesce(%(exclude)s::boolean, false), nullif(%(alias)s::text, ''))
+    ON CONFLICT (userid) DO UPDATE SET
+        mastodon_exclude = coalesce(%(exclude)s::boolean, p.mastodon_exclude),
+        mastodon_alias = CASE WHEN %(alias)s::text IS NULL THEN p.mastodon_alias ELSE nullif(%(alias)s::text, '') END,
+        updated_at = now()
+    RETURNING userid, mastodon_exclude, mastodon_alias''')
+
+class UserPrefs:
+    """Per-user settings from bot.user_prefs (see 012_user_prefs.sql), all held in memory.
+
+    `excluded` is everyone who doesn't want their quotes on Mastodon and `aliases` what to
+    call people there. Both are updated in place, never replaced, so they can be handed to
+    whatever needs them (like the scrubber). Changes made anywhere, in this process or
+    another, arrive through LISTEN/NOTIFY, and everything is reloaded after reconnecting.
+
+    `seed_excluded` and `seed_aliases` are the old settings from config.yaml; they're
+    written in for anyone who doesn't have a row yet."""
+
+    def __init__(self, seed_excluded=None, seed_aliases: dict = None):
+        self.excluded: set[int] = set()
+        self.aliases: dict[int, str] = {}
+        self.seed_excluded = [int(u) for u in seed_excluded or []]
+        self.seed_aliases = {int(k): v for k, v in (seed_aliases or {}).items() if v}
+        self.task: asyncio.Task | None = None
+
+        self.loads = 0
+        self.notifications = 0
+
+    def apply(self, uid: int, exclude: bool, alias: str | None):
+        if exclude:
+            self.excluded.add(uid)
+        else:
+            self.excluded.discard(uid)
+        if alias:
+            self.aliases[uid] = alias
+        else:
+            self.aliases.pop(uid, None)
+
+    async def seed(self):
+        uids = sorted(set(self.seed_excluded) | set(self.seed_aliases))
+        if uids:
+            await seed_query.run({
+                "uids": uids,
+                "excludes": [uid in self.seed_excluded for uid in uids],
+                "aliases": [self.seed_aliases.get(uid) for uid in uids],
+            })
+
+    async def load(self):
+        rows = await load_query.fetchall()
+        self.excluded.clear()
+        self.aliases.clear()
+        for uid, exclude, alias in rows:
+            self.apply(uid, exclude, alias)
+        self.loads += 1
+        logger.debug(f"Prefs: loaded {len(rows)} users ({len(self.excluded)} excluded, {len(self.aliases)} aliases)")
+
+    def notified(self, payload: str):
+        row = json.loads(payload)
+        self.notifications += 1
+        self.apply(row['userid'], row['mastodon_exclude'], row['mastodon_alias'])
+
+    async def set(self, uid: int, exclude: bool = None, alias: str = None):
+        """Change someone's settings; None leaves a setting alone, and an empty alias removes it."""
+        uid, exclude, alias = await set_query.fetchone({"uid": uid, "exclude": exclude, "alias": alias})
+        # Don't wait for the notification to come back round
+        self.apply(uid, exclude, alias)
+        return exclude, alias
+
+    async def start(self):
+        await self.seed()
+        await self.load()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(database.listen('user_prefs', self.notified, reconnected=self.load))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        return {
+            "excluded": len(self.excluded),
+            "aliases": len(self.aliases),
+            "loads": self.loads,
+            "notifications": self.notifications,
+        }
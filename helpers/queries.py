@@ -0,0 +1,127 @@
+import time
+import logging
+from contextlib import contextmanager
+
+from helpers import database, metrics
+
+logger = logging.getLogger('helpers')
+
+# The columns every quote-returning query hands back, in the order the rest of the bot unpacks them:
+# qid, content, authorid, authorname, timestamp, karma, source
+quote_columns = "id,content,authorid,authorname,timestamp,karma,source"
+
+class Query:
+    """One named SQL statement with its parameters passed separately.
+
+    Runs as a server-side prepared statement, so PostgreSQL parses and plans it once per
+    connection rather than on every call, and keeps track of how long it takes."""
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = metrics.query_seconds.labels(name)
+
+    @contextmanager
+    def timed(self):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors += 1
+            metrics.query_errors.labels(self.name).inc()
+            raise
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.calls += 1
+            self.total_ms += elapsed
+            self.max_ms = max(self.max_ms, elapsed)
+            self.histogram.observe(elapsed / 1000)
+
+    async def execute(self, con, params=None):
+        with self.timed():
+            return await con.execute(self.sql, params, prepare=True)
+
+    async def executemany(self, params_seq, con=None):
+        """Run the statement once for every set of params, pipelined, timed as one call.
+        psycopg prepares it after the first few rows of a batch."""
+        if con is None:
+            async with database.connection() as con:
+                return await self.executemany(params_seq, con=con)
+        with self.timed():
+            async with con.cursor() as cur:
+                await cur.executemany(self.sql, params_seq)
+
+    async def fetchone(self, params=None, con=None):
+        if con is not None:
+            return await (await self.execute(con, params)).fetchone()
+        async with database.connection() as con:
+            return await (await self.execute(con, params)).fetchone()
+
+    async def fetchall(self, params=None, con=None):
+        if con is not None:
+            return await (await self.execute(con, params)).fetchall()
+        async with database.connection() as con:
+            return await (await self.execute(con, params)).fetchall()
+
+    async def run(self, params=None, con=None):
+        """For statements with nothing to fetch. Returns the row count."""
+        if con is not None:
+            return (await self.execute(con, params)).rowcount
+        async with database.connection() as con:
+            return (await self.execute(con, params)).rowcount
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": self.total_ms / self.calls if self.calls else 0.0,
+            "max_ms": self.max_ms,
+        }
+
+registry: dict[str, Query] = {}
+
+def query(name: str, sql: str):
+    """The Query called `name`, created the first time it's asked for."""
+    q = registry.get(name)
+    if q is None:
+        q = registry[name] = Query(name, sql)
+    return q
+
+def quote_filter(gid: int = None, uid=None, exclude=None):
+    """WHERE conditions for the usual quote filters: a guild, one or more authors, and
+    authors to leave out. Returns (shape, sql, params).
+
+    The SQL only depends on which filters are present, never on their values, so each
+    combination is its own prepared statement with a plan that can use the right index.
+    `shape` names the combination, for naming the query."""
+    conditions, params, shape = [], {}, []
+    if bool(gid):
+        conditions.append("guild = %(gid)s")
+        params['gid'] = int(gid)
+        shape.append("guild")
+    if uid is not None and not isinstance(uid, int) and len(uid) == 1:
+        uid = next(iter(uid))
+    if isinstance(uid, int):
+        conditions.append("authorid = %(uid)s")
+        params['uid'] = uid
+        shape.append("author")
+    elif uid:
+        conditions.append("authorid = ANY(%(uids)s)")
+        params['uids'] = [int(u) for u in uid]
+        shape.append("authors")
+    if exclude:
+        conditions.append("authorid <> ALL(%(exclude)s)")
+        params['exclude'] = [int(u) for u in exclude]
+        shape.append("exclude")
+    return "+".join(shape) or "all", conditions, params
+
+def where(conditions: list[str], *extra: str):
+    conditions = [*conditions, *extra]
+    return f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+def stats():
+    return {name: q.stats() for name, q in sorted(registry.items())}
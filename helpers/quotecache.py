@@ -0,0 +1,192 @@
+import sys
+import time
+import random
+import typing
+import logging
+from collections import OrderedDict
+
+from helpers import database, queries
+
+logger = logging.getLogger('helpers')
+
+class QuoteRecord(typing.NamedTuple):
+    """A quote as the rest of the bot unpacks it: qid, content, authorid, authorname, timestamp, karma, source."""
+    id: int
+    content: str
+    authorid: int | None
+    authorname: str | None
+    timestamp: int | None
+    karma: int
+    source: str | None
+
+def record_size(record: QuoteRecord, shared=()):
+    """Rough bytes held by one record: the tuple plus each field, not counting
+    values shared with other records (like interned author names)."""
+    return sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record if field is not None and field not in shared)
+
+# Read through a server-side cursor (see QuoteCache.load), so declared rather than prepared and not timed
+load_query = queries.query("quote_cache_load", f"SELECT {queries.quote_columns} FROM bot.quotes WHERE guild = %(gid)s ORDER BY id")
+
+class GuildQuotes:
+    """Every quote in one guild, plus where to find each author's."""
+
+    def __init__(self, rows):
+        self.loaded_at = time.monotonic()
+        self.records: list[QuoteRecord] = []
+        self.positions: dict[int, int] = {}
+        self.by_author: dict[int, list[int]] = {}
+        # The same few names come up over and over, so keep one copy of each
+        self.names: dict[str, str] = {}
+        self.bytes = 0
+        for row in rows:
+            self.add(QuoteRecord(*row))
+
+    def add(self, record: QuoteRecord):
+        if record.id in self.positions:
+            return
+        if record.authorname is not None:
+            record = record._replace(authorname=self.names.setdefault(record.authorname, record.authorname))
+        self.positions[record.id] = len(self.records)
+        self.by_author.setdefault(record.authorid, []).append(len(self.records))
+        self.records.append(record)
+        self.bytes += record_size(record, shared=(record.authorname,))
+
+    def set_karma(self, qid: int, karma: int):
+        position = self.positions.get(qid)
+        if position is not None:
+            self.records[position] = self.records[position]._replace(karma=karma)
+
+    def pick(self, uid=None):
+        if uid is None:
+            return random.choice(self.records) if self.records else None
+
+        # Every quote by any of the authors equally likely, not every author
+        positions = [self.by_author.get(u, []) for u in ((uid,) if isinstance(uid, int) else set(uid))]
+        count = sum(len(p) for p in positions)
+        if count == 0:
+            return None
+        index = random.randrange(count)
+        for p in positions:
+            if index < len(p):
+                return self.records[p[index]]
+            index -= len(p)
+
+class QuoteCache:
+    """Whole guilds' quotes held in memory, so random quotes for a guild never touch the database.
+
+    A guild is loaded in one query the first time it's asked for, kept current as quotes
+    are saved and voted on, and reloaded after `ttl` seconds in case something else changed
+    the table. Guilds are evicted least recently used first to stay under `max_bytes`
+    (an estimate, see record_size); a guild too big to fit on its own isn't cached at all
+    (reading it stops once it's over), and isn't tried again until `ttl` seconds later,
+    however many quotes it gets saved."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: int = 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.guilds: OrderedDict[int, GuildQuotes] = OrderedDict()
+        # Guilds found to be too big: how many quotes it took to go over, and when to try again
+        self.oversized: dict[int, tuple[int, float]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def bytes(self):
+        return sum(guild.bytes for guild in self.guilds.values())
+
+    async def guild(self, gid: int):
+        """The guild's cached quotes, loading them if need be. None if it's too big to cache."""
+        cached = self.guilds.get(gid)
+        if cached is not None and time.monotonic() - cached.loaded_at < self.ttl:
+            self.hits += 1
+            self.guilds.move_to_end(gid)
+            return cached
+
+        self.misses += 1
+        if gid in self.oversized and cached is None:
+            if time.monotonic() < self.oversized[gid][1]:
+                return None
+            del self.oversized[gid]
+
+        start = time.perf_counter()
+        quotes = await self.load(gid)
+        if quotes.bytes > self.max_bytes:
+            logger.info(f"Quote cache: guild {gid} is too big to cache (over {self.max_bytes:,} bytes after {len(quotes.records)} quotes)")
+            self.oversized[gid] = (len(quotes.records), time.monotonic() + self.ttl)
+            self.guilds.pop(gid, None)
+            return None
+
+        self.guilds[gid] = quotes
+        self.guilds.move_to_end(gid)
+        logger.debug(f"Quote cache: loaded {len(quotes.records)} quotes for guild {gid} in {(time.perf_counter() - start) * 1000:.1f}ms")
+        self.evict()
+        return quotes
+
+    async def load(self, gid: int, batch_size: int = 1000):
+        """Read a guild's quotes `batch_size` at a time, stopping as soon as they pass max_bytes,
+        so a guild too big to cache is never read into memory in full."""
+        quotes = GuildQuotes(())
+        async with database.connection() as con:
+            async with con.cursor(name="sanford_quote_cache_load") as cur:
+                cur.itersize = batch_size
+                await cur.execute(load_query.sql, {"gid": gid})
+                async for row in cur:
+                    quotes.add(QuoteRecord(*row))
+                    if quotes.bytes > self.max_bytes:
+                        break
+        return quotes
+
+    def evict(self):
+        total = self.bytes
+        while total > self.max_bytes and len(self.guilds) > 1:
+            gid, quotes = self.guilds.popitem(last=False)
+            total -= quotes.bytes
+            self.evictions += 1
+            logger.debug(f"Quote cache: evicted guild {gid}")
+
+    async def pick(self, gid: int, uid=None):
+        """(cached, record): whether the guild could be cached, and a random quote from it (or None)."""
+        quotes = await self.guild(gid)
+        if quotes is None:
+            return False, None
+        return True, quotes.pick(uid)
+
+    def add(self, gid: int, row):
+        """A quote was just saved."""
+        quotes = self.guilds.get(gid)
+        if quotes is not None:
+            quotes.add(QuoteRecord(*row))
+            self.evict()
+
+    def karma_flushed(self, rows):
+        """KarmaQueue listener: (id, karma, guild) for every quote whose karma just changed."""
+        for qid, karma, gid in rows:
+            quotes = self.guilds.get(gid)
+            if quotes is not None:
+                quotes.set_karma(qid, karma)
+
+    def forget(self, gid: int = None):
+        if gid is None:
+            self.guilds.clear()
+            self.oversized.clear()
+        else:
+            # Still too big if it was (stampfinder forgets a guild after every batch it writes)
+            self.guilds.pop(gid, None)
+
+    def stats(self):
+        quotes = sum(len(guild.records) for guild in self.guilds.values())
+        total = self.bytes
+        return {
+            "guilds": len(self.guilds),
+            "quotes": quotes,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "bytes_per_quote": total / quotes if quotes else 0.0,
+            "oversized_guilds": len(self.oversized),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            "evictions": self.evictions,
+        }
@@ -1,11 +1,21 @@
 from datetime import datetime
-import psycopg2
+import psycopg
 import discord
 import yaml
 import re
+import random
 import asyncio
 import logging
 
+from helpers import database, queries
+from helpers.randompick import QuoteIdIndex
+from helpers.quotecache import QuoteCache
+from helpers.karma import KarmaQueue
+from helpers.leaderboard import Leaderboards
+from helpers.search import QuoteSearch
+from helpers.scrubber import Scrubber
+from helpers.prefs import UserPrefs
+
 with open('config.yaml', 'r') as file:
     cfg = yaml.safe_load(file)
 
@@ -15,6 +25,34 @@ handler = logging.StreamHandler()
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# Quote IDs per guild/author, for picking random quotes without ORDER BY random()
+quote_ids = QuoteIdIndex(**(cfg['sanford']['quoting'].get('random_pick') or {}))
+
+# Whole guilds' quotes in memory, so random quotes from a guild don't need the database
+quote_cache = QuoteCache(**(cfg['sanford']['quoting'].get('cache') or {}))
+
+# Karma changes from votes, written out in batches
+karma_queue = KarmaQueue(**(cfg['sanford']['quoting'].get('karma_queue') or {}))
+
+# Per-guild leaderboards, kept in memory until the guild's quotes change
+leaderboards = Leaderboards(**(cfg['sanford']['quoting'].get('leaderboard') or {}))
+
+# Searching quotes by content
+quote_search = QuoteSearch(**(cfg['sanford']['quoting'].get('search') or {}))
+
+# Everyone's Mastodon settings, from bot.user_prefs (the config's are only the starting point)
+user_prefs = UserPrefs((cfg.get('mastodon') or {}).get('exclude_users'), (cfg.get('mappings') or {}).get('users'))
+
+# Discord markup flattened to plain text, with users' Mastodon names from their prefs
+scrubber = Scrubber(user_prefs.aliases)
+
+def karma_flushed(rows):
+    for guild in {row[2] for row in rows}:
+        leaderboards.invalidate(guild)
+
+karma_queue.listeners.append(karma_flushed)
+karma_queue.listeners.append(quote_cache.karma_flushed)
+
 def format_quote(content,timestamp,authorID=None,authorName=None,bot=None,source=None,format: str='plain'):
     quote_string_id = '''"{0}"
     —<@{1}> / {2}'''
@@ -70,131 +108,188 @@ def format_quote(content,timestamp,authorID=None,authorName=None,bot=None,source
 
 ### SQL FUNCTIONS
 
-def get_quote(gid: int = None, uid: int = None, sort_order: str = "random()", limit: int = 1):
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port = cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-)
-    cur = con.cursor()
-    
-    where_filter = []
-    if bool(gid): where_filter.append(f"guild='{str(gid)}'")
-    if bool(uid): where_filter.append(f"authorid {('= ' + str(uid) + '') if type(uid) == int else ('= ' + str(uid[0]) + '') if len(uid) == 1 else ('=ANY ' +  str(uid))}")
-#    if bool(exclude_list): where_filter.append(f"authorid NOT IN ({str(exclude_list).strip('[]')})")
-
-    query = f"SELECT id,content,authorid,authorname,timestamp,karma,source FROM bot.quotes {'WHERE ' + ' AND '.join(where_filter) if bool(uid) or bool(gid) else ''} ORDER BY {sort_order} {f"LIMIT {limit}" if (bool(limit) and limit > 0) else ""}"
-    logger.debug(query)
-    # Fetch a random quote from the SQL database
-    try:
-        cur.execute(query)
-        result = [[q[0],q[1],q[2],q[3],q[4],q[5],q[6]] for q in cur.fetchall()]
-    except TypeError as error:
-        if bool(uid) and "NoneType object" in str(error):
+# Every statement below goes through helpers/queries.py: parameters are always passed
+# separately, and each one is prepared once per connection and timed
+
+quote_by_id = queries.query("quote_by_id", f"SELECT {queries.quote_columns} FROM bot.quotes WHERE id = %(id)s")
+quotes_by_ids = queries.query("quotes_by_ids", f"SELECT {queries.quote_columns} FROM bot.quotes WHERE id = ANY(%(ids)s) ORDER BY id")
+
+async def get_random_quote(gid: int = None, uid: int = None):
+    # Straight out of memory if this guild fits in the quote cache
+    if bool(gid):
+        cached, q = await quote_cache.pick(gid, uid)
+        if cached:
+            if q is None:
+                if bool(uid):
+                    raise LookupError("Sorry, that user doesn't have any quotes saved in this server yet!")
+                raise LookupError(":no_entry_sign: Got nothing. There may not be any quotes here yet!")
+            return list(q)
+
+    # Otherwise pick an ID out of the cached index, then fetch just that row
+    for attempt in range(2):
+        qid = await quote_ids.pick(gid, uid)
+        if qid is None:
+            break
+        q = await quote_by_id.fetchone({"id": qid})
+        if q is not None:
+            return [q[0],q[1],q[2],q[3],q[4],q[5],q[6]]
+        # The quote went away since we cached its ID, so reload this scope and try again
+        quote_ids.forget(gid)
+
+    if bool(uid):
+        raise LookupError("Sorry, that user doesn't have any quotes saved in this server yet!")
+    raise LookupError(":no_entry_sign: Got nothing. There may not be any quotes here yet!")
+
+async def get_nth_quote(gid: int = None, uid: int = None, n: int = 0):
+    """A user's nth quote, oldest first (negative n counts back from the newest)."""
+    # If we've got this user's IDs in memory already it's just an index into them
+    ids = quote_ids.peek(gid, uid)
+    q = None
+    if ids is not None and -len(ids) <= n < len(ids):
+        q = await quote_by_id.fetchone({"id": ids[n]})
+        if q is None:
+            # Deleted since the IDs were loaded, so they're out of date; ask the database instead
+            quote_ids.forget(gid, uid)
+    if q is None:
+        # Otherwise walk the (author, [guild,] id) index and stop at the nth row
+        shape, conditions, params = queries.quote_filter(gid, uid)
+        order = "ASC" if n >= 0 else "DESC"
+        params['n'] = n if n >= 0 else -n - 1
+        q = await queries.query(f"nth_quote[{shape}] {order}",
+            f"SELECT {queries.quote_columns} FROM bot.quotes{queries.where(conditions)} ORDER BY id {order} OFFSET %(n)s LIMIT 1"
+        ).fetchone(params)
+
+    if q is None:
+        raise LookupError(f"Sorry, that user doesn't have a quote #{n} saved{' in this server' if bool(gid) else ''}!")
+    return [q[0],q[1],q[2],q[3],q[4],q[5],q[6]]
+
+def listing_query(gid: int = None, uid: int = None, after: int = 0, paged: bool = True):
+    shape, conditions, params = queries.quote_filter(gid, uid)
+    params['after'] = after or 0
+    sql = f"SELECT {queries.quote_columns} FROM bot.quotes{queries.where(conditions, 'id > %(after)s')} ORDER BY id"
+    if paged:
+        sql += " LIMIT %(limit)s"
+    return queries.query(f"list_quotes[{shape}]{'' if paged else ' export'}", sql), params
+
+async def list_quotes(gid: int = None, uid: int = None, after: int = 0, limit: int = 100):
+    """One page of quotes in id order, starting after the quote ID `after`.
+
+    Keyset pagination: each page is a range scan on the guild/author index, however far in we are."""
+    query, params = listing_query(gid, uid, after)
+    params['limit'] = limit
+    return await query.fetchall(params)
+
+async def stream_quotes(gid: int = None, uid: int = None, after: int = 0, batch_size: int = 500):
+    """Every matching quote in id order, read through a server-side cursor so only
+    `batch_size` rows are in memory at a time."""
+    # Named cursors are declared on the server rather than prepared, so this one isn't timed
+    query, params = listing_query(gid, uid, after, paged=False)
+    async with database.connection() as con:
+        async with con.cursor(name="sanford_quote_export") as cur:
+            cur.itersize = batch_size
+            await cur.execute(query.sql, params)
+            async for q in cur:
+                yield q
+
+async def top_quotes(gid: int, uid: int = None, after: tuple = None, limit: int = 5):
+    """A guild's (or one of its users') quotes by karma, best first.
+
+    `after` is the (karma, id) of the last quote on the previous page, so each page picks
+    up where the last left off in the karma index instead of counting past it with OFFSET."""
+    shape, conditions, params = queries.quote_filter(gid, uid)
+    # Lower karma, or the same karma and a later id - the first half lets the index do the work.
+    # The first page starts from the highest karma there could be.
+    params['karma'], params['id'] = after if after is not None else (2**31 - 1, 0)
+    params['limit'] = limit
+    # Quotes with no karma rank (and show) as 0 rather than dropping out
+    return await queries.query(f"top_quotes[{shape}]",
+        "SELECT id,content,authorid,authorname,timestamp,coalesce(karma, 0),source FROM bot.quotes"
+        f"{queries.where(conditions, 'coalesce(karma, 0) <= %(karma)s', '(coalesce(karma, 0) < %(karma)s OR id > %(id)s)')}"
+        " ORDER BY coalesce(karma, 0) DESC, id LIMIT %(limit)s"
+    ).fetchall(params)
+
+async def get_quote(gid: int = None, uid: int = None, limit: int = 1):
+    """A random quote, optionally from a guild and/or author(s). With a `limit` other than 1,
+    a list of up to that many different random quotes, in id order."""
+    if limit == 1:
+        return await get_random_quote(gid, uid)
+
+    ids = await quote_ids.ids(gid, uid)
+    if len(ids) == 0:
+        if bool(uid):
             raise LookupError("Sorry, that user doesn't have any quotes saved in this server yet!")
-    finally:
-        cur.close()
-        con.close()
-    if len(result) == 1:
-        return result[0]
-    else:
-        return result
-
-def insert_quote(quote_data: tuple):
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port = cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-    )
-    cur = con.cursor()
-    
+        raise LookupError(":no_entry_sign: Got nothing. There may not be any quotes here yet!")
+
+    picked = random.sample(range(len(ids)), min(limit, len(ids))) if limit and limit > 0 else range(len(ids))
+    return [[q[0],q[1],q[2],q[3],q[4],q[5],q[6]] for q in await quotes_by_ids.fetchall({"ids": [ids[i] for i in picked]})]
+
+insert_quote_query = queries.query("insert_quote", "INSERT INTO bot.quotes (content, authorid, authorname, addedby, guild, msgid, timestamp, source) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (msgid) WHERE msgid IS NOT NULL DO NOTHING RETURNING id, karma")
+
+async def insert_quote(quote_data: tuple):
     # Validate quote tuple first
     if len(quote_data) != 8:
         raise Exception(f"Quote object has {len(quote_data)} items (should be 8)")
     
     
-    cur.execute("INSERT INTO bot.quotes (content, authorid, authorname, addedby, guild, msgid, timestamp, source) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id, karma;", quote_data)
-    returning = cur.fetchone()
-    con.commit()
-    cur.close()
-    con.close()
+    # Saving a message that's already been saved hits the unique msgid index and returns nothing
+    returning = await insert_quote_query.fetchone(quote_data)
+    if returning is None:
+        raise LookupError('This quote is already in the database.')
+    content, authorid, authorname, addedby, guild, msgid, timestamp, source = quote_data
+    quote_ids.add(guild, authorid, returning[0])
+    quote_cache.add(guild, (returning[0], content, authorid, authorname, timestamp, returning[1], source))
+    leaderboards.invalidate(guild)
     return returning
 
-def update_karma(qid,karma):
-    con = psycopg2.connect(
-        database = cfg['postgresql']['database'],
-        host = cfg['postgresql']['host'],
-        port = cfg['postgresql']['port'],
-        user = cfg['postgresql']['user'],
-        password = cfg['postgresql']['password'],
-    )
-    cur = con.cursor()
-    cur.execute("UPDATE bot.quotes SET karma= %s WHERE id= %s", (karma, qid))
-    con.commit()
-    cur.close()
-    con.close()
+guild_stats = queries.query("quote_stats[guild]", "SELECT total, nullstamps, nullsource, nullids FROM bot.quote_stats WHERE guild = %(gid)s")
+global_stats = queries.query("quote_stats[all]", "SELECT coalesce(sum(total), 0)::bigint, coalesce(sum(nullstamps), 0)::bigint, coalesce(sum(nullsource), 0)::bigint, coalesce(sum(nullids), 0)::bigint FROM bot.quote_stats")
+
+async def quote_stats(gid: int = None):
+    """(total, no timestamp, no source, no message ID) for a guild, or across every guild."""
+    if bool(gid):
+        row = await guild_stats.fetchone({"gid": gid})
+    else:
+        row = await global_stats.fetchone()
+    return row or (0, 0, 0, 0)
+
+async def reconcile_quote_stats():
+    """Recount bot.quote_stats from scratch, in case the triggers ever missed something.
+    Returns the guilds whose figures were wrong."""
+    async with database.connection() as con:
+        await con.execute("LOCK TABLE bot.quotes IN SHARE ROW EXCLUSIVE MODE")
+        cur = await con.execute('''WITH actual AS (
+                SELECT coalesce(guild, 0) AS guild, count(*) AS total,
+                    count(*) FILTER (WHERE timestamp IS NULL) AS nullstamps,
+                    count(*) FILTER (WHERE source IS NULL) AS nullsource,
+                    count(*) FILTER (WHERE msgid IS NULL) AS nullids
+                FROM bot.quotes GROUP BY coalesce(guild, 0)
+            )
+            SELECT coalesce(a.guild, s.guild) FROM actual a FULL JOIN bot.quote_stats s ON s.guild = a.guild
+            WHERE (coalesce(a.total, 0), coalesce(a.nullstamps, 0), coalesce(a.nullsource, 0), coalesce(a.nullids, 0))
+                IS DISTINCT FROM (coalesce(s.total, 0), coalesce(s.nullstamps, 0), coalesce(s.nullsource, 0), coalesce(s.nullids, 0))''')
+        wrong = [row[0] for row in await cur.fetchall()]
+        await con.execute("DELETE FROM bot.quote_stats")
+        await con.execute('''INSERT INTO bot.quote_stats (guild, total, nullstamps, nullsource, nullids)
+            SELECT coalesce(guild, 0), count(*),
+                count(*) FILTER (WHERE timestamp IS NULL),
+                count(*) FILTER (WHERE source IS NULL),
+                count(*) FILTER (WHERE msgid IS NULL)
+            FROM bot.quotes GROUP BY coalesce(guild, 0)''')
+    logger.info(f"Quote stats: recounted, {len(wrong)} guilds were off")
+    return wrong
+
+def update_karma(qid, delta):
+    # Queued, not written straight away - see helpers/karma.py
+    karma_queue.add(qid, delta)
+
 
 
-    
-async def karma_helper(interaction: discord.Interaction, qid, karma):
-    # config vars
-    timeout = cfg['sanford']['quoting']['vote_timeout']
-    # Let's allow the quote to be voted on
-    thumbsUp, thumbsDown = "👍", "👎"
-    
-    imsg = await interaction.original_response()
-    msg = await imsg.fetch()
-    
-    await msg.add_reaction(thumbsUp)
-    await msg.add_reaction(thumbsDown)
-    
-    
-    await asyncio.sleep(60*timeout) # Wait 3 minutes before collecting reactions
-    
-    msg = await msg.fetch()
-    
-    upCount = 0
-    downCount = 0
-    
-    # Count the reactions (Sanfords doesn't count)
-    for e in msg.reactions:
-        match e.emoji:
-            case "👍":
-                upCount = e.count - 1
-            case "👎":
-                downCount = e.count - 1
-                
-    karmadiff = 0 + upCount - downCount
-    newkarma = karma + karmadiff
-    
-    return (qid, newkarma)
-    
 ### MASTOPOSTER-CENTRIC FUNCTIONS
     
 def rename_user(id, fallback: str):
-    for k,v in cfg['mappings']['users'].items():
-        if k == id:
-            # Found our author!
-            return v
-    else:
-        return fallback
-    
+    return scrubber.rename(id, fallback)
+
 def strip_discord_format(str):
-    emoji = re.compile(r"<(:\S+:)\d+>")
-    user = re.compile(r"<@!?(\d+)>")
-    # replace emoji mentions with just the :emoji: string
-    str = re.sub(emoji,r"\g<1>",str)
-    
-    usermatches = user.finditer(str)
-    
-    for match in usermatches:
-        str = str.replace(f"<@{match.group(1)}>", rename_user(match.group(1), '(user id here, no match)'))
-        str = str.replace(f"<@!{match.group(1)}>", rename_user(match.group(1), '(user id here, no match)'))
-        
-    return str
+    return scrubber.scrub(str)
             
     
@@ -0,0 +1,101 @@
+import time
+import random
+import logging
+from array import array
+from collections import OrderedDict
+
+from helpers import queries
+
+logger = logging.getLogger('helpers')
+
+class QuoteIdIndex:
+    """Sorted quote IDs for each scope we've been asked about (a guild, some authors, both, or everything).
+
+    Picking a random quote is then a random index into the array and a primary key lookup,
+    rather than ORDER BY random() sorting every matching row. Every ID in a scope is equally
+    likely to come up. Arrays are loaded on first use, appended to as quotes are saved,
+    and thrown away after `ttl` seconds in case something else touched the table."""
+
+    def __init__(self, max_scopes: int = 256, ttl: int = 600):
+        self.max_scopes = max_scopes
+        self.ttl = ttl
+        self.scopes: OrderedDict[tuple, tuple[float, array]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(gid: int = None, uid=None):
+        if uid is None or (not isinstance(uid, int) and len(uid) == 0):
+            uids = None
+        elif isinstance(uid, int):
+            uids = (uid,)
+        else:
+            uids = tuple(sorted(set(int(u) for u in uid)))
+        return (int(gid) if gid else None, uids)
+
+    async def load(self, key: tuple):
+        gid, uids = key
+        shape, conditions, params = queries.quote_filter(gid, uids)
+        rows = await queries.query(f"quote_ids[{shape}]", f"SELECT id FROM bot.quotes{queries.where(conditions)} ORDER BY id").fetchall(params)
+        return array('q', (row[0] for row in rows))
+
+    async def ids(self, gid: int = None, uid=None):
+        key = self.scope(gid, uid)
+        cached = self.scopes.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            self.hits += 1
+            self.scopes.move_to_end(key)
+            return cached[1]
+
+        self.misses += 1
+        ids = await self.load(key)
+        self.scopes[key] = (time.monotonic(), ids)
+        self.scopes.move_to_end(key)
+        while len(self.scopes) > self.max_scopes:
+            self.scopes.popitem(last=False)
+        return ids
+
+    def peek(self, gid: int = None, uid=None):
+        """A scope's IDs if they're already loaded and fresh, without going to the database."""
+        cached = self.scopes.get(self.scope(gid, uid))
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+
+    async def pick(self, gid: int = None, uid=None):
+        ids = await self.ids(gid, uid)
+        if len(ids) == 0:
+            return None
+        return ids[random.randrange(len(ids))]
+
+    def add(self, gid: int, authorid: int, qid: int):
+        """A quote was just saved; put it into every cached scope it belongs to."""
+        for (sgid, suids), (_, ids) in self.scopes.items():
+            if sgid is not None and sgid != int(gid):
+                continue
+            if suids is not None and int(authorid) not in suids:
+                continue
+            # IDs come from a sequence, so appending keeps the array sorted
+            if len(ids) == 0 or ids[-1] < qid:
+                ids.append(qid)
+
+    def forget(self, gid: int = None, uid=None):
+        """Drop cached scopes for a guild (or everything) so they get reloaded next time.
+        With `uid`, just the one scope for that guild (or every guild) and author(s)."""
+        if uid is not None:
+            self.scopes.pop(self.scope(gid, uid), None)
+            return
+        if gid is None:
+            self.scopes.clear()
+            return
+        for key in [k for k in self.scopes if k[0] is None or k[0] == int(gid)]:
+            del self.scopes[key]
+
+    def stats(self):
+        return {
+            "scopes": len(self.scopes),
+            "ids": sum(len(ids) for _, ids in self.scopes.values()),
+            "bytes": sum(ids.itemsize * len(ids) for _, ids in self.scopes.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
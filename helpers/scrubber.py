@@ -0,0 +1,79 @@
+import re
+from datetime import datetime, timezone
+
+# Every bit of Discord markup we know how to flatten, in one pattern so a quote is scanned once
+markup = re.compile(r"""<(?:
+    @!?(?P<user>\d+)                            # <@123> or <@!123>
+    | @&(?P<role>\d+)                           # <@&123>
+    | \#(?P<channel>\d+)                        # <#123>
+    | a?(?P<emoji>:\w+:)\d+                     # <:name:123> or <a:name:123>
+    | t:(?P<timestamp>-?\d+)(?::(?P<style>[tTdDfFR]))?   # <t:1700000000:F>
+)>""", re.VERBOSE)
+
+# Discord's timestamp styles, written out as plain text. Relative ones (R) don't mean much
+# once they've left Discord, so they get the date
+timestamp_formats = {
+    't': "%H:%M UTC",
+    'T': "%H:%M:%S UTC",
+    'd': "%d/%m/%Y",
+    'D': "%B %d, %Y",
+    'f': "%B %d, %Y %H:%M UTC",
+    'F': "%A, %B %d, %Y %H:%M UTC",
+    'R': "%B %d, %Y",
+}
+
+def format_timestamp(seconds: int, style: str = None):
+    try:
+        date = datetime.fromtimestamp(seconds, tz=timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        return None
+    return date.strftime(timestamp_formats[style or 'f'])
+
+class Scrubber:
+    """Turns Discord markup into plain text for posting outside Discord: mentions become
+    the names in `users` (user ID -> name), custom emoji become their :name:, and
+    timestamps become dates. Roles and channels only get names if they're given.
+
+    `users` is used as it is, not copied, so a dict that's kept up to date elsewhere
+    (like UserPrefs.aliases) keeps the names current."""
+
+    def __init__(self, users: dict = None, roles: dict = None, channels: dict = None, fallback: str = '(user id here, no match)'):
+        self.users: dict[int, str] = users if users is not None else {}
+        self.roles: dict[int, str] = {int(k): v for k, v in (roles or {}).items()}
+        self.channels: dict[int, str] = {int(k): v for k, v in (channels or {}).items()}
+        self.fallback = fallback
+
+    def rename(self, uid, fallback: str):
+        if uid is None:
+            return fallback
+        return self.users.get(int(uid), fallback)
+
+    def replace(self, match: re.Match):
+        kind = match.lastgroup if match.lastgroup != 'style' else 'timestamp'
+        value = match.group(kind)
+        match kind:
+            case 'user':
+                return self.users.get(int(value), self.fallback)
+            case 'role':
+                return '@' + self.roles.get(int(value), 'role')
+            case 'channel':
+                return '#' + self.channels.get(int(value), 'channel')
+            case 'emoji':
+                return value
+            case 'timestamp':
+                return format_timestamp(int(value), match.group('style')) or match.group(0)
+
+    def scrub(self, text: str):
+        if '<' not in text:
+            return text
+        return markup.sub(self.replace, text)
+
+    def scrub_many(self, texts):
+        """scrub() for a whole batch of quotes, in one pass over them all."""
+        texts = list(texts)
+        # Joined on a character Discord never lets into a message, so there's one
+        # regex call for the batch instead of one per quote
+        joined = '\0'.join(texts)
+        if joined.count('\0') != len(texts) - 1:
+            return [self.scrub(text) for text in texts]
+        return markup.sub(self.replace, joined).split('\0') if texts else []
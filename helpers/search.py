@@ -0,0 +1,100 @@
+import logging
+
+import psycopg
+
+from helpers import database, queries
+from helpers.queries import quote_columns as columns
+
+logger = logging.getLogger('helpers')
+
+trigram_check = queries.query("search_has_trigrams", "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+set_timeout = queries.query("search_timeout", "SELECT set_config('statement_timeout', %(timeout)s, true)")
+
+class QuoteSearch:
+    """Finds quotes by what they say.
+
+    Whole words go through the full text index (bot.quotes.search, see 006_quote_search.sql)
+    and are ranked by how well they match. When that turns up nothing - partial words,
+    names, or a search made entirely of stopwords - we fall back to a substring match,
+    ranked by trigram similarity if pg_trgm is installed.
+
+    Ranking only looks at the first `max_candidates` matches, and every search gets
+    `timeout_ms` to finish, so a very common word can't tie up a connection."""
+
+    def __init__(self, max_candidates: int = 1000, timeout_ms: int = 2000):
+        self.max_candidates = max_candidates
+        self.timeout_ms = timeout_ms
+        self.trigrams: bool | None = None
+
+        self.searches = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+
+    async def has_trigrams(self, con):
+        if self.trigrams is None:
+            self.trigrams = await trigram_check.fetchone(con=con) is not None
+        return self.trigrams
+
+    async def fulltext(self, con, params, shape, conditions):
+        return await queries.query(f"search_fulltext[{shape}]", f'''SELECT {columns} FROM (
+                SELECT {columns}, ts_rank_cd(search, query) AS rank
+                FROM bot.quotes, websearch_to_tsquery('english', %(text)s) query
+                {queries.where(conditions, 'search @@ query')}
+                LIMIT %(candidates)s
+            ) matches ORDER BY rank DESC, id LIMIT %(limit)s OFFSET %(offset)s''').fetchall(params, con=con)
+
+    async def substring(self, con, params, shape, conditions):
+        params['pattern'] = '%' + params['text'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if await self.has_trigrams(con):
+            order = "similarity(content, %(text)s) DESC, id"
+        else:
+            order = "id DESC"
+        return await queries.query(f"search_substring[{shape}]{' trigram' if self.trigrams else ''}", f'''SELECT {columns} FROM (
+                SELECT {columns} FROM bot.quotes
+                {queries.where(conditions, 'content ILIKE %(pattern)s')}
+                LIMIT %(candidates)s
+            ) matches ORDER BY {order} LIMIT %(limit)s OFFSET %(offset)s''').fetchall(params, con=con)
+
+    async def search(self, text: str, gid: int = None, uid: int = None, limit: int = 10, offset: int = 0, mode: str = None):
+        """Returns (mode, rows). Pass the mode back in when asking for the next page, so
+        every page of a search comes from the same kind of match."""
+        text = text.strip()
+        if not text:
+            raise LookupError("You'll need to give me something to search for!")
+
+        shape, conditions, params = queries.quote_filter(gid, uid)
+        params.update({
+            "text": text,
+            "limit": limit,
+            "offset": offset,
+            "candidates": self.max_candidates,
+        })
+
+        self.searches += 1
+        try:
+            async with database.connection() as con:
+                # Only for this transaction, so the connection goes back to the pool as it was
+                await set_timeout.execute(con, {"timeout": str(int(self.timeout_ms))})
+                if mode != "substring":
+                    rows = await self.fulltext(con, params, shape, conditions)
+                    if rows or mode == "fulltext":
+                        return "fulltext", rows
+                    if offset > 0:
+                        # A later page asked for without its mode: only fall back if page one would have
+                        first = await self.fulltext(con, {**params, "limit": 1, "offset": 0}, shape, conditions)
+                        if first:
+                            return "fulltext", rows
+                self.fallbacks += 1
+                return "substring", await self.substring(con, params, shape, conditions)
+        except psycopg.errors.QueryCanceled:
+            self.timeouts += 1
+            logger.warning(f"Search: '{text}' took longer than {self.timeout_ms}ms")
+            raise LookupError("That search took too long - try something more specific.")
+
+    def stats(self):
+        return {
+            "searches": self.searches,
+            "substring_fallbacks": self.fallbacks,
+            "timeouts": self.timeouts,
+            "trigrams": self.trigrams,
+        }
@@ -0,0 +1,4 @@
+-- Let the random quote picker (helpers/randompick.py) load a scope's quote IDs
+-- straight out of an index instead of scanning the whole table
+CREATE INDEX IF NOT EXISTS quotes_guild_id_idx ON bot.quotes (guild, id);
+CREATE INDEX IF NOT EXISTS quotes_authorid_guild_id_idx ON bot.quotes (authorid, guild, id);
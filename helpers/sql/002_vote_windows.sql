@@ -0,0 +1,13 @@
+-- Quotes that are currently open for voting, so the windows survive a reboot
+CREATE TABLE IF NOT EXISTS bot.vote_windows (
+    msgid bigint PRIMARY KEY,
+    channelid bigint NOT NULL,
+    guild bigint,
+    quoteid bigint NOT NULL,
+    karma integer NOT NULL,
+    up integer NOT NULL DEFAULT 0,
+    down integer NOT NULL DEFAULT 0,
+    embed jsonb NOT NULL,
+    closes_at timestamptz NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vote_windows_closes_at_idx ON bot.vote_windows (closes_at);
@@ -0,0 +1,15 @@
+-- Checkpoints for background stampfinder runs, one per channel
+CREATE TABLE IF NOT EXISTS bot.stampfinder_jobs (
+    channelid bigint PRIMARY KEY,
+    guild bigint NOT NULL,
+    status text NOT NULL DEFAULT 'running', -- running, paused, done or failed
+    last_msgid bigint,
+    last_timestamp bigint,
+    messages bigint NOT NULL DEFAULT 0,
+    hits integer NOT NULL DEFAULT 0,
+    total integer NOT NULL DEFAULT 0,
+    error text,
+    reportchannelid bigint,
+    started_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
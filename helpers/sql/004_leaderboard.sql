@@ -0,0 +1,102 @@
+-- Per-guild leaderboard totals, kept up to date by triggers on bot.quotes.
+-- A guild is only tracked once it's listed in leaderboard_guilds, which happens
+-- the first time its leaderboard is built (see helpers/leaderboard.py)
+CREATE TABLE IF NOT EXISTS bot.leaderboard (
+    guild bigint NOT NULL,
+    userid bigint NOT NULL,
+    quotes integer NOT NULL DEFAULT 0,
+    karma bigint NOT NULL DEFAULT 0, -- sum of karma over this user's quotes
+    saves integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild, userid)
+);
+
+CREATE TABLE IF NOT EXISTS bot.leaderboard_guilds (
+    guild bigint PRIMARY KEY,
+    refreshed_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION bot.leaderboard_track() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND EXISTS (SELECT 1 FROM bot.leaderboard_guilds WHERE guild = OLD.guild) THEN
+        IF OLD.authorid IS NOT NULL THEN
+            UPDATE bot.leaderboard SET quotes = quotes - 1, karma = karma - coalesce(OLD.karma, 0)
+                WHERE guild = OLD.guild AND userid = OLD.authorid;
+        END IF;
+        IF OLD.addedby IS NOT NULL THEN
+            UPDATE bot.leaderboard SET saves = saves - 1
+                WHERE guild = OLD.guild AND userid = OLD.addedby;
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND EXISTS (SELECT 1 FROM bot.leaderboard_guilds WHERE guild = NEW.guild) THEN
+        IF NEW.authorid IS NOT NULL THEN
+            INSERT INTO bot.leaderboard AS l (guild, userid, quotes, karma) VALUES (NEW.guild, NEW.authorid, 1, coalesce(NEW.karma, 0))
+                ON CONFLICT (guild, userid) DO UPDATE SET quotes = l.quotes + 1, karma = l.karma + EXCLUDED.karma;
+        END IF;
+        IF NEW.addedby IS NOT NULL THEN
+            INSERT INTO bot.leaderboard AS l (guild, userid, saves) VALUES (NEW.guild, NEW.addedby, 1)
+                ON CONFLICT (guild, userid) DO UPDATE SET saves = l.saves + 1;
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Inserts and deletes are counted a statement at a time, so a bulk import touches
+-- each user's row once instead of once per quote
+CREATE OR REPLACE FUNCTION bot.leaderboard_track_inserts() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bot.leaderboard AS l (guild, userid, quotes, karma, saves)
+        SELECT guild, userid, sum(quotes), sum(karma), sum(saves) FROM (
+            SELECT guild, authorid AS userid, 1 AS quotes, coalesce(karma, 0) AS karma, 0 AS saves FROM new_rows WHERE authorid IS NOT NULL
+            UNION ALL
+            SELECT guild, addedby, 0, 0, 1 FROM new_rows WHERE addedby IS NOT NULL
+        ) changes
+        WHERE guild IN (SELECT guild FROM bot.leaderboard_guilds)
+        GROUP BY guild, userid
+        ON CONFLICT (guild, userid) DO UPDATE SET
+            quotes = l.quotes + EXCLUDED.quotes,
+            karma = l.karma + EXCLUDED.karma,
+            saves = l.saves + EXCLUDED.saves;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot.leaderboard_track_deletes() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot.leaderboard AS l SET
+            quotes = l.quotes - d.quotes,
+            karma = l.karma - d.karma,
+            saves = l.saves - d.saves
+        FROM (
+            SELECT guild, userid, sum(quotes) AS quotes, sum(karma) AS karma, sum(saves) AS saves FROM (
+                SELECT guild, authorid AS userid, 1 AS quotes, coalesce(karma, 0) AS karma, 0 AS saves FROM old_rows WHERE authorid IS NOT NULL
+                UNION ALL
+                SELECT guild, addedby, 0, 0, 1 FROM old_rows WHERE addedby IS NOT NULL
+            ) changes GROUP BY guild, userid
+        ) d
+        WHERE l.guild = d.guild AND l.userid = d.userid;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS leaderboard_track_rows ON bot.quotes;
+
+DROP TRIGGER IF EXISTS leaderboard_track_inserts ON bot.quotes;
+CREATE TRIGGER leaderboard_track_inserts AFTER INSERT ON bot.quotes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot.leaderboard_track_inserts();
+
+DROP TRIGGER IF EXISTS leaderboard_track_deletes ON bot.quotes;
+CREATE TRIGGER leaderboard_track_deletes AFTER DELETE ON bot.quotes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot.leaderboard_track_deletes();
+
+DROP TRIGGER IF EXISTS leaderboard_track_changes ON bot.quotes;
+CREATE TRIGGER leaderboard_track_changes AFTER UPDATE OF guild, authorid, addedby, karma ON bot.quotes
+    FOR EACH ROW WHEN (OLD.guild IS DISTINCT FROM NEW.guild
+        OR OLD.authorid IS DISTINCT FROM NEW.authorid
+        OR OLD.addedby IS DISTINCT FROM NEW.addedby
+        OR OLD.karma IS DISTINCT FROM NEW.karma)
+    EXECUTE FUNCTION bot.leaderboard_track();
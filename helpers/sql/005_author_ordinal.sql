@@ -0,0 +1,3 @@
+-- The nth quote by an author across every server (/quote/user/{id}?id=N), walked
+-- in id order straight off the index
+CREATE INDEX IF NOT EXISTS quotes_authorid_id_idx ON bot.quotes (authorid, id);
@@ -0,0 +1,23 @@
+-- Full text search over quote content (helpers/search.py). The tsvector is a stored
+-- generated column, so it's kept up to date without any help from the bot
+ALTER TABLE bot.quotes ADD COLUMN IF NOT EXISTS search tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED;
+CREATE INDEX IF NOT EXISTS quotes_search_idx ON bot.quotes USING GIN (search);
+
+-- Trigrams make partial-word (ILIKE '%...%') searches indexable too. Not every
+-- server has pg_trgm or lets us install it, and search still works without it
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available, partial-word quote search will not be indexed';
+END
+$$;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        CREATE INDEX IF NOT EXISTS quotes_content_trgm_idx ON bot.quotes USING GIN (content gin_trgm_ops);
+    END IF;
+END
+$$;
@@ -0,0 +1,6 @@
+-- /quote top reads quotes best-first, a page at a time (helpers/quoting.py top_quotes).
+-- Quotes with no karma count as 0, so the indexes are on coalesce(karma, 0) to match
+DROP INDEX IF EXISTS bot.quotes_guild_karma_idx;
+DROP INDEX IF EXISTS bot.quotes_guild_author_karma_idx;
+CREATE INDEX IF NOT EXISTS quotes_guild_karma0_idx ON bot.quotes (guild, (coalesce(karma, 0)) DESC, id);
+CREATE INDEX IF NOT EXISTS quotes_guild_author_karma0_idx ON bot.quotes (guild, authorid, (coalesce(karma, 0)) DESC, id);
@@ -0,0 +1,109 @@
+-- Per-guild counts of quotes and of quotes missing details, for /quote sanity.
+-- Kept up to date by triggers; global figures are the sum over every guild.
+-- Quotes with no guild are counted under guild 0.
+DO $$
+BEGIN
+    IF to_regclass('bot.quote_stats') IS NULL THEN
+        CREATE TABLE bot.quote_stats (
+            guild bigint PRIMARY KEY,
+            total bigint NOT NULL DEFAULT 0,
+            nullstamps bigint NOT NULL DEFAULT 0,
+            nullsource bigint NOT NULL DEFAULT 0,
+            nullids bigint NOT NULL DEFAULT 0
+        );
+        -- Hold off writers until the triggers below exist, so nothing slips between the two
+        LOCK TABLE bot.quotes IN SHARE ROW EXCLUSIVE MODE;
+        INSERT INTO bot.quote_stats (guild, total, nullstamps, nullsource, nullids)
+            SELECT coalesce(guild, 0), count(*),
+                count(*) FILTER (WHERE timestamp IS NULL),
+                count(*) FILTER (WHERE source IS NULL),
+                count(*) FILTER (WHERE msgid IS NULL)
+            FROM bot.quotes GROUP BY coalesce(guild, 0);
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION bot.quote_stats_track() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE bot.quote_stats SET
+            total = total - 1,
+            nullstamps = nullstamps - (OLD.timestamp IS NULL)::int,
+            nullsource = nullsource - (OLD.source IS NULL)::int,
+            nullids = nullids - (OLD.msgid IS NULL)::int
+        WHERE guild = coalesce(OLD.guild, 0);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO bot.quote_stats AS s (guild, total, nullstamps, nullsource, nullids)
+            VALUES (coalesce(NEW.guild, 0), 1, (NEW.timestamp IS NULL)::int, (NEW.source IS NULL)::int, (NEW.msgid IS NULL)::int)
+            ON CONFLICT (guild) DO UPDATE SET
+                total = s.total + 1,
+                nullstamps = s.nullstamps + EXCLUDED.nullstamps,
+                nullsource = s.nullsource + EXCLUDED.nullsource,
+                nullids = s.nullids + EXCLUDED.nullids;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Inserts and deletes are counted a statement at a time, so a bulk import updates
+-- each guild's row once instead of once per quote
+CREATE OR REPLACE FUNCTION bot.quote_stats_track_inserts() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bot.quote_stats AS s (guild, total, nullstamps, nullsource, nullids)
+        SELECT coalesce(guild, 0), count(*),
+            count(*) FILTER (WHERE timestamp IS NULL),
+            count(*) FILTER (WHERE source IS NULL),
+            count(*) FILTER (WHERE msgid IS NULL)
+        FROM new_rows GROUP BY coalesce(guild, 0)
+        ON CONFLICT (guild) DO UPDATE SET
+            total = s.total + EXCLUDED.total,
+            nullstamps = s.nullstamps + EXCLUDED.nullstamps,
+            nullsource = s.nullsource + EXCLUDED.nullsource,
+            nullids = s.nullids + EXCLUDED.nullids;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot.quote_stats_track_deletes() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot.quote_stats AS s SET
+            total = s.total - d.total,
+            nullstamps = s.nullstamps - d.nullstamps,
+            nullsource = s.nullsource - d.nullsource,
+            nullids = s.nullids - d.nullids
+        FROM (
+            SELECT coalesce(guild, 0) AS guild, count(*) AS total,
+                count(*) FILTER (WHERE timestamp IS NULL) AS nullstamps,
+                count(*) FILTER (WHERE source IS NULL) AS nullsource,
+                count(*) FILTER (WHERE msgid IS NULL) AS nullids
+            FROM old_rows GROUP BY coalesce(guild, 0)
+        ) d
+        WHERE s.guild = d.guild;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS quote_stats_insert_delete ON bot.quotes;
+
+DROP TRIGGER IF EXISTS quote_stats_inserts ON bot.quotes;
+CREATE TRIGGER quote_stats_inserts AFTER INSERT ON bot.quotes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot.quote_stats_track_inserts();
+
+DROP TRIGGER IF EXISTS quote_stats_deletes ON bot.quotes;
+CREATE TRIGGER quote_stats_deletes AFTER DELETE ON bot.quotes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot.quote_stats_track_deletes();
+
+DROP TRIGGER IF EXISTS quote_stats_update ON bot.quotes;
+CREATE TRIGGER quote_stats_update
+    AFTER UPDATE OF guild, timestamp, source, msgid ON bot.quotes
+    FOR EACH ROW
+    WHEN (OLD.guild IS DISTINCT FROM NEW.guild
+        OR (OLD.timestamp IS NULL) <> (NEW.timestamp IS NULL)
+        OR (OLD.source IS NULL) <> (NEW.source IS NULL)
+        OR (OLD.msgid IS NULL) <> (NEW.msgid IS NULL))
+    EXECUTE FUNCTION bot.quote_stats_track();
@@ -0,0 +1,34 @@
+-- A Discord message can only be saved as a quote once. insert_quote relies on this
+-- index for ON CONFLICT, so saving is a single statement with no race between
+-- checking for a duplicate and inserting.
+DO $$
+DECLARE
+    moved integer;
+BEGIN
+    IF to_regclass('bot.quotes_msgid_key') IS NULL THEN
+        -- Two people saving the same message at once used to be able to get both
+        -- saves through. The first save of each message stays; the others are moved
+        -- (karma and all) to bot.quotes_duplicates, with kept_id pointing at the one
+        -- that stayed, for the owner to look over and put back if they want
+        CREATE TABLE IF NOT EXISTS bot.quotes_duplicates (
+            LIKE bot.quotes,
+            kept_id bigint NOT NULL,
+            archived_at timestamptz NOT NULL DEFAULT now()
+        );
+
+        WITH firsts AS (
+            SELECT msgid, min(id) AS id FROM bot.quotes WHERE msgid IS NOT NULL GROUP BY msgid HAVING count(*) > 1
+        ), archived AS (
+            INSERT INTO bot.quotes_duplicates
+                SELECT q.*, firsts.id, now() FROM bot.quotes q JOIN firsts ON q.msgid = firsts.msgid AND q.id > firsts.id
+                RETURNING id
+        )
+        DELETE FROM bot.quotes WHERE id IN (SELECT id FROM archived);
+        GET DIAGNOSTICS moved = ROW_COUNT;
+        IF moved > 0 THEN
+            RAISE WARNING 'Moved % duplicate saves of the same message to bot.quotes_duplicates', moved;
+        END IF;
+        CREATE UNIQUE INDEX quotes_msgid_key ON bot.quotes (msgid) WHERE msgid IS NOT NULL;
+    END IF;
+END
+$$;
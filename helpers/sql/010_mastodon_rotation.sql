@@ -0,0 +1,11 @@
+-- mastoposter.py works through a guild's quotes in a shuffled order, one per post,
+-- and only reshuffles once every quote has had its turn. `ids` is the current bag,
+-- `position` how far through it we are, and `excluded` the exclude_users list the
+-- bag was built with, so changes to it can be picked up
+CREATE TABLE IF NOT EXISTS bot.mastodon_rotation (
+    guild bigint PRIMARY KEY,
+    ids bigint[] NOT NULL DEFAULT '{}',
+    position integer NOT NULL DEFAULT 0,
+    excluded bigint[] NOT NULL DEFAULT '{}',
+    shuffled_at timestamptz NOT NULL DEFAULT now()
+);
@@ -0,0 +1,36 @@
+-- Posts waiting to go out to Mastodon: scheduled ones picked from the rotation
+-- (see 010_mastodon_rotation.sql) and new quotes as they're saved. A row stays
+-- pending until posted_at or failed_at is set; next_attempt_at is when it's next
+-- due, pushed back after every failed attempt. The id doubles as the Idempotency-Key
+-- sent with the post, so a retry after a lost response can't post twice
+CREATE TABLE IF NOT EXISTS bot.mastodon_outbox (
+    id bigserial PRIMARY KEY,
+    kind text NOT NULL, -- 'scheduled' or 'new_quote'
+    guild bigint NOT NULL,
+    quote_id bigint NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    next_attempt_at timestamptz NOT NULL DEFAULT now(),
+    attempts integer NOT NULL DEFAULT 0,
+    last_error text,
+    posted_at timestamptz,
+    failed_at timestamptz,
+    status_id text -- Mastodon's id for the post
+);
+
+CREATE INDEX IF NOT EXISTS mastodon_outbox_due_idx ON bot.mastodon_outbox (next_attempt_at)
+    WHERE posted_at IS NULL AND failed_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS mastodon_outbox_scheduled_idx ON bot.mastodon_outbox (guild, created_at)
+    WHERE kind = 'scheduled';
+
+-- So a poster in another process (mastoposter.py) hears about new posts straight away
+CREATE OR REPLACE FUNCTION bot.mastodon_outbox_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('mastodon_outbox', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS mastodon_outbox_notify ON bot.mastodon_outbox;
+CREATE TRIGGER mastodon_outbox_notify AFTER INSERT ON bot.mastodon_outbox
+    FOR EACH ROW EXECUTE FUNCTION bot.mastodon_outbox_notify();
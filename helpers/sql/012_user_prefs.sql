@@ -0,0 +1,25 @@
+-- Per-user settings, moved out of config.yaml (mastodon.exclude_users and
+-- mappings.users, which are only used to fill this table in the first time).
+-- Every process keeps all of it in memory (see helpers/prefs.py) and hears about
+-- changes through NOTIFY, with the new values in the payload
+CREATE TABLE IF NOT EXISTS bot.user_prefs (
+    userid bigint PRIMARY KEY,
+    mastodon_exclude boolean NOT NULL DEFAULT false, -- don't post their quotes to Mastodon
+    mastodon_alias text, -- what to call them in Mastodon posts
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION bot.user_prefs_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('user_prefs', json_build_object('userid', OLD.userid, 'mastodon_exclude', false, 'mastodon_alias', null)::text);
+    ELSE
+        PERFORM pg_notify('user_prefs', json_build_object('userid', NEW.userid, 'mastodon_exclude', NEW.mastodon_exclude, 'mastodon_alias', NEW.mastodon_alias)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_prefs_notify ON bot.user_prefs;
+CREATE TRIGGER user_prefs_notify AFTER INSERT OR UPDATE OR DELETE ON bot.user_prefs
+    FOR EACH ROW EXECUTE FUNCTION bot.user_prefs_notify();
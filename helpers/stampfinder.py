@@ -0,0 +1,370 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+
+import discord
+from psycopg.rows import dict_row
+
+from helpers import database, queries
+from helpers.quoting import quote_cache
+
+logger = logging.getLogger('helpers')
+
+def normalize(text: str):
+    # Ignore differences in case and whitespace when matching quotes to messages
+    return " ".join(text.split()).casefold()
+
+class Automaton:
+    """Aho-Corasick automaton: finds every added pattern inside a text in one pass over it."""
+
+    def __init__(self):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.out: list[list] = [[]]
+
+    def add(self, pattern: str, value):
+        state = 0
+        for char in pattern:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = nxt
+        self.out[state].append(value)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(char, 0)
+                # Anything that ends where the fallback state ends also ends here
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text: str):
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.out[state]:
+                yield from self.out[state]
+
+class PendingQuotes:
+    """The quotes stampfinder is still looking for, indexed so each message is checked once
+    against all of them instead of once per quote."""
+
+    def __init__(self, rows):
+        # rows are (id, content, authorid)
+        self.quotes: dict[int, tuple[str, int]] = {}
+        self.exact: dict[tuple[int, str], list[int]] = {}
+        self.automaton = Automaton()
+
+        for qid, content, authorid in rows:
+            text = normalize(content or "")
+            if not text:
+                continue # An empty quote would match every message
+            self.quotes[qid] = (text, int(authorid))
+            self.exact.setdefault((int(authorid), text), []).append(qid)
+            self.automaton.add(text, qid)
+        self.automaton.build()
+
+    def __len__(self):
+        return len(self.quotes)
+
+    def match(self, message):
+        """Quote IDs this message is the source of, removing them from the index."""
+        found = []
+        content = normalize(message.content)
+
+        # Exactly what they said
+        for qid in self.exact.get((message.author.id, content), []):
+            if qid in self.quotes:
+                found.append(qid)
+
+        # Said somewhere within the message
+        for qid in self.automaton.search(content):
+            if qid in self.quotes and self.quotes[qid][1] == message.author.id and qid not in found:
+                found.append(qid)
+
+        # Said by someone mentioned in the message (e.g. 'Bucket, addquote @someone ...')
+        if message.raw_mentions:
+            mentions = set(message.raw_mentions)
+            for qid in self.automaton.search(normalize(message.clean_content)):
+                if qid in self.quotes and self.quotes[qid][1] in mentions and qid not in found:
+                    found.append(qid)
+
+        for qid in found:
+            self.remove(qid)
+        return found
+
+    def remove(self, qid: int):
+        text, authorid = self.quotes.pop(qid)
+        self.exact[(authorid, text)].remove(qid)
+
+pending_query = queries.query("stampfinder_pending", "SELECT id,content,authorid FROM bot.quotes WHERE guild = %(gid)s AND authorID is not NULL AND (timestamp IS NULL OR addedby is NULL) ORDER BY id ASC")
+pending_resumed_query = queries.query("stampfinder_pending[resumed]", "SELECT id,content,authorid FROM bot.quotes WHERE guild = %(gid)s AND authorID is not NULL AND (timestamp IS NULL OR addedby is NULL) AND msgID IS NULL ORDER BY id ASC")
+
+async def load_pending(gid: int, resuming: bool = False):
+    # When picking a job back up, anything that already got a message ID was found earlier
+    # in this job (most never get an addedby, so it'd otherwise still look pending), and
+    # that older match is the one we want: matching it again against later messages would
+    # overwrite it. Those quotes are counted in the job's hits already
+    return await (pending_resumed_query if resuming else pending_query).fetchall({"gid": gid})
+
+save_stamp_query = queries.query("stampfinder_save_stamp", "UPDATE bot.quotes SET msgID= %s, timestamp= %s, updatedAt= %s, addedby = COALESCE(%s, addedby), source = %s WHERE ID= %s AND (timestamp IS NULL OR source IS NULL OR msgID IS NULL OR addedby IS NULL)")
+checkpoint_query = queries.query("stampfinder_checkpoint", "UPDATE bot.stampfinder_jobs SET last_msgid = %s, last_timestamp = %s, messages = %s, hits = %s, total = %s, updated_at = now() WHERE channelid = %s")
+
+async def save_stamps(stamps: list[tuple]):
+    """Write found message info for a batch of quotes, skipping any that got theirs in the meantime."""
+    await save_stamp_query.executemany(stamps)
+
+class Stampfinder:
+    """Walks a channel's history once, matching messages against PendingQuotes and
+    saving what it finds every `batch_size` hits.
+
+    `history` can be anything that async-iterates message-like objects, and `writer`
+    anything that takes a list of update rows, so this runs fine without Discord or a database."""
+
+    def __init__(self, pending: PendingQuotes, bot_id: int, batch_size: int = 50, checkpoint_every: int = 1000, writer=save_stamps):
+        self.pending = pending
+        self.bot_id = bot_id
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self.writer = writer
+        self.total = len(pending)
+        self.batch: list[tuple] = []
+        self.last_message = None
+
+        self.messages = 0
+        self.hits = 0
+        self.scanned = 0 # messages looked at this run, for the rate
+        self.started = None
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        # messages per second
+        return self.scanned / self.elapsed if self.elapsed else 0.0
+
+    def check(self, message):
+        if message.author.id == self.bot_id:
+            return # Don't add confirmation messages from Sanford as the message ID itself
+        elif message.content.startswith('b!addquote'):
+            return # Pre-Bucket/Sanford string circa 2016
+            # This basically means we tried to add it from IRC or another prior network
+            # Ergo, this is not a timestamp we want
+
+        for qid in self.pending.match(message):
+            logger.info(f"Stampfinder: Found quote ID {qid} in msg ID {message.id} timestamp {message.created_at.strftime('%Y-%m-%d %H:%M:%S.%f %z')}")
+
+            addedby = None
+            if message.content.startswith('Bucket, addquote') or message.content.startswith('//addquote'):
+                addedby = message.author.id
+
+            self.batch.append((
+                message.id,
+                int(datetime.timestamp(message.created_at)),
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f %z"),
+                addedby,
+                message.jump_url,
+                qid,
+            ))
+            self.hits += 1
+
+    async def commit(self):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            await self.writer(batch)
+
+    async def run(self, history, on_progress=None, progress_every: int = 1000):
+        self.started = time.perf_counter()
+        async for message in history:
+            self.messages += 1
+            self.scanned += 1
+            self.check(message)
+            self.last_message = message
+
+            if len(self.batch) >= self.batch_size or self.scanned % self.checkpoint_every == 0:
+                await self.commit()
+            if on_progress is not None and self.messages % progress_every == 0:
+                self.elapsed = time.perf_counter() - self.started
+                await on_progress(self, message)
+            if not len(self.pending):
+                break # Found everything, no point reading further
+
+        await self.commit()
+        self.elapsed = time.perf_counter() - self.started
+        logger.info(f"Stampfinder: {self.hits}/{self.total} found in {self.messages} messages ({self.rate:.1f} msgs/sec)")
+        return self.hits
+
+class RateBudget:
+    """Token bucket shared by every running job, so together they read at most `rate` messages a second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class StampfinderJob(Stampfinder):
+    """A Stampfinder that runs in the background and checkpoints to bot.stampfinder_jobs.
+
+    Every commit writes the stamps found so far and the last message scanned in the same
+    transaction, so a crash or reboot loses at most one batch and the job carries on with
+    history(after=...) from the checkpoint."""
+
+    def __init__(self, channel, row, pending: PendingQuotes, bot_id: int, budget: RateBudget):
+        super().__init__(pending, bot_id)
+        self.channel = channel
+        self.budget = budget
+        self.last_msgid = row['last_msgid']
+        self.messages = row['messages']
+        self.hits = row['hits']
+        # Quotes already found don't come back in the index, so count them towards the total
+        self.total = len(pending) + row['hits']
+
+    async def commit(self):
+        batch, self.batch = self.batch, []
+        if self.last_message is not None:
+            self.last_msgid = self.last_message.id
+        async with database.connection() as con:
+            if batch:
+                await save_stamp_query.executemany(batch, con=con)
+            await checkpoint_query.run((
+                self.last_msgid,
+                int(datetime.timestamp(self.last_message.created_at)) if self.last_message is not None else None,
+                self.messages,
+                self.hits,
+                self.total,
+                self.channel.id,
+            ), con=con)
+        if batch:
+            # Those quotes' timestamps and sources just changed
+            quote_cache.forget(self.channel.guild.id)
+
+    async def history(self):
+        after = discord.Object(id=self.last_msgid) if self.last_msgid else None
+        async for message in self.channel.history(limit=None, oldest_first=True, after=after):
+            await self.budget.take()
+            yield message
+
+class StampfinderJobs:
+    """Runs stampfinder over several channels at once, resuming any that were interrupted."""
+
+    def __init__(self, bot: discord.Client, messages_per_second: float = 100, max_jobs: int = 3):
+        self.bot = bot
+        self.budget = RateBudget(messages_per_second)
+        self.slots = asyncio.Semaphore(max_jobs)
+        self.jobs: dict[int, StampfinderJob] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    def running(self, channelid: int):
+        return channelid in self.tasks and not self.tasks[channelid].done()
+
+    async def get(self, channelid: int):
+        async with database.connection() as con:
+            cur = con.cursor(row_factory=dict_row)
+            await cur.execute("SELECT * FROM bot.stampfinder_jobs WHERE channelid = %s", (channelid,))
+            return await cur.fetchone()
+
+    async def start(self, channel, reportchannelid: int = None):
+        """Start a job for this channel, or carry on with it if it never finished."""
+        if self.running(channel.id):
+            return self.jobs[channel.id]
+
+        row = await self.get(channel.id)
+        resuming = row is not None and row['status'] != 'done'
+        async with database.connection() as con:
+            if resuming:
+                await con.execute("UPDATE bot.stampfinder_jobs SET status = 'running', error = NULL, reportchannelid = COALESCE(%s, reportchannelid), updated_at = now() WHERE channelid = %s", (reportchannelid, channel.id))
+            else:
+                await con.execute("INSERT INTO bot.stampfinder_jobs (channelid, guild, reportchannelid) VALUES (%s, %s, %s) ON CONFLICT (channelid) DO UPDATE SET status = 'running', last_msgid = NULL, last_timestamp = NULL, messages = 0, hits = 0, total = 0, error = NULL, reportchannelid = EXCLUDED.reportchannelid, started_at = now(), updated_at = now()", (channel.id, channel.guild.id, reportchannelid))
+        row = await self.get(channel.id)
+
+        pending = PendingQuotes(await load_pending(channel.guild.id, resuming=resuming))
+        job = StampfinderJob(channel, row, pending, self.bot.user.id, self.budget)
+        self.jobs[channel.id] = job
+        self.tasks[channel.id] = asyncio.create_task(self.run(job, row['reportchannelid']))
+        logger.info(f"Stampfinder: {'resuming' if resuming else 'starting'} job for #{channel.name} ({len(pending)} quotes to find{', after msg ' + str(row['last_msgid']) if row['last_msgid'] else ''})")
+        return job
+
+    async def run(self, job: StampfinderJob, reportchannelid: int = None):
+        async with self.slots:
+            try:
+                await job.run(job.history())
+            except asyncio.CancelledError:
+                # Shutting down or paused; the last checkpoint is where we'll pick up again
+                raise
+            except Exception as error:
+                logger.error(f"Stampfinder: job for #{job.channel.name} failed")
+                logger.exception(error)
+                async with database.connection() as con:
+                    await con.execute("UPDATE bot.stampfinder_jobs SET status = 'failed', error = %s, updated_at = now() WHERE channelid = %s", (str(error), job.channel.id))
+                return
+
+        async with database.connection() as con:
+            await con.execute("UPDATE bot.stampfinder_jobs SET status = 'done', updated_at = now() WHERE channelid = %s", (job.channel.id,))
+
+        if reportchannelid:
+            report = self.bot.get_partial_messageable(reportchannelid)
+            await report.send(f"Done! Found sources for **{str(job.hits)}** out of {str(job.total)} quotes in **{str(job.messages)} messages** in <#{job.channel.id}> ({job.rate:.1f} messages/sec).")
+
+    async def pause(self, channelid: int):
+        if self.running(channelid):
+            self.tasks[channelid].cancel()
+        async with database.connection() as con:
+            await con.execute("UPDATE bot.stampfinder_jobs SET status = 'paused', updated_at = now() WHERE channelid = %s AND status = 'running'", (channelid,))
+
+    async def resume_all(self):
+        """Restart every job that was still running when the bot went down."""
+        async with database.connection() as con:
+            cur = await con.execute("SELECT channelid FROM bot.stampfinder_jobs WHERE status = 'running'")
+            channelids = [row[0] for row in await cur.fetchall()]
+
+        for channelid in channelids:
+            if self.running(channelid):
+                continue
+            try:
+                channel = self.bot.get_channel(channelid) or await self.bot.fetch_channel(channelid)
+                await self.start(channel)
+            except discord.HTTPException as error:
+                logger.error(f"Stampfinder: couldn't resume job for channel {channelid}: {error}")
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def status(self):
+        async with database.connection() as con:
+            cur = con.cursor(row_factory=dict_row)
+            await cur.execute("SELECT channelid, guild, status, last_msgid, last_timestamp, messages, hits, total, error, started_at, updated_at FROM bot.stampfinder_jobs ORDER BY started_at DESC")
+            rows = await cur.fetchall()
+
+        for row in rows:
+            job = self.jobs.get(row['channelid'])
+            live = job is not None and self.running(row['channelid'])
+            if live:
+                # Fresher than the last checkpoint
+                row['messages'], row['hits'] = job.messages, job.hits
+            row['messages_per_second'] = job.rate if live else None
+        return rows
@@ -1,5 +1,4 @@
 from datetime import datetime
-import psycopg2
 import discord
 from discord import ui
 
@@ -10,4 +9,55 @@ class UpdateQuote(ui.Modal, title="Update quote details"):
     author = ui.UserSelect(custom_id='authorselect', )
     content = ui.TextInput(label="Quoted text", required=True, style=discord.TextStyle.paragraph, custom_id="content")
     source = ui.TextInput(label="Quote Source (if applicable)", custom_id="source")
-    
\ No newline at end of file
+    
+class TopQuotesView(ui.View):
+    """Previous/next buttons for /quote top.
+
+    Pages are fetched by keyset rather than offset: we keep the (karma, id) cursor each
+    page started from, so going forward starts after the last quote on screen and going
+    back just fetches from the cursor before."""
+
+    def __init__(self, user: discord.abc.User, fetch, render, per_page: int = 5, timeout: float = 300):
+        super().__init__(timeout=timeout)
+        self.user = user
+        self.fetch = fetch # async (after, limit) -> rows
+        self.render = render # (rows, first rank on the page) -> discord.Embed
+        self.per_page = per_page
+        self.cursors = [None]
+        self.rows = []
+        self.message: discord.InteractionMessage | None = None
+
+    async def load(self):
+        # One extra, to see if there's another page after this one
+        rows = await self.fetch(self.cursors[-1], self.per_page + 1)
+        self.rows = rows[:self.per_page]
+        self.previous.disabled = len(self.cursors) == 1
+        self.next.disabled = len(rows) <= self.per_page
+        return self.render(self.rows, (len(self.cursors) - 1) * self.per_page + 1)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # Only whoever asked gets to flip through
+        if interaction.user.id != self.user.id:
+            await interaction.response.send_message("These aren't your buttons! Run `/quote top` yourself.", ephemeral=True)
+            return False
+        return True
+
+    @ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: ui.Button):
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        await interaction.response.edit_message(embed=await self.load(), view=self)
+
+    @ui.button(label="Next", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: ui.Button):
+        if self.rows:
+            last = self.rows[-1]
+            self.cursors.append((last[5], last[0]))
+        await interaction.response.edit_message(embed=await self.load(), view=self)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
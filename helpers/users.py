@@ -0,0 +1,208 @@
+import time
+import typing
+import asyncio
+import logging
+from collections import OrderedDict
+
+import discord
+
+from helpers import metrics
+
+logger = logging.getLogger('helpers')
+
+class UserResolver:
+    """Turns user IDs into discord.User objects as cheaply as possible.
+
+    In order: the gateway cache (guild members, then users), then users we've fetched
+    recently (LRU, expiring after `ttl` seconds), and only then the REST API, with every
+    remaining lookup sent at once but no more than `concurrency` in flight."""
+
+    def __init__(self, bot: discord.Client, max_size: int = 2048, ttl: int = 3600, concurrency: int = 5):
+        self.bot = bot
+        self.max_size = max_size
+        self.ttl = ttl
+        self.limiter = asyncio.Semaphore(concurrency)
+        self.cache: OrderedDict[int, tuple[float, discord.User | None]] = OrderedDict()
+
+        self.gateway_hits = 0
+        self.cache_hits = 0
+        self.fetches = 0
+        self.fetch_errors = 0
+
+    def cached(self, userid: int, guild: discord.Guild = None):
+        """Whatever we can find without a network call. Returns (found, user)."""
+        user = (guild.get_member(userid) if guild is not None else None) or self.bot.get_user(userid)
+        if user is not None:
+            self.gateway_hits += 1
+            return True, user
+
+        entry = self.cache.get(userid)
+        if entry is not None:
+            if time.monotonic() < entry[0]:
+                self.cache_hits += 1
+                self.cache.move_to_end(userid)
+                return True, entry[1]
+            del self.cache[userid]
+        return False, None
+
+    def remember(self, userid: int, user: discord.User | None):
+        self.cache[userid] = (time.monotonic() + self.ttl, user)
+        self.cache.move_to_end(userid)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def fetch(self, userid: int):
+        async with self.limiter:
+            self.fetches += 1
+            try:
+                with metrics.rest_call('fetch_user'):
+                    user = await self.bot.fetch_user(userid)
+            except discord.NotFound:
+                user = None # Deleted accounts stay deleted, so remember that too
+            except discord.HTTPException as error:
+                self.fetch_errors += 1
+                logger.warning(f"Users: couldn't fetch user {userid}: {error}")
+                return None
+        self.remember(userid, user)
+        return user
+
+    async def resolve_many(self, userids, guild: discord.Guild = None):
+        """{userid: user or None} for every ID given, with at most one round of REST calls."""
+        resolved = {}
+        missing = []
+        for userid in dict.fromkeys(userids):
+            if userid is None:
+                continue
+            found, user = self.cached(userid, guild)
+            if found:
+                resolved[userid] = user
+            else:
+                missing.append(userid)
+
+        if missing:
+            fetched = await asyncio.gather(*(self.fetch(userid) for userid in missing))
+            resolved.update(zip(missing, fetched))
+        return resolved
+
+    async def resolve(self, userid: int, guild: discord.Guild = None):
+        return (await self.resolve_many([userid], guild)).get(userid)
+
+    def stats(self):
+        return {
+            "cached": len(self.cache),
+            "gateway_hits": self.gateway_hits,
+            "cache_hits": self.cache_hits,
+            "fetches": self.fetches,
+            "fetch_errors": self.fetch_errors,
+        }
+
+class AuthorProfile(typing.NamedTuple):
+    id: int
+    name: str
+    display_name: str
+    avatar_url: str | None
+
+    @classmethod
+    def of(cls, user: discord.User | discord.Member):
+        return cls(user.id, user.name, user.display_name, user.display_avatar.url if user.display_avatar else None)
+
+class AuthorProfiles:
+    """What a quote needs to know about its author: name, avatar, and whether they're
+    still in the guild.
+
+    Members are filled in from the messages and interactions we see, so the usual case
+    needs no REST calls at all. Join, leave and profile update events only arrive with the
+    members intent, which the bot doesn't ask for, so nothing tells us when someone leaves:
+    every member entry expires after `ttl` seconds like the non-member ones do, and is
+    checked again then. People we've had to look up and found not to be in a guild are
+    remembered in a bounded LRU, and their user profile comes from the UserResolver cache."""
+
+    def __init__(self, resolver: UserResolver, max_nonmembers: int = 4096, ttl: int = 3600):
+        self.resolver = resolver
+        self.max_nonmembers = max_nonmembers
+        self.ttl = ttl
+        # guild -> user -> (expires, profile)
+        self.members: dict[int, dict[int, tuple[float, AuthorProfile]]] = {}
+        self.nonmembers: OrderedDict[tuple[int, int], float] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, member: discord.Member):
+        if not isinstance(member, discord.Member) or member.guild is None:
+            return
+        self.members.setdefault(member.guild.id, {})[member.id] = (time.monotonic() + self.ttl, AuthorProfile.of(member))
+        self.nonmembers.pop((member.guild.id, member.id), None)
+
+    def left(self, guild_id: int, user_id: int):
+        self.members.get(guild_id, {}).pop(user_id, None)
+        self.not_member(guild_id, user_id)
+
+    def user_updated(self, user: discord.User):
+        # Username/avatar changes apply everywhere, but guild nicknames/avatars win
+        for guild_id, members in self.members.items():
+            if user.id in members:
+                guild = self.resolver.bot.get_guild(guild_id)
+                member = guild.get_member(user.id) if guild is not None else None
+                members[user.id] = (members[user.id][0], AuthorProfile.of(member or user))
+        self.resolver.remember(user.id, user)
+
+    def not_member(self, guild_id: int, user_id: int):
+        self.nonmembers[(guild_id, user_id)] = time.monotonic() + self.ttl
+        self.nonmembers.move_to_end((guild_id, user_id))
+        while len(self.nonmembers) > self.max_nonmembers:
+            self.nonmembers.popitem(last=False)
+
+    def known_nonmember(self, guild_id: int, user_id: int):
+        expires = self.nonmembers.get((guild_id, user_id))
+        if expires is None:
+            return False
+        if time.monotonic() >= expires:
+            del self.nonmembers[(guild_id, user_id)]
+            return False
+        return True
+
+    async def lookup(self, guild: discord.Guild | None, user_id: int):
+        """(profile or None, is_member) for a quote author."""
+        if guild is not None:
+            entry = self.members.get(guild.id, {}).get(user_id)
+            if entry is not None:
+                if time.monotonic() < entry[0]:
+                    self.hits += 1
+                    return entry[1], True
+                del self.members[guild.id][user_id]
+
+            member = guild.get_member(user_id)
+            if member is not None:
+                self.hits += 1
+                self.seen(member)
+                return self.members[guild.id][user_id][1], True
+
+            if not self.known_nonmember(guild.id, user_id):
+                # First time we've wondered about them here, so ask once
+                self.misses += 1
+                try:
+                    with metrics.rest_call('fetch_member'):
+                        member = await guild.fetch_member(user_id)
+                    self.seen(member)
+                    return self.members[guild.id][user_id][1], True
+                except discord.NotFound:
+                    self.not_member(guild.id, user_id)
+                except discord.HTTPException as error:
+                    logger.warning(f"Users: couldn't fetch member {user_id} of guild {guild.id}: {error}")
+
+        found, user = self.resolver.cached(user_id)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+            user = await self.resolver.fetch(user_id)
+        return (AuthorProfile.of(user) if user is not None else None), False
+
+    def stats(self):
+        return {
+            "members": sum(len(members) for members in self.members.values()),
+            "nonmembers": len(self.nonmembers),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
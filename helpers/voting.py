@@ -0,0 +1,206 @@
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import discord
+from psycopg.types.json import Jsonb
+
+from helpers import database, queries, metrics
+from helpers.quoting import update_karma
+
+logger = logging.getLogger('helpers')
+
+thumbsUp, thumbsDown = "👍", "👎"
+
+def score_footer(karma, newkarma):
+    karmadiff = newkarma - karma
+    return f"Score: {'+' if newkarma > 0 else ''}{newkarma} ({'went up by +{karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff > 0 else 'went down by {karmadiff} pts'.format(karmadiff=karmadiff) if karmadiff < 0 else 'did not change'} this time)."
+
+count_up_query = queries.query("vote_up", "UPDATE bot.vote_windows SET up = up + %(delta)s WHERE msgid = %(msgid)s")
+count_down_query = queries.query("vote_down", "UPDATE bot.vote_windows SET down = down + %(delta)s WHERE msgid = %(msgid)s")
+open_window_query = queries.query("vote_window_open", '''INSERT INTO bot.vote_windows (msgid, channelid, guild, quoteid, karma, embed, closes_at)
+    VALUES (%(msgid)s, %(channelid)s, %(guild)s, %(quoteid)s, %(karma)s, %(embed)s, %(closes_at)s) ON CONFLICT (msgid) DO NOTHING''')
+close_window_query = queries.query("vote_window_close", "DELETE FROM bot.vote_windows WHERE msgid = %(msgid)s")
+
+class VoteWindow:
+    __slots__ = ('msgid', 'channelid', 'guild', 'quoteid', 'karma', 'up', 'down', 'embed', 'closes_at', 'resumed')
+
+    def __init__(self, msgid, channelid, guild, quoteid, karma, embed, closes_at, up=0, down=0, resumed=False):
+        self.msgid = msgid
+        self.channelid = channelid
+        self.guild = guild
+        self.quoteid = quoteid
+        self.karma = karma
+        self.up = up
+        self.down = down
+        self.embed = embed
+        self.closes_at = closes_at
+        self.resumed = resumed
+
+class VoteScheduler:
+    """Keeps track of every quote that's open for voting.
+
+    Windows are stored in bot.vote_windows and counted live from raw reaction events.
+    One task sleeps until the next window is due, closes it, and goes back to sleep,
+    so nothing sits around waiting on a single quote. Windows that were open when the
+    bot went down are picked back up by start()."""
+
+    def __init__(self, bot: discord.Client, timeout: int):
+        self.bot = bot
+        self.timeout = timeout # minutes
+        self.windows: dict[int, VoteWindow] = {}
+        self.heap: list[tuple[float, int]] = []
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    async def start(self):
+        if self.running:
+            return
+
+        async with database.connection() as con:
+            cur = await con.execute("SELECT msgid, channelid, guild, quoteid, karma, up, down, embed, closes_at FROM bot.vote_windows")
+            rows = await cur.fetchall()
+
+        for msgid, channelid, guild, quoteid, karma, up, down, embed, closes_at in rows:
+            # Reactions that came in while we were offline never reached us,
+            # so these get a recount from the message itself when they close
+            self.schedule(VoteWindow(msgid, channelid, guild, quoteid, karma, embed, closes_at.timestamp(), up, down, resumed=True))
+        if rows:
+            logger.info(f"Voting: resumed {len(rows)} open vote windows")
+
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+
+    def schedule(self, window: VoteWindow):
+        self.windows[window.msgid] = window
+        heapq.heappush(self.heap, (window.closes_at, window.msgid))
+        self.wakeup.set()
+
+    async def open(self, message: discord.Message, qid: int, karma: int, embed: discord.Embed):
+        """Start collecting votes on a quote message we just sent."""
+        await message.add_reaction(thumbsUp)
+        await message.add_reaction(thumbsDown)
+
+        window = VoteWindow(
+            message.id,
+            message.channel.id,
+            message.guild.id if message.guild else None,
+            qid,
+            karma,
+            embed.to_dict(),
+            time.time() + 60*self.timeout,
+        )
+        await open_window_query.run({
+            "msgid": window.msgid,
+            "channelid": window.channelid,
+            "guild": window.guild,
+            "quoteid": window.quoteid,
+            "karma": window.karma,
+            "embed": Jsonb(window.embed),
+            "closes_at": datetime.fromtimestamp(window.closes_at, timezone.utc),
+        })
+        self.schedule(window)
+
+    async def reaction(self, payload: discord.RawReactionActionEvent, delta: int):
+        """Count a vote from on_raw_reaction_add (delta=1) or on_raw_reaction_remove (delta=-1)."""
+        window = self.windows.get(payload.message_id)
+        if window is None or payload.user_id == self.bot.user.id:
+            return
+
+        match str(payload.emoji):
+            case "👍":
+                window.up += delta
+                query = count_up_query
+            case "👎":
+                window.down += delta
+                query = count_down_query
+            case _:
+                return
+
+        await query.run({"delta": delta, "msgid": window.msgid})
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            closes_at, msgid = self.heap[0]
+            delay = closes_at - time.time()
+            if delay > 0:
+                # Sleep until the next window is due, unless an earlier one gets opened meanwhile
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            window = self.windows.pop(msgid, None)
+            if window is None:
+                continue
+            try:
+                await self.close(window)
+            except Exception as error:
+                logger.error(f"Voting: could not close the vote on quote {window.quoteid} (msg {window.msgid})")
+                logger.exception(error)
+
+    async def recount(self, window: VoteWindow, message: discord.PartialMessage):
+        with metrics.rest_call('fetch_message'):
+            msg = await message.fetch()
+        window.up, window.down = 0, 0
+        # Count the reactions (Sanfords doesn't count)
+        for e in msg.reactions:
+            match e.emoji:
+                case "👍":
+                    window.up = e.count - 1
+                case "👎":
+                    window.down = e.count - 1
+
+    async def close(self, window: VoteWindow):
+        message = self.bot.get_partial_messageable(window.channelid, guild_id=window.guild).get_partial_message(window.msgid)
+        embed = discord.Embed.from_dict(window.embed)
+
+        try:
+            if window.resumed:
+                await self.recount(window, message)
+
+            karmadiff = window.up - window.down
+            update_karma(window.quoteid, karmadiff)
+            newkarma = window.karma + karmadiff
+
+            embed.set_footer(text=score_footer(window.karma, newkarma))
+            await message.edit(embed=embed)
+            await message.clear_reactions()
+        except discord.NotFound:
+            logger.info(f"Voting: quote message {window.msgid} is gone, dropping its vote")
+        except Exception as error:
+            embed.set_footer(text=f"Score: {'+' if window.karma > 0 else ''}{window.karma} (no change due to error: {error}")
+            try:
+                await message.edit(embed=embed)
+            except discord.HTTPException:
+                pass
+            raise
+        finally:
+            await close_window_query.run({"msgid": window.msgid})
+
+    def stats(self):
+        return {
+            "open": len(self.windows),
+            "next_close_in": max(0.0, self.heap[0][0] - time.time()) if self.heap else None,
+        }
@@ -0,0 +1,119 @@
+# Benchmark one member's leaderboard ranks (Leaderboards.ranks in helpers/leaderboard.py)
+# against loading the whole board and searching it, as 'Leaderboard Stats' used to.
+#
+#   python leaderbench.py --authors 10000 --guild 1
+#
+# Fills guild `--guild` in bot.quotes with quotes by `--authors` made-up users (pick a
+# guild ID that isn't real!), builds its leaderboard, times each way of looking members
+# up, checks they agree, and deletes it all again unless --keep.
+# Needs config.yaml (for the database) in the working directory, like the bot.
+
+import time
+import random
+import asyncio
+import argparse
+
+from helpers import database
+from helpers.bench import report
+from helpers.leaderboard import Leaderboards, categories
+
+async def timed(label, users, lookup):
+    latencies = []
+    for user in users:
+        start = time.perf_counter()
+        await lookup(user)
+        latencies.append((time.perf_counter() - start) * 1000)
+    report(label, latencies, "lookups")
+
+def old_ranks(board, userid):
+    # As 'Leaderboard Stats' did it: a linear search of each ranking for the member
+    def findIndex(l, index, value):
+        for pos, t in enumerate(l):
+            if t[index] == value:
+                return pos
+        raise ValueError("list.index(x): x not in list")
+
+    ranks = {}
+    for category in categories:
+        try:
+            value, _, rank = board.rankings[category][findIndex(board.rankings[category], 1, userid)]
+            ranks[category] = (value, rank)
+        except ValueError:
+            ranks[category] = None
+    return ranks
+
+async def main(args):
+    await database.open_pool()
+    await database.migrate()
+    gid = args.guild
+
+    async with database.connection() as con:
+        if (await (await con.execute("SELECT count(*) FROM bot.quotes WHERE guild = %s", (gid,))).fetchone())[0]:
+            print(f"Guild {gid} already has quotes; pick an unused --guild")
+            return
+        start = time.perf_counter()
+        # Authors 1..N with a long tail of quote counts, saved by the same people
+        # (the g * 0 makes Postgres pick a fresh author for every row)
+        await con.execute('''INSERT INTO bot.quotes (content, authorid, authorname, addedby, guild, timestamp, karma)
+            SELECT 'Synthetic quote number ' || g, a, 'user' || a, 1 + (random() * (%(authors)s::int - 1))::bigint, %(guild)s,
+                1500000000 + g, 1 + (random() * 10)::int
+            FROM generate_series(1, %(authors)s::int * %(per_author)s::int) g,
+                LATERAL (SELECT 1 + floor(%(authors)s::int * power(random(), 2) + g * 0)::bigint AS a) author''',
+            {"authors": args.authors, "per_author": args.per_author, "guild": gid})
+        quotes, authors = await (await con.execute("SELECT count(*), count(DISTINCT authorid) FROM bot.quotes WHERE guild = %s", (gid,))).fetchone()
+        await con.execute("ANALYZE bot.quotes")
+    print(f"Inserted {quotes:,} quotes by {authors:,} authors in {time.perf_counter() - start:.1f}s\n")
+
+    leaderboards = Leaderboards(ttl=3600)
+    users = random.choices(range(1, args.authors + 1), k=args.lookups)
+    try:
+        start = time.perf_counter()
+        await leaderboards.refresh(gid)
+        print(f"{'First build (refresh)':<34} {(time.perf_counter() - start) * 1000:8.1f}ms")
+        start = time.perf_counter()
+        await leaderboards.get(gid)
+        print(f"{'Board load (get)':<34} {(time.perf_counter() - start) * 1000:8.1f}ms\n")
+
+        async def old(user):
+            leaderboards.invalidate(gid)
+            return old_ranks(await leaderboards.get(gid), user)
+
+        async def cold(user):
+            leaderboards.invalidate(gid)
+            return await leaderboards.ranks(gid, user)
+
+        async def warm(user):
+            return await leaderboards.ranks(gid, user)
+
+        await timed("Old: load board + linear search", users[:args.old_lookups], old)
+        await timed("ranks(), board not loaded (SQL)", users, cold)
+        await leaderboards.get(gid)
+        await timed("ranks(), board in memory", users, warm)
+        print()
+
+        # Every way should give the same answer
+        board = await leaderboards.get(gid)
+        mismatches = 0
+        for user in users[:args.old_lookups]:
+            leaderboards.invalidate(gid)
+            from_sql = await leaderboards.ranks(gid, user)
+            if not (from_sql == board.ranks(user) == old_ranks(board, user)):
+                mismatches += 1
+        print(f"Checked {min(len(users), args.old_lookups)} members: {mismatches} disagreed")
+    finally:
+        if not args.keep:
+            async with database.connection() as con:
+                await con.execute("DELETE FROM bot.quotes WHERE guild = %s", (gid,))
+                await con.execute("DELETE FROM bot.leaderboard WHERE guild = %s", (gid,))
+                await con.execute("DELETE FROM bot.leaderboard_guilds WHERE guild = %s", (gid,))
+        await database.close_pool()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark leaderboard rank lookups for one member.")
+    parser.add_argument('-a', '--authors', type=int, default=10_000, help="Synthetic authors (and savers)")
+    parser.add_argument('-q', '--per-author', type=int, default=5, help="Quotes per author, on average")
+    parser.add_argument('-g', '--guild', type=int, default=1, help="Guild ID to put them in (must have no quotes)")
+    parser.add_argument('-l', '--lookups', type=int, default=1000, help="Timed lookups for each new way")
+    parser.add_argument('-o', '--old-lookups', type=int, default=50, help="Timed lookups for the old way, which is slow")
+    parser.add_argument('--keep', action='store_true', help="Leave the synthetic guild in the database")
+    asyncio.run(main(parser.parse_args()))
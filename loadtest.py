@@ -0,0 +1,59 @@
+# Hammer the Sanford API with concurrent requests and report latency percentiles.
+#
+#   python loadtest.py http://localhost:8690/quote/server/1234 --requests 2000 --concurrency 50
+#
+# Run it against a live bot and watch the gateway heartbeat (or /status/database and
+# /status/api) while it goes - API load shouldn't hold up anything else.
+
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+
+from helpers.bench import percentile
+
+async def worker(session, url, remaining, latencies, statuses):
+    while True:
+        try:
+            remaining.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        except aiohttp.ClientError as error:
+            statuses[type(error).__name__] = statuses.get(type(error).__name__, 0) + 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+async def main(args):
+    remaining = asyncio.Queue()
+    for _ in range(args.requests):
+        remaining.put_nowait(None)
+    latencies = []
+    statuses = {}
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session, args.url, remaining, latencies, statuses) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    print(f"{args.requests} requests, {args.concurrency} at a time, in {elapsed:.2f}s ({args.requests / elapsed:.1f} req/s)")
+    print(f"Responses: {', '.join(f'{status}: {count}' for status, count in sorted(statuses.items(), key=str))}")
+    if latencies:
+        print(f"Latency (ms): p50 {percentile(latencies, 50):.1f}, p90 {percentile(latencies, 90):.1f}, "
+              f"p99 {percentile(latencies, 99):.1f}, max {max(latencies):.1f}, mean {statistics.fmean(latencies):.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test a Sanford API endpoint.")
+    parser.add_argument('url', help="Full URL to request, e.g. http://localhost:8690/quote/server/1234")
+    parser.add_argument('-n', '--requests', type=int, default=1000, help="Total requests to make")
+    parser.add_argument('-c', '--concurrency', type=int, default=20, help="Requests in flight at once")
+    parser.add_argument('-t', '--timeout', type=float, default=30, help="Seconds before a request counts as failed")
+    asyncio.run(main(parser.parse_args()))
@@ -1,84 +1,52 @@
-from mastodon import Mastodon
 import yaml
-import psycopg2
-import re
+import asyncio
 import argparse
-from helpers.quoting import rename_user,strip_discord_format
 
-
-import schedule
-import time
-from datetime import datetime
-
-from helpers.quoting import format_quote,fetch_random_quote
+from helpers import database
+from helpers.poster import MastodonPoster
+from helpers.quoting import user_prefs
 
 # load config
 with open('config.yaml', 'r') as file:
     cfg = yaml.safe_load(file)
 
-con = psycopg2.connect(
-    database = cfg['postgresql']['database'],
-    host = cfg['postgresql']['host'] if hasattr(cfg['postgresql'], "host") else None,
-    user = cfg['postgresql']['user'],
-    password = cfg['postgresql']['password'],
-)
-cur = con.cursor()
-
-mastodon = Mastodon(
-        access_token = cfg['mastodon']['access_token'],
-        api_base_url = cfg['mastodon']['api_base_url']
-)
-
-post_string = '''"{0}"
-    —{1} / {2}'''
-
-def post_new_quote(content, aID, timestamp):
-
-    # Scrub Discord-specific formatting
-    content = strip_discord_format(content)
-
+# The poster itself lives in helpers/poster.py, so the bot can run it too
+# (set mastodon.run_in_bot). This runs it on its own. Both can run at once.
+
+async def main(args):
+    await database.open_pool()
+    await database.migrate()
+    # Kept up to date by the bot's /mastodon command as it's used
+    await user_prefs.start()
+
+    postercfg = cfg['mastodon'].get('poster') or {}
+    if args.debug:
+        postercfg['interval'] = 120
+    poster = MastodonPoster(
+        cfg['mastodon']['api_base_url'],
+        cfg['mastodon']['access_token'],
+        lambda: user_prefs.excluded,
+        **postercfg
+    )
+    print(f"Posting every {poster.interval / 3600:g} hours" if poster.interval >= 3600 else f"Posting every {poster.interval:g} seconds")
 
-    quote = format_quote(content,authorName=rename_user(aID,f'(@splatsune@thegeneral.chat has no map for user {aID}!)'),timestamp=timestamp) 
-    mastodon.status_post(quote)
+    try:
+        await poster.run()
+    finally:
+        await user_prefs.stop()
+        await database.close_pool()
 
 # Main script
 if __name__ == "__main__":
 
     arguments =  argparse.ArgumentParser(
-        description= 'Posts quotes to Mastodon every 2 hours!'
+        description= 'Posts quotes to Mastodon every 3 hours, and new quotes as they are saved!'
     )
 
     arguments.add_argument('--debug', action='store_true', help='Debug mode. Posts every two minutes instead')
     args = arguments.parse_args()
 
-    usedids = []
-
-    def post():
-        id,content,aID,aName,timestamp,karma = fetch_random_quote(124680630075260928, cfg['mastodon']['exclude_users'])
-        while id in usedids: # if id has been used recently
-            id,content,aID,aName,timestamp,karma = fetch_random_quote(124680630075260928, cfg['mastodon']['exclude_users'])
-        usedids.append(id)
-        content = strip_discord_format(content)
-        
-        # Console logging
-        print("'" + content + "' - " + rename_user(aID, f'no map for user {str(aID)}') + " (ID " + str(aID) + ", timestamp " + str(timestamp) + ")")
-
-        quote = format_quote(content,authorName=rename_user(aID,f'(@splatsune@thegeneral.chat has no map for user {aID}!)'),timestamp=timestamp)
-            
-        try:
-            mastodon.status_post(quote)
-        except MastodonAPIError as error:
-            print(f'Could not post this time due to: {error}')
-
-    if args.debug == True:
-        # Schedule to run every 3 minutes (for testing)
-        print('Debug Mode: Posting every 2 minutes')
-        schedule.every(2).minutes.do(post)
-    else:
-        # Schedule to run every 2 hours
-        print('Posting every 3 hours')
-        schedule.every(3).hours.at("00:00").do(post)
-
-    while True:
-        schedule.run_pending()
-        time.sleep(3)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
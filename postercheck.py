@@ -0,0 +1,141 @@
+# Check the Mastodon poster (helpers/poster.py) against a fake Mastodon server that
+# misbehaves on purpose, without posting anything anywhere.
+#
+#   python postercheck.py --guild 1 --port 8765
+#
+# Saves a few made-up quotes in guild `--guild` (pick a guild ID that isn't real!) and
+# queues them through a MastodonPoster pointed at the fake server, which answers:
+#   "flaky"    500 the first time, then posts: retried, with the same Idempotency-Key
+#   "limited"  429 with Retry-After the first time, then posts: waits, attempt refunded
+#   "rejected" 422 every time: given up on straight away, not retried
+#   "fine"     posts first time
+# Then checks the outbox and the poster's counters agree, and cleans up unless --keep.
+# Use a scratch database: the poster sends anything else that's due in the outbox too.
+# Needs config.yaml (for the database) in the working directory, like the bot.
+
+import sys
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+from helpers import database
+from helpers.poster import MastodonPoster
+
+TOKEN = "postercheck-token"
+
+class FakeMastodon:
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        # kind -> [(Idempotency-Key, Authorization)] for every request for it
+        self.calls: dict[str, list[tuple]] = {}
+
+    async def statuses(self, request: web.Request):
+        status = (await request.post())['status']
+        kind = next((k for k in ("flaky", "limited", "rejected", "fine") if k in status), "unknown")
+        calls = self.calls.setdefault(kind, [])
+        calls.append((request.headers.get('Idempotency-Key'), request.headers.get('Authorization')))
+
+        if kind == "flaky" and len(calls) == 1:
+            return web.Response(status=500, text="something broke")
+        if kind == "limited" and len(calls) == 1:
+            return web.Response(status=429, text="slow down", headers={"Retry-After": str(self.retry_after), "X-RateLimit-Remaining": "0"})
+        if kind in ("rejected", "unknown"):
+            return web.Response(status=422, text="Validation failed: text is too long")
+        return web.json_response({"id": f"{kind}-{len(calls)}", "url": f"https://example.invalid/@sanford/{kind}"},
+                                 headers={"X-RateLimit-Remaining": "300"})
+
+async def main(args):
+    fake = FakeMastodon(args.retry_after)
+    app = web.Application()
+    app.router.add_post('/api/v1/statuses', fake.statuses)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+
+    await database.open_pool()
+    await database.migrate()
+    gid = args.guild
+    failures = []
+
+    def check(what, ok):
+        print(f"{'ok  ' if ok else 'FAIL'} {what}")
+        if not ok:
+            failures.append(what)
+
+    poster = MastodonPoster(f"http://127.0.0.1:{args.port}/", TOKEN, lambda: [], guild=gid, interval=0,
+                            backoff=0.2, max_attempts=3, poll=1)
+    try:
+        async with database.connection() as con:
+            if (await (await con.execute("SELECT count(*) FROM bot.quotes WHERE guild = %s", (gid,))).fetchone())[0]:
+                print(f"Guild {gid} already has quotes; pick an unused --guild")
+                return 2
+            rows = await (await con.execute('''INSERT INTO bot.quotes (content, authorid, guild, timestamp)
+                SELECT kind || ' quote', 1, %s, 1700000000 FROM unnest(ARRAY['flaky', 'limited', 'rejected', 'fine']) kind
+                RETURNING content, id''', (gid,))).fetchall()
+        quotes = {content.split()[0]: qid for content, qid in rows}
+
+        poster.start()
+        outbox = {kind: await poster.enqueue(qid) for kind, qid in quotes.items()}
+
+        # Wait for every post to be sent or given up on
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            async with database.connection() as con:
+                pending = (await (await con.execute('''SELECT count(*) FROM bot.mastodon_outbox
+                    WHERE id = ANY(%s) AND posted_at IS NULL AND failed_at IS NULL''', (list(outbox.values()),))).fetchone())[0]
+            if pending == 0:
+                break
+            await asyncio.sleep(0.2)
+        check(f"every post settled within {args.timeout}s", pending == 0)
+
+        async with database.connection() as con:
+            rows = await (await con.execute('''SELECT id, attempts, posted_at IS NOT NULL, failed_at IS NOT NULL, last_error, status_id
+                FROM bot.mastodon_outbox WHERE id = ANY(%s)''', (list(outbox.values()),))).fetchall()
+        results = {oid: row for oid, *row in rows}
+
+        for kind, oid in outbox.items():
+            calls = fake.calls.get(kind, [])
+            check(f"{kind}: every request had Idempotency-Key sanford-outbox-{oid}",
+                  bool(calls) and all(key == f"sanford-outbox-{oid}" for key, _ in calls))
+            check(f"{kind}: every request had the access token", all(auth == f"Bearer {TOKEN}" for _, auth in calls))
+
+        attempts, posted, failed, error, status_id = results[outbox['flaky']]
+        check("flaky: 500 retried, then posted", len(fake.calls.get('flaky', [])) == 2 and posted and status_id == "flaky-2")
+        check("flaky: the 500 counted as an attempt", attempts == 2)
+
+        attempts, posted, failed, error, status_id = results[outbox['limited']]
+        check("limited: 429 waited out, then posted", len(fake.calls.get('limited', [])) == 2 and posted)
+        check("limited: the 429 didn't count as an attempt", attempts == 1)
+
+        attempts, posted, failed, error, status_id = results[outbox['rejected']]
+        check("rejected: 422 given up on without retrying", len(fake.calls.get('rejected', [])) == 1 and failed and not posted)
+        check("rejected: the error was kept", error is not None and error.startswith("HTTP 422"))
+
+        attempts, posted, failed, error, status_id = results[outbox['fine']]
+        check("fine: posted first time", len(fake.calls.get('fine', [])) == 1 and posted and attempts == 1)
+
+        status = await poster.status()
+        check("poster counted 3 posted, 1 retry, 1 failure, 1 rate limit",
+              (status['posted'], status['retries'], status['failures'], status['rate_limited']) == (3, 1, 1, 1))
+    finally:
+        await poster.stop()
+        if not args.keep:
+            async with database.connection() as con:
+                await con.execute("DELETE FROM bot.mastodon_outbox WHERE guild = %s", (gid,))
+                await con.execute("DELETE FROM bot.quotes WHERE guild = %s", (gid,))
+        await database.close_pool()
+        await runner.cleanup()
+
+    print(f"\n{len(failures)} check(s) failed" if failures else "\nAll checks passed")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the Mastodon poster's retries against a fake Mastodon server.")
+    parser.add_argument('-g', '--guild', type=int, default=1, help="Guild ID to save the test quotes in (must have no quotes)")
+    parser.add_argument('-p', '--port', type=int, default=8765, help="Port for the fake Mastodon server")
+    parser.add_argument('-r', '--retry-after', type=int, default=1, help="Retry-After the fake server sends with its 429")
+    parser.add_argument('-t', '--timeout', type=float, default=30, help="Seconds to wait for every post to settle")
+    parser.add_argument('--keep', action='store_true', help="Leave the test quotes and outbox rows in the database")
+    sys.exit(asyncio.run(main(parser.parse_args())))
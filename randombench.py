@@ -0,0 +1,117 @@
+# Benchmark random quote picks (helpers/randompick.py and helpers/quotecache.py) against
+# the ORDER BY random() query they replaced, on a big synthetic guild.
+#
+#   python randombench.py --rows 1000000 --guild 1
+#
+# Fills guild `--guild` in bot.quotes with `--rows` made-up quotes (pick a guild ID that
+# isn't real!), times each way of picking a random quote from the guild and from one
+# author, checks the picks are uniform, and deletes the quotes again unless --keep.
+# Needs config.yaml (for the database) in the working directory, like the bot.
+
+import time
+import asyncio
+import argparse
+
+from helpers import database
+from helpers.bench import report
+from helpers.quoting import quote_ids, quote_cache, quote_by_id
+
+async def timed(label, picks, pick):
+    latencies = []
+    for _ in range(picks):
+        start = time.perf_counter()
+        await pick()
+        latencies.append((time.perf_counter() - start) * 1000)
+    report(label, latencies, "picks")
+
+def uniformity(label, ids, picks, bins=100):
+    """Chi-squared over `bins` equal slices of the scope's sorted IDs: each slice should come
+    up equally often. Passes if it's under the 95th percentile for that many degrees of freedom."""
+    ids = sorted(ids)
+    bins = min(bins, len(ids))
+    position = {qid: i for i, qid in enumerate(ids)}
+    sizes, counts = [0] * bins, [0] * bins
+    for i in range(len(ids)):
+        sizes[i * bins // len(ids)] += 1
+    for qid in picks:
+        counts[position[qid] * bins // len(ids)] += 1
+    chi2 = sum((c - len(picks) * size / len(ids)) ** 2 / (len(picks) * size / len(ids)) for c, size in zip(counts, sizes))
+    # Wilson-Hilferty approximation of the chi-squared 95th percentile
+    dof = bins - 1
+    critical = dof * (1 - 2 / (9 * dof) + 1.645 * (2 / (9 * dof)) ** 0.5) ** 3 if dof else 0.0
+    print(f"{label:<34} chi-squared {chi2:7.1f} over {bins} bins of {len(ids):,} quotes, {len(picks):,} picks "
+          f"({'uniform' if chi2 < critical else 'NOT uniform'} at p = 0.05, limit {critical:.1f})")
+
+async def main(args):
+    await database.open_pool()
+    await database.migrate()
+    gid, author = args.guild, 7
+
+    async with database.connection() as con:
+        if (await (await con.execute("SELECT count(*) FROM bot.quotes WHERE guild = %s", (gid,))).fetchone())[0]:
+            print(f"Guild {gid} already has quotes; pick an unused --guild")
+            return
+        start = time.perf_counter()
+        await con.execute('''INSERT INTO bot.quotes (content, authorid, authorname, guild, timestamp)
+            SELECT 'Synthetic quote number ' || g, g %% %s, 'user' || (g %% %s), %s, 1500000000 + g
+            FROM generate_series(1, %s) g''', (args.authors, args.authors, gid, args.rows))
+        await con.execute("ANALYZE bot.quotes")
+    print(f"Inserted {args.rows:,} quotes by {args.authors} authors in {time.perf_counter() - start:.1f}s\n")
+
+    try:
+        async def order_by_random(uid=None):
+            async with database.connection() as con:
+                if uid is None:
+                    cur = await con.execute("SELECT * FROM bot.quotes WHERE guild = %s ORDER BY random() LIMIT 1", (gid,))
+                else:
+                    cur = await con.execute("SELECT * FROM bot.quotes WHERE guild = %s AND authorid = %s ORDER BY random() LIMIT 1", (gid, uid))
+                return await cur.fetchone()
+
+        async def id_index(uid=None):
+            return await quote_by_id.fetchone({"id": await quote_ids.pick(gid, uid)})
+
+        # Cold loads first: what the first pick after a restart (or ttl) costs
+        for label, load in (("ID index, cold load (guild)", lambda: quote_ids.ids(gid)),
+                            ("ID index, cold load (author)", lambda: quote_ids.ids(gid, author)),
+                            ("Quote cache, cold load (guild)", lambda: quote_cache.guild(gid))):
+            start = time.perf_counter()
+            await load()
+            print(f"{label:<34} {(time.perf_counter() - start) * 1000:8.1f}ms")
+        if gid in quote_cache.oversized:
+            print("(the guild is too big for the quote cache's max_bytes, so it's left out below)")
+        print()
+
+        await timed("ORDER BY random() (guild)", args.old_picks, order_by_random)
+        await timed("ORDER BY random() (author)", args.old_picks, lambda: order_by_random(author))
+        await timed("ID index + PK lookup (guild)", args.picks, id_index)
+        await timed("ID index + PK lookup (author)", args.picks, lambda: id_index(author))
+        if gid not in quote_cache.oversized:
+            await timed("Quote cache (guild)", args.picks, lambda: quote_cache.pick(gid))
+            await timed("Quote cache (author)", args.picks, lambda: quote_cache.pick(gid, author))
+        print()
+
+        # The in-memory part on its own, enough times to check the spread
+        guild_ids, author_ids = await quote_ids.ids(gid), await quote_ids.ids(gid, author)
+        uniformity("ID index (guild)", guild_ids, [await quote_ids.pick(gid) for _ in range(args.samples)])
+        uniformity("ID index (author)", author_ids, [await quote_ids.pick(gid, author) for _ in range(args.samples)])
+        if gid not in quote_cache.oversized:
+            uniformity("Quote cache (guild)", guild_ids, [(await quote_cache.pick(gid))[1].id for _ in range(args.samples)])
+            uniformity("Quote cache (author)", author_ids, [(await quote_cache.pick(gid, author))[1].id for _ in range(args.samples)])
+    finally:
+        quote_ids.forget(gid)
+        quote_cache.forget(gid)
+        if not args.keep:
+            async with database.connection() as con:
+                await con.execute("DELETE FROM bot.quotes WHERE guild = %s", (gid,))
+        await database.close_pool()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark random quote picks against ORDER BY random().")
+    parser.add_argument('-n', '--rows', type=int, default=1_000_000, help="Synthetic quotes to insert")
+    parser.add_argument('-a', '--authors', type=int, default=500, help="Authors to spread them over")
+    parser.add_argument('-g', '--guild', type=int, default=1, help="Guild ID to put them in (must have no quotes)")
+    parser.add_argument('-p', '--picks', type=int, default=2000, help="Timed picks for each new way")
+    parser.add_argument('-o', '--old-picks', type=int, default=50, help="Timed picks for ORDER BY random(), which is slow")
+    parser.add_argument('-s', '--samples', type=int, default=200_000, help="Picks used to check uniformity")
+    parser.add_argument('--keep', action='store_true', help="Leave the synthetic quotes in the database")
+    asyncio.run(main(parser.parse_args()))
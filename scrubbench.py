@@ -0,0 +1,66 @@
+# Time the Discord markup scrubber (helpers/scrubber.py) against the one it replaced.
+#
+#   python scrubbench.py --quotes 20000 --mentions 3
+#
+# Builds quotes full of mentions, emoji and timestamps, then scrubs them with the old
+# regex-and-replace function, Scrubber.scrub one at a time, and Scrubber.scrub_many.
+
+import re
+import time
+import random
+import argparse
+
+from helpers.scrubber import Scrubber
+
+def old_strip_discord_format(str, users):
+    # As it was in helpers/quoting.py, with the alias lookup it did for every mention
+    def rename_user(id, fallback):
+        for k,v in users.items():
+            if k == id:
+                return v
+        else:
+            return fallback
+
+    emoji = re.compile(r"<(:\S+:)\d+>")
+    user = re.compile(r"<@!?(\d+)>")
+    str = re.sub(emoji,r"\g<1>",str)
+    for match in user.finditer(str):
+        str = str.replace(f"<@{match.group(1)}>", rename_user(match.group(1), '(user id here, no match)'))
+        str = str.replace(f"<@!{match.group(1)}>", rename_user(match.group(1), '(user id here, no match)'))
+    return str
+
+def make_quotes(count, mentions, users):
+    ids = list(users)
+    words = "the quick brown fox jumps over a lazy dog and then it says".split()
+    quotes = []
+    for _ in range(count):
+        parts = random.choices(words, k=12)
+        for _ in range(mentions):
+            parts.insert(random.randrange(len(parts)), random.choice([
+                f"<@{random.choice(ids)}>", f"<@!{random.choice(ids)}>", "<:blobcat:1234567890>", f"<t:{random.randrange(1_500_000_000, 1_800_000_000)}:D>",
+            ]))
+        quotes.append(" ".join(parts))
+    return quotes
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:9.1f}ms  {count / elapsed:12,.0f} quotes/s")
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the Discord markup scrubber.")
+    parser.add_argument('-n', '--quotes', type=int, default=20000, help="Quotes to scrub")
+    parser.add_argument('-m', '--mentions', type=int, default=3, help="Bits of markup per quote")
+    parser.add_argument('-u', '--users', type=int, default=200, help="Users with a name mapped")
+    args = parser.parse_args()
+
+    users = {random.randrange(10**17, 10**18): f"user{i}" for i in range(args.users)}
+    quotes = make_quotes(args.quotes, args.mentions, users)
+    scrubber = Scrubber(users)
+
+    timed("old strip_discord_format", len(quotes), lambda: [old_strip_discord_format(q, users) for q in quotes])
+    single = timed("Scrubber.scrub", len(quotes), lambda: [scrubber.scrub(q) for q in quotes])
+    batch = timed("Scrubber.scrub_many", len(quotes), lambda: scrubber.scrub_many(quotes))
+    assert single == batch